@@ -0,0 +1,280 @@
+"""
+Local stand-ins for the Telegram Bot API and PhotoRoom /v2/edit, used by the
+benchmarks. Both are plain aiohttp apps; point the bot at them with
+TelegramAPIServer.from_base(...) and PHOTOROOM_API_URL.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Any
+
+from aiohttp import web
+
+# replies that only report progress; anything else ends a job for that chat
+STATUS_PREFIXES = ("⏳", "🕒")
+
+
+async def serve(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> Tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API: getFile + file download from an in-memory dict,
+    send*/edit* answered with plausible Message objects, getChatMember
+    answering `member_status`, getUpdates serving a preloaded queue.
+    Every call is recorded with its arrival time.
+
+    With `local_dir` it behaves like telegram-bot-api --local: getFile
+    writes the file there and returns its absolute path, and file://
+    arguments of send* calls are counted in `local_uploads`.
+
+    Flood limits: chats in `blocked` answer send* with 403, and more than
+    `flood_rate` send* calls per second get 429 with retry_after.
+    """
+
+    def __init__(
+        self,
+        files: Optional[Dict[str, bytes]] = None,
+        member_status: str = "member",
+        latency: float = 0.0,
+        local_dir: Optional[str] = None,
+        blocked: Optional[set] = None,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+    ):
+        self.files: Dict[str, bytes] = files or {}
+        self.member_status = member_status
+        self.latency = latency
+        self.local_dir = local_dir
+        self.local_uploads = 0
+        self.blocked = blocked or set()
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.flood_errors = 0
+        self._sends: List[float] = []
+
+        self.calls: List[Tuple[float, str, Dict[str, Any]]] = []
+        self.counts: Dict[str, int] = defaultdict(int)
+        # chat_id -> arrival times of final (non-status) replies, in order
+        self.replies: Dict[int, List[float]] = defaultdict(list)
+        self.text_replies = 0  # final replies without a result (errors, sub wall, paywall)
+        self.updates: List[Dict[str, Any]] = []
+        self._update_event = asyncio.Event()
+        self._ids = itertools.count(1000)
+
+    @property
+    def replied(self) -> int:
+        return sum(len(v) for v in self.replies.values())
+
+    def push_updates(self, updates: List[Dict[str, Any]]):
+        self.updates.extend(updates)
+        self._update_event.set()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self._file)
+        return app
+
+    async def _params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type.startswith("multipart/"):
+            params: Dict[str, Any] = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename is None:
+                    params[part.name] = (await part.read()).decode()
+                else:
+                    size = 0
+                    while chunk := await part.read_chunk():
+                        size += len(chunk)
+                    params[part.name] = size
+            return params
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.can_read_body:
+            return dict(await request.post())
+        return {}
+
+    def _message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **fields,
+        }
+
+    def _photo(self) -> List[Dict[str, Any]]:
+        n = next(self._ids)
+        return [{"file_id": f"res{n}", "file_unique_id": f"resu{n}", "width": 512, "height": 512}]
+
+    async def _method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        now = time.monotonic()
+        self.calls.append((now, method, params))
+        self.counts[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        m = method.lower()
+        chat_id = int(params.get("chat_id") or 0)
+        if m.startswith(("send", "copy")):
+            error = self._send_error(chat_id, now)
+            if error is not None:
+                return web.json_response(error, status=error["error_code"])
+        if m.startswith("send"):
+            self.local_uploads += sum(1 for v in params.values() if isinstance(v, str) and v.startswith("file://"))
+            if m == "sendmediagroup":
+                self.local_uploads += params.get("media", "").count('"file://')
+        if m.startswith("send") and chat_id:
+            text = params.get("text") or ""
+            if not (m == "sendmessage" and text.startswith(STATUS_PREFIXES)):
+                self.replies[chat_id].append(now)
+                if m == "sendmessage":
+                    self.text_replies += 1
+
+        if m == "getme":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif m == "getfile":
+            fid = params["file_id"]
+            result = {
+                "file_id": fid,
+                "file_unique_id": f"u{fid}",
+                "file_size": len(self.files[fid]),
+                "file_path": self._local_path(fid) if self.local_dir else f"files/{fid}.jpg",
+            }
+        elif m == "copymessage":
+            result = {"message_id": next(self._ids)}
+        elif m in ("sendmessage", "editmessagetext"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif m == "sendphoto":
+            result = self._message(chat_id, photo=self._photo())
+        elif m == "senddocument":
+            n = next(self._ids)
+            result = self._message(chat_id, document={"file_id": f"doc{n}", "file_unique_id": f"docu{n}"})
+        elif m == "sendmediagroup":
+            media = json.loads(params.get("media") or "[]")
+            result = [self._message(chat_id, photo=self._photo()) for _ in media]
+        elif m == "getchatmember":
+            user = {"id": int(params["user_id"]), "is_bot": False, "first_name": "user"}
+            result = {"status": self.member_status, "user": user}
+        elif m == "getupdates":
+            result = await self._get_updates(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _send_error(self, chat_id: int, now: float) -> Optional[Dict[str, Any]]:
+        if chat_id in self.blocked:
+            return {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if self.flood_rate:
+            self._sends = [t for t in self._sends if t > now - 1.0]
+            if len(self._sends) >= self.flood_rate:
+                self.flood_errors += 1
+                return {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            self._sends.append(now)
+        return None
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), timeout=min(timeout, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _local_path(self, fid: str) -> str:
+        path = os.path.abspath(os.path.join(self.local_dir, f"{fid}.jpg"))
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(self.files[fid])
+        return path
+
+    async def _file(self, request: web.Request) -> web.Response:
+        name = request.match_info["path"].rsplit("/", 1)[-1]
+        fid = name.rsplit(".", 1)[0]
+        data = self.files.get(fid)
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/jpeg")
+
+
+# result size per export.format relative to PNG (rough ratios for a cut-out on white)
+FORMAT_RATIOS = {"png": 1.0, "jpeg": 0.15, "webp": 0.1}
+
+
+class FakePhotoRoom:
+    """
+    /v2/edit with configurable latency (mean, +-jitter) and error rate.
+    The result is `result_bytes` long for PNG, scaled by FORMAT_RATIOS for
+    the requested export.format; request fields are counted in `fields`.
+    """
+
+    def __init__(self, latency: float = 0.3, jitter: float = 0.1, error_rate: float = 0.0, result_bytes: int = 200_000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        block = bytes(random.getrandbits(8) for _ in range(1024))
+        self.results = {
+            fmt: block * max(1, int(result_bytes * ratio) // 1024) for fmt, ratio in FORMAT_RATIOS.items()
+        }
+
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.fields: Dict[str, int] = defaultdict(int)
+        self.durations: List[float] = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v2/edit", self._edit)
+        return app
+
+    async def _edit(self, request: web.Request) -> web.StreamResponse:
+        started = time.monotonic()
+        self.requests += 1
+        size = 0
+        fields: Dict[str, str] = {}
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                fields[part.name] = (await part.read()).decode()
+                self.fields[f"{part.name}={fields[part.name]}"] += 1
+            else:
+                while chunk := await part.read_chunk():
+                    size += len(chunk)
+        self.bytes_in += size
+
+        await asyncio.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="unavailable")
+
+        fmt = fields.get("export.format", "png")
+        body = self.results.get(fmt, self.results["png"])
+        self.bytes_out += len(body)
+        resp = web.Response(body=body, content_type=f"image/{fmt}")
+        self.durations.append(time.monotonic() - started)
+        return resp
@@ -0,0 +1,567 @@
+"""
+End-to-end load test: synthetic photo/document updates go through the real
+Dispatcher handlers, with the Bot API and PhotoRoom replaced by the local
+stand-ins from bench.fakes. No credentials, no network.
+
+    python -m bench.loadtest --updates 200 --rate 50 --pr-latency 0.4
+    python -m bench.loadtest --updates 100 --rate 50 --webhook
+    python -m bench.loadtest --compare bench/results/a1b2c3d.json bench/results/e4f5a6b.json
+
+Each run writes a JSON report (default: bench/results/<commit>.json) with
+throughput, per-stage latency percentiles, peak RSS and SQLite write counts.
+
+--webhook POSTs the updates to the bot's webhook app (bot.webhook.build_app)
+instead of feeding the Dispatcher directly, after checking that requests
+with a missing or wrong secret token are refused; the run exits 1 if any
+of the webhook checks fails.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.fakes import FakePhotoRoom, FakeTelegram, serve  # noqa: E402
+
+TOKEN = "123456:bench"
+PROBE_CHAT = 999_999_999
+
+
+# ---------- REPORTING ----------
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    v = sorted(values)
+
+    def pct(p: float) -> float:
+        return v[min(len(v) - 1, int(len(v) * p))]
+
+    return {
+        "count": len(v),
+        "mean": sum(v) / len(v),
+        "p50": pct(0.50),
+        "p95": pct(0.95),
+        "p99": pct(0.99),
+        "max": v[-1],
+    }
+
+
+def git_commit() -> Dict[str, Any]:
+    try:
+        sha = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(["git", "status", "--porcelain", "--", "bot"], cwd=ROOT, capture_output=True, text=True).stdout
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": "unknown", "dirty": False}
+    return {"commit": sha, "dirty": dirty}
+
+
+class Stages:
+    """Collects durations per stage name."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {name: percentiles(v) for name, v in sorted(self.samples.items())}
+
+
+# ---------- SYNTHETIC INPUT ----------
+
+def make_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    # noise compresses like a real photo does (badly), a flat colour would not
+    from PIL import Image
+
+    noise = Image.effect_noise((width, height), 60)
+    im = Image.merge("RGB", (noise, noise.rotate(90, expand=False), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    out = io.BytesIO()
+    im.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def message_base(update_id: int, user_id: int) -> Dict[str, Any]:
+    return {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+    }
+
+
+def photo_update(update_id: int, user_id: int, file_id: str, size: int) -> Dict[str, Any]:
+    msg = message_base(update_id, user_id)
+    msg["photo"] = [{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 1280, "height": 960, "file_size": size}]
+    return {"update_id": update_id, "message": msg}
+
+
+def document_update(update_id: int, user_id: int, file_id: str, size: int) -> Dict[str, Any]:
+    msg = message_base(update_id, user_id)
+    msg["document"] = {
+        "file_id": file_id,
+        "file_unique_id": f"u{file_id}",
+        "file_name": f"{file_id}.jpg",
+        "mime_type": "image/jpeg",
+        "file_size": size,
+    }
+    return {"update_id": update_id, "message": msg}
+
+
+def build_workload(args) -> Tuple[Dict[str, bytes], List[Dict[str, Any]]]:
+    rnd = random.Random(args.seed)
+    photo = make_jpeg(*args.photo_size)
+    document = make_jpeg(*args.document_size, quality=95)
+
+    files: Dict[str, bytes] = {}
+    updates: List[Dict[str, Any]] = []
+    users = args.users or args.updates
+    for i in range(args.updates):
+        user_id = 10_000 + (i % users)
+        if files and rnd.random() < args.repeat:
+            file_id = rnd.choice(list(files))  # resend of a known file: cache path
+        else:
+            file_id = f"f{i}"
+            # unique bytes per file, so the content hash differs too
+            files[file_id] = (document if rnd.random() < args.documents else photo) + i.to_bytes(4, "big")
+        data = files[file_id]
+        if len(data) > len(photo) + 4:
+            updates.append(document_update(i + 1, user_id, file_id, len(data)))
+        else:
+            updates.append(photo_update(i + 1, user_id, file_id, len(data)))
+    return files, updates
+
+
+# ---------- PROBES ----------
+
+def install_probes(M, bot, stages: Stages) -> Dict[str, Any]:
+    """
+    Times the stages of a job from the outside: Bot API calls (session
+    middleware), file download, preprocessing, PhotoRoom (until the response
+    headers), queue wait; counts SQLite write statements.
+    """
+    from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+    class ApiTimer(BaseRequestMiddleware):
+        async def __call__(self, make_request, bot, method):
+            started = time.monotonic()
+            try:
+                return await make_request(bot, method)
+            finally:
+                stages.add(f"api.{method.__api_method__}", time.monotonic() - started)
+
+    bot.session.middleware(ApiTimer())
+
+    def timed_download(stream):
+        async def wrapper(*a, **kw):
+            started = time.monotonic()
+            async for chunk in stream(*a, **kw):
+                yield chunk
+            stages.add("download", time.monotonic() - started)
+
+        return wrapper
+
+    from bot import streams
+
+    # HTTP download, or the disk read of a local-mode Bot API server
+    bot.session.stream_content = timed_download(bot.session.stream_content)
+    streams.local_file_chunks = timed_download(streams.local_file_chunks)
+
+    prepare = M.preprocessor.prepare
+
+    async def timed_prepare(*a, **kw):
+        started = time.monotonic()
+        try:
+            return await prepare(*a, **kw)
+        finally:
+            stages.add("preprocess", time.monotonic() - started)
+
+    M.preprocessor.prepare = timed_prepare
+
+    remove_bg_stream = M.photoroom.remove_bg_stream
+
+    @asynccontextmanager
+    async def timed_remove_bg(*a, **kw):
+        started = time.monotonic()
+        async with remove_bg_stream(*a, **kw) as body:
+            stages.add("photoroom", time.monotonic() - started)
+            yield body
+
+    M.photoroom.remove_bg_stream = timed_remove_bg
+
+    submit = M.scheduler.submit
+
+    def timed_submit(job):
+        run = job.run
+
+        async def timed_run():
+            stages.add("queue_wait", (job.started_at or time.monotonic()) - job.enqueued_at)
+            started = time.monotonic()
+            try:
+                await run()
+            finally:
+                stages.add("job", time.monotonic() - started)
+
+        job.run = timed_run
+        return submit(job)
+
+    M.scheduler.submit = timed_submit
+
+    sqlite = {"writes": 0, "commits": 0}
+
+    def trace(sql: str):
+        head = sql.lstrip()[:7].upper()
+        if head.startswith(("INSERT", "UPDATE", "DELETE", "REPLACE")):
+            sqlite["writes"] += 1
+        elif head.startswith(("COMMIT", "END")):
+            sqlite["commits"] += 1
+
+    return {"sqlite": sqlite, "trace": trace}
+
+
+# ---------- WEBHOOK ----------
+
+# WEBHOOK_BASE_URL -> whether check_base_url() must accept it
+BASE_URL_CASES = {
+    "https://bot.example.com": True,
+    "https://bot.example.com:8443/prefix": True,
+    "http://bot.example.com": False,
+    "bot.example.com": False,
+    "": False,
+}
+
+
+async def start_webhook(M, bot, probe: Dict[str, Any]):
+    """
+    Serves the bot's webhook app on a local port and checks it the way a
+    stranger would hit it: `probe` is posted without and with a wrong secret
+    token, both must get 401 (and the probe chat must never get a reply).
+    Returns (runner, session, post, checks); post(raw) delivers an update
+    with the right token and returns the HTTP status.
+    """
+    from aiohttp import ClientSession
+
+    from bot.webhook import build_app, check_base_url, default_secret
+
+    secret = M.WEBHOOK_SECRET or default_secret(TOKEN)
+    runner, port = await serve(build_app(M.dp, bot, M.WEBHOOK_PATH, secret))
+    base = f"http://127.0.0.1:{port}"
+    session = ClientSession()
+
+    async def post(raw: Dict[str, Any], token: Optional[str] = secret) -> int:
+        headers = {} if token is None else {"X-Telegram-Bot-Api-Secret-Token": token}
+        async with session.post(base + M.WEBHOOK_PATH, json=raw, headers=headers) as resp:
+            await resp.read()
+            return resp.status
+
+    async with session.get(base + "/healthz") as resp:
+        healthz = resp.status
+
+    base_urls = {}
+    for url, valid in BASE_URL_CASES.items():
+        try:
+            check_base_url(url)
+            accepted = True
+        except ValueError:
+            accepted = False
+        base_urls[url or "<empty>"] = accepted == valid
+
+    checks = {
+        "healthz": healthz,
+        "no_secret": await post(probe, token=None),
+        "wrong_secret": await post(probe, token=secret[::-1]),
+        "base_url_checks": base_urls,
+    }
+    return runner, session, post, checks
+
+
+# ---------- RUN ----------
+
+async def run(args) -> Dict[str, Any]:
+    files, updates = build_workload(args)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    local_dir = os.path.join(workdir, "tg-files") if args.local_api else None
+    if local_dir:
+        os.makedirs(local_dir)
+
+    tg = FakeTelegram(files, member_status=args.member_status, latency=args.tg_latency, local_dir=local_dir)
+    pr = FakePhotoRoom(latency=args.pr_latency, jitter=args.pr_jitter, error_rate=args.pr_error_rate)
+    tg_runner, tg_port = await serve(tg.app())
+    pr_runner, pr_port = await serve(pr.app())
+
+    os.environ.update(
+        BOT_TOKEN=TOKEN,
+        PHOTOROOM_API_KEY="bench",
+        PHOTOROOM_API_URL=f"http://127.0.0.1:{pr_port}/v2/edit",
+        DB_PATH=os.path.join(workdir, "bot.db"),
+        RESULT_CACHE_DIR=os.path.join(workdir, "cache"),
+        EVENTS_ARCHIVE_DIR=os.path.join(workdir, "archive"),
+        METRICS_PORT="0",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{tg_port}",
+        TELEGRAM_API_LOCAL="1" if args.local_api else "0",
+    )
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    os.chdir(workdir)  # keeps load_dotenv() away from a developer's .env
+
+    # config is read at import time, so the bot is imported only now
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.types import Update
+
+    import bot.main as M
+
+    bot = Bot(TOKEN, session=AiohttpSession(api=M.api_server()))
+    stages = Stages()
+    probes = install_probes(M, bot, stages)
+
+    await M.startup(bot)
+    await M.db._conn.set_trace_callback(probes["trace"])
+    changes_before = M.db._conn.total_changes
+
+    webhook = None
+    if args.webhook:
+        # a chat no workload update uses: any reply to it means a refused update got handled
+        probe = {**updates[0], "update_id": 0, "message": {**updates[0]["message"], **message_base(0, PROBE_CHAT)}}
+        wh_runner, wh_session, post, webhook = await start_webhook(M, bot, probe)
+        webhook["rejected_statuses"] = defaultdict(int)
+
+    sent_at: Dict[int, List[float]] = defaultdict(list)
+
+    async def feed(raw: Dict[str, Any]):
+        chat_id = raw["message"]["chat"]["id"]
+        started = time.monotonic()
+        sent_at[chat_id].append(started)
+        if webhook is not None:
+            # acked before the handler runs (handle_in_background), so this is the HTTP round trip
+            status = await post(raw)
+            if status != 200:
+                webhook["rejected_statuses"][status] += 1
+        else:
+            update = Update.model_validate(raw, context={"bot": bot})
+            await M.dp.feed_update(bot, update)
+        stages.add("handler", time.monotonic() - started)
+
+    started = time.monotonic()
+    tasks = []
+    for i, raw in enumerate(updates):
+        if args.rate:
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(raw)))
+    await asyncio.gather(*tasks)
+
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        st = M.scheduler.stats()
+        if tg.replied >= len(updates) or (st["pending"] == 0 and st["running"] == 0 and tg.replied >= st["submitted"]):
+            break
+        await asyncio.sleep(0.02)
+    elapsed = time.monotonic() - started
+
+    # end-to-end: k-th update of a chat is matched with its k-th final reply
+    for chat_id, times in sent_at.items():
+        for sent, replied in zip(times, tg.replies.get(chat_id, [])):
+            stages.add("e2e", replied - sent)
+
+    await M.db.flush_events()
+    sched = M.scheduler.stats()
+    total_changes = M.db._conn.total_changes - changes_before
+    photoroom_stats = M.photoroom.stats()
+    cache_stats = M.cache.stats()
+
+    if webhook is not None:
+        await wh_session.close()
+        await wh_runner.cleanup()
+        webhook["rejected_statuses"] = dict(webhook["rejected_statuses"])
+        webhook["probe_replies"] = len(tg.replies.get(PROBE_CHAT, []))
+        webhook["ok"] = (
+            webhook["healthz"] == 200
+            and webhook["no_secret"] == 401
+            and webhook["wrong_secret"] == 401
+            and not webhook["rejected_statuses"]
+            and webhook["probe_replies"] == 0
+            and all(webhook["base_url_checks"].values())
+            and tg.replied >= len(updates)
+        )
+
+    await M.shutdown(bot)
+    await tg_runner.cleanup()
+    await pr_runner.cleanup()
+
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        **git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "updates": args.updates,
+            "users": args.users or args.updates,
+            "rate": args.rate,
+            "documents": args.documents,
+            "repeat": args.repeat,
+            "pr_latency": args.pr_latency,
+            "pr_jitter": args.pr_jitter,
+            "pr_error_rate": args.pr_error_rate,
+            "tg_latency": args.tg_latency,
+            "local_api": args.local_api,
+            "webhook": args.webhook,
+            "env": args.env,
+        },
+        "elapsed_s": elapsed,
+        "completed": tg.replied,
+        "results": tg.replied - tg.text_replies,
+        "text_replies": tg.text_replies,
+        "throughput_per_s": (tg.replied - tg.text_replies) / elapsed if elapsed else 0.0,
+        "stages": stages.report(),
+        "rss_peak_kb": self_ru.ru_maxrss,
+        "rss_children_peak_kb": child_ru.ru_maxrss,
+        "sqlite": {**probes["sqlite"], "total_changes": total_changes},
+        "telegram_calls": dict(sorted(tg.counts.items())),
+        "telegram_local_uploads": tg.local_uploads,
+        "photoroom": {
+            "requests": pr.requests,
+            "errors": pr.errors,
+            "bytes_in": pr.bytes_in,
+            "bytes_out": pr.bytes_out,
+            "fields": dict(sorted(pr.fields.items())),
+            **photoroom_stats,
+        },
+        "scheduler": sched,
+        "cache": cache_stats,
+        "webhook": webhook,
+    }
+
+
+# ---------- COMPARE ----------
+
+KEY_METRICS = [
+    ("throughput_per_s", "throughput/s", +1),
+    ("stages.e2e.p50", "e2e p50 s", -1),
+    ("stages.e2e.p95", "e2e p95 s", -1),
+    ("stages.e2e.p99", "e2e p99 s", -1),
+    ("stages.handler.p95", "handler p95 s", -1),
+    ("stages.queue_wait.p95", "queue wait p95 s", -1),
+    ("stages.photoroom.p95", "photoroom p95 s", -1),
+    ("photoroom.bytes_out", "photoroom bytes out", -1),
+    ("rss_peak_kb", "peak RSS KB", -1),
+    ("sqlite.writes", "sqlite writes", -1),
+    ("sqlite.commits", "sqlite commits", -1),
+]
+
+
+def _lookup(report: Dict[str, Any], path: str) -> Optional[float]:
+    node: Any = report
+    for part in path.split("."):
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node if isinstance(node, (int, float)) else None
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], fail_above: Optional[float]) -> int:
+    """Prints a side by side table; returns 1 when a metric regressed more than `fail_above` %."""
+    print(f"{'metric':<20}{old.get('commit', '?'):>14}{new.get('commit', '?'):>14}{'change':>10}")
+    regressed = []
+    for path, label, better in KEY_METRICS:
+        a, b = _lookup(old, path), _lookup(new, path)
+        if a is None or b is None:
+            continue
+        change = (b - a) / a * 100 if a else 0.0
+        print(f"{label:<20}{a:>14.4g}{b:>14.4g}{change:>+9.1f}%")
+        if fail_above is not None and change * -better > fail_above:
+            regressed.append(label)
+    if old.get("config") != new.get("config"):
+        print("note: the runs used different settings")
+    if regressed:
+        print("regressed:", ", ".join(regressed))
+        return 1
+    return 0
+
+
+# ---------- CLI ----------
+
+def parse_args(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--updates", type=int, default=200, help="number of image updates")
+    p.add_argument("--users", type=int, default=0, help="distinct users (0 = one per update)")
+    p.add_argument("--rate", type=float, default=0, help="updates per second (0 = all at once)")
+    p.add_argument("--documents", type=float, default=0.2, help="share of large files sent as documents")
+    p.add_argument("--repeat", type=float, default=0.0, help="share of updates resending an earlier file")
+    p.add_argument("--photo-size", type=int, nargs=2, default=(1280, 960), metavar=("W", "H"))
+    p.add_argument("--document-size", type=int, nargs=2, default=(4032, 3024), metavar=("W", "H"))
+    p.add_argument("--pr-latency", type=float, default=0.4, help="PhotoRoom mean latency, s")
+    p.add_argument("--pr-jitter", type=float, default=0.1, help="PhotoRoom latency +-, s")
+    p.add_argument("--pr-error-rate", type=float, default=0.0, help="share of PhotoRoom 503s")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="extra latency per Bot API call, s")
+    p.add_argument("--local-api", action="store_true", help="Bot API stand-in in local mode (files on disk)")
+    p.add_argument("--webhook", action="store_true", help="deliver updates over HTTP to the webhook app")
+    p.add_argument("--member-status", default="member", help="getChatMember answer")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="bot setting override")
+    p.add_argument("--timeout", type=float, default=300, help="max seconds to wait for replies")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="report path (default: bench/results/<commit>.json)")
+    p.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    p.add_argument("--fail-above", type=float, help="with --compare: exit 1 on a regression above this %%")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            return compare(json.load(f_old), json.load(f_new), args.fail_above)
+
+    out = os.path.abspath(args.out) if args.out else None
+    report = asyncio.run(run(args))
+    if out is None:
+        suffix = "-dirty" if report["dirty"] else ""
+        out = os.path.join(ROOT, "bench", "results", f"{report['commit']}{suffix}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    e2e = report["stages"].get("e2e", {})
+    print(
+        f"{report['results']}/{args.updates} results in {report['elapsed_s']:.1f}s "
+        f"({report['throughput_per_s']:.1f}/s), e2e p50={e2e.get('p50', 0):.3f}s "
+        f"p95={e2e.get('p95', 0):.3f}s p99={e2e.get('p99', 0):.3f}s, "
+        f"rss={report['rss_peak_kb'] // 1024}MB, sqlite writes={report['sqlite']['writes']}"
+    )
+    webhook = report["webhook"]
+    if webhook is not None:
+        print(
+            f"webhook: healthz={webhook['healthz']} no secret={webhook['no_secret']} "
+            f"wrong secret={webhook['wrong_secret']} refused updates={webhook['rejected_statuses'] or 0} "
+            f"probe replies={webhook['probe_replies']} base url checks="
+            f"{sum(webhook['base_url_checks'].values())}/{len(webhook['base_url_checks'])} "
+            f"-> {'ok' if webhook['ok'] else 'FAILED'}"
+        )
+    print("report:", out)
+    return 0 if webhook is None or webhook["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
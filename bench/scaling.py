@@ -0,0 +1,213 @@
+"""
+Worker scaling benchmark: the real bot runs as its own process tree
+(`python -m bot.main` with WORKERS=N) against the local Bot API and
+PhotoRoom stand-ins from bench.fakes, and takes the same burst of image
+updates through getUpdates for every N. No credentials, no network.
+
+    python -m bench.scaling --workers 1 2 4 --updates 400 --users 200
+    python -m bench.scaling --workers 1 4 --env JOB_CONCURRENCY=4 --cpu-work 1
+
+WORKERS=1 is the plain single-process bot (aiogram polling), so the first
+row is the baseline. Per-worker settings multiply with N (see .env.example);
+pin them with --env for a like-for-like comparison of the process split.
+The report (default: bench/results/scaling-<commit>.json) has throughput,
+end-to-end percentiles and CPU seconds of the bot processes per N.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.fakes import FakePhotoRoom, FakeTelegram, serve  # noqa: E402
+from bench.loadtest import TOKEN, build_workload, git_commit, percentiles  # noqa: E402
+
+
+def children_cpu() -> float:
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+async def run_one(args, workers: int) -> Dict[str, Any]:
+    files, updates = build_workload(args)
+    workdir = tempfile.mkdtemp(prefix=f"scaling-{workers}-")
+
+    tg = FakeTelegram(files, latency=args.tg_latency)
+    pr = FakePhotoRoom(latency=args.pr_latency, jitter=args.pr_jitter)
+    tg_runner, tg_port = await serve(tg.app())
+    pr_runner, pr_port = await serve(pr.app())
+
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "BOT_TOKEN": TOKEN,
+        "PHOTOROOM_API_KEY": "bench",
+        "PHOTOROOM_API_URL": f"http://127.0.0.1:{pr_port}/v2/edit",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "RESULT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "EVENTS_ARCHIVE_DIR": os.path.join(workdir, "archive"),
+        "METRICS_PORT": "0",
+        "DELIVERY_MODE": "polling",
+        "WORKERS": str(workers),
+    }
+    env.pop("WORKER_INDEX", None)
+    if args.cpu_work:
+        # make the bot preprocess every image, so each update costs real CPU
+        env.update(PREPROCESS_MIN_KB="0", PREPROCESS_MAX_EDGE="1024")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    cpu_before = children_cpu()
+    # cwd keeps load_dotenv() away from a developer's .env
+    proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "bot.main", cwd=workdir, env=env)
+    try:
+        deadline = time.monotonic() + 60
+        while tg.counts["getUpdates"] == 0:
+            if proc.returncode is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"bot with WORKERS={workers} did not start polling")
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(args.warmup)
+
+        sent_at: Dict[int, List[float]] = defaultdict(list)
+        started = time.monotonic()
+        for i, raw in enumerate(updates):
+            if args.rate:
+                delay = started + i / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent_at[raw["message"]["chat"]["id"]].append(time.monotonic())
+            tg.push_updates([raw])
+
+        deadline = time.monotonic() + args.timeout
+        while tg.replied < len(updates) and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        elapsed = time.monotonic() - started
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=90)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        await tg_runner.cleanup()
+        await pr_runner.cleanup()
+    cpu = children_cpu() - cpu_before
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    e2e = []
+    for chat_id, times in sent_at.items():
+        for sent, replied in zip(times, tg.replies.get(chat_id, [])):
+            e2e.append(replied - sent)
+
+    results = tg.replied - tg.text_replies
+    return {
+        "workers": workers,
+        "exit_code": proc.returncode,
+        "elapsed_s": elapsed,
+        "completed": tg.replied,
+        "results": results,
+        "text_replies": tg.text_replies,
+        "throughput_per_s": results / elapsed if elapsed else 0.0,
+        "e2e": percentiles(e2e),
+        "cpu_s": cpu,
+        "cpu_per_update_ms": cpu / len(updates) * 1000 if updates else 0.0,
+        "photoroom_requests": pr.requests,
+        "telegram_calls": dict(sorted(tg.counts.items())),
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    runs = []
+    for workers in args.workers:
+        r = await run_one(args, workers)
+        runs.append(r)
+        print(
+            f"workers={workers}: {r['results']}/{args.updates} results in {r['elapsed_s']:.1f}s "
+            f"({r['throughput_per_s']:.1f}/s), e2e p50={r['e2e'].get('p50', 0):.3f}s "
+            f"p95={r['e2e'].get('p95', 0):.3f}s, cpu={r['cpu_s']:.1f}s"
+        )
+    base = runs[0]["throughput_per_s"] if runs else 0.0
+    for r in runs:
+        r["speedup"] = r["throughput_per_s"] / base if base else 0.0
+
+    return {
+        **git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "cpus": os.cpu_count(),
+        "config": {
+            "updates": args.updates,
+            "users": args.users or args.updates,
+            "rate": args.rate,
+            "documents": args.documents,
+            "pr_latency": args.pr_latency,
+            "pr_jitter": args.pr_jitter,
+            "tg_latency": args.tg_latency,
+            "cpu_work": args.cpu_work,
+            "env": args.env,
+        },
+        "runs": runs,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to compare")
+    p.add_argument("--updates", type=int, default=300, help="number of image updates per run")
+    p.add_argument("--users", type=int, default=0, help="distinct users (0 = one per update)")
+    p.add_argument("--rate", type=float, default=0, help="updates per second (0 = all at once)")
+    p.add_argument("--documents", type=float, default=0.0, help="share of large files sent as documents")
+    p.add_argument("--photo-size", type=int, nargs=2, default=(1280, 960), metavar=("W", "H"))
+    p.add_argument("--document-size", type=int, nargs=2, default=(4032, 3024), metavar=("W", "H"))
+    p.add_argument("--pr-latency", type=float, default=0.2, help="PhotoRoom mean latency, s")
+    p.add_argument("--pr-jitter", type=float, default=0.05, help="PhotoRoom latency +-, s")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="extra latency per Bot API call, s")
+    p.add_argument("--cpu-work", type=int, default=0, help="1 = preprocess every image in the bot")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="bot setting override")
+    p.add_argument("--warmup", type=float, default=1.0, help="seconds between first poll and the burst")
+    p.add_argument("--timeout", type=float, default=300, help="max seconds to wait for replies per run")
+    p.add_argument("--keep", action="store_true", help="keep the per-run working directories")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="report path (default: bench/results/scaling-<commit>.json)")
+    args = p.parse_args(argv)
+    args.repeat = 0.0  # every update is new work: the caches are per worker
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    out = os.path.abspath(args.out) if args.out else None
+    report = asyncio.run(run(args))
+    if out is None:
+        suffix = "-dirty" if report["dirty"] else ""
+        out = os.path.join(ROOT, "bench", "results", f"scaling-{report['commit']}{suffix}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'workers':>8}{'results/s':>12}{'speedup':>9}{'e2e p95 s':>11}{'cpu ms/upd':>12}")
+    for r in report["runs"]:
+        print(
+            f"{r['workers']:>8}{r['throughput_per_s']:>12.1f}{r['speedup']:>9.2f}"
+            f"{r['e2e'].get('p95', 0):>11.3f}{r['cpu_per_update_ms']:>12.1f}"
+        )
+    print("report:", out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
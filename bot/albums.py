@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+log = logging.getLogger(__name__)
+
+# Telegram caps albums at 10 items
+MAX_ALBUM_ITEMS = 10
+
+
+class _Batch:
+    __slots__ = ("items", "on_complete", "timer")
+
+    def __init__(self, on_complete: Callable[[List[Any]], Awaitable[None]]):
+        self.items: List[Any] = []
+        self.on_complete = on_complete
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class AlbumCollector:
+    """
+    Groups the separate messages of one album (same media_group_id) into a
+    single batch. Telegram delivers them back to back, so a batch is closed
+    `window` seconds after its last item arrived, or as soon as it is full;
+    `on_complete` (given with the first item) then runs in its own task.
+    """
+
+    def __init__(self, window: float = 0.8, max_items: int = MAX_ALBUM_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._tasks: set = set()
+
+        self.albums = 0
+        self.items = 0
+
+    def add(self, key: Hashable, item: Any, on_complete: Callable[[List[Any]], Awaitable[None]]):
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(on_complete)
+        batch.items.append(item)
+        self.items += 1
+
+        if batch.timer is not None:
+            batch.timer.cancel()
+        if len(batch.items) >= self.max_items:
+            self._complete(key)
+        else:
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._complete, key)
+
+    def _complete(self, key: Hashable):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self.albums += 1
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _run(batch: _Batch):
+        try:
+            await batch.on_complete(batch.items)
+        except Exception:
+            log.exception("album batch failed")
+
+    async def close(self):
+        """
+        Shutdown: drops batches still being collected (nothing is charged
+        before on_complete) and waits for callbacks already running.
+        """
+        for batch in self._batches.values():
+            if batch.timer is not None:
+                batch.timer.cancel()
+        self._batches.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"open": len(self._batches), "albums": self.albums, "items": self.items}
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from bot.db import DB
+from bot.metrics import BROADCAST_MESSAGES
+
+log = logging.getLogger(__name__)
+
+
+class BroadcastBusy(Exception):
+    pass
+
+
+class Broadcaster:
+    """
+    Sends one admin message to every reachable user, at most `rate`
+    messages/s with up to `concurrency` requests in flight.
+
+    Recipients are read from `users` one keyset page at a time. After each
+    page the cursor (last user_id done) and the counters are saved, so a
+    restart resumes where it stopped; a graceful stop finishes the messages
+    in flight first, a crash repeats at most one page. FloodWait
+    (TelegramRetryAfter) pauses all sending for the time Telegram asks and
+    retries that user; users who blocked the bot are marked in `users` and
+    skipped from then on.
+    An error that ends the loop marks the broadcast failed, with the
+    counters of the last page saved.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        rate: float = 25.0,
+        concurrency: int = 8,
+        page_size: int = 200,
+        max_retries: int = 3,
+        stop_timeout: float = 10.0,
+    ):
+        self.db = db
+        self.rate = rate
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.stop_timeout = stop_timeout
+
+        self._bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._next_slot = 0.0  # monotonic time of the next allowed send
+        self._paused_until = 0.0  # FloodWait
+        self._recent: deque = deque()  # send times over the last `window` s
+        self._started = 0.0
+
+        self.current: Optional[Dict[str, Any]] = None  # broadcasts row being sent
+        self.flood_waits = 0
+        self.window = 10.0
+
+    # ---------- LIFECYCLE ----------
+
+    async def start(self, bot: Bot):
+        """Resumes a broadcast left running by the previous process."""
+        self._bot = bot
+        row = await self.db.running_broadcast()
+        if row is not None:
+            log.info("broadcast %s: resuming after user %s", row["id"], row["cursor"])
+            self._spawn(row)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=self.stop_timeout)
+        except asyncio.TimeoutError:
+            # the last saved page is sent again on the next start
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._stopping = False
+
+    # ---------- CONTROL ----------
+
+    async def launch(
+        self,
+        created_by: int,
+        text: Optional[str] = None,
+        from_chat_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+    ) -> int:
+        if self.running:
+            raise BroadcastBusy(self.current["id"])
+        broadcast_id = await self.db.create_broadcast(created_by, text, from_chat_id, message_id)
+        self._spawn(await self.db.get_broadcast(broadcast_id))
+        return broadcast_id
+
+    async def cancel(self) -> Optional[int]:
+        """Stops the running broadcast for good; returns its id."""
+        if not self.running:
+            return None
+        broadcast_id = self.current["id"]
+        await self.stop()
+        row = self.current
+        await self.db.save_broadcast(
+            broadcast_id, row["cursor"], row["sent"], row["failed"], row["blocked"], state="cancelled"
+        )
+        row["state"] = "cancelled"
+        return broadcast_id
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _spawn(self, row: Dict[str, Any]):
+        self.current = row
+        self._recent.clear()
+        self._started = time.monotonic()
+        self._task = asyncio.create_task(self._run(row))
+
+    # ---------- SENDING ----------
+
+    async def _run(self, row: Dict[str, Any]):
+        limit = asyncio.Semaphore(self.concurrency)
+        try:
+            while not self._stopping:
+                page = await self.db.broadcast_recipients(row["cursor"], self.page_size)
+                if not page:
+                    row["state"] = "done"
+                    break
+
+                blocked: List[int] = []
+                inflight = set()
+                done_upto = row["cursor"]
+                for user_id in page:
+                    if self._stopping:
+                        break
+                    await limit.acquire()
+                    await self._pace()
+                    task = asyncio.create_task(self._deliver(row, user_id, blocked))
+                    task.add_done_callback(lambda _: limit.release())
+                    inflight.add(task)
+                    done_upto = user_id
+                if inflight:
+                    await asyncio.gather(*inflight)
+
+                await self.db.mark_blocked(blocked)
+                row["cursor"] = done_upto
+                await self.db.save_broadcast(row["id"], row["cursor"], row["sent"], row["failed"], row["blocked"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("broadcast %s failed after user %s", row["id"], row["cursor"])
+            row["state"] = "failed"
+
+        if row["state"] == "running":
+            return  # stopped: resumes on the next start
+        # a row left 'running' would show in /broadcast while nothing sends it
+        try:
+            await self.db.save_broadcast(
+                row["id"], row["cursor"], row["sent"], row["failed"], row["blocked"], state=row["state"]
+            )
+        except Exception:
+            log.exception("broadcast %s: could not save state %s", row["id"], row["state"])
+            return
+        if row["state"] == "done":
+            log.info(
+                "broadcast %s done: %s sent, %s failed, %s blocked", row["id"], row["sent"], row["failed"], row["blocked"]
+            )
+
+    async def _pace(self):
+        # one slot every 1/rate s, after any FloodWait pause
+        now = time.monotonic()
+        slot = max(self._next_slot, self._paused_until, now)
+        self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _deliver(self, row: Dict[str, Any], user_id: int, blocked: List[int]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._send(row, user_id)
+                row["sent"] += 1
+                self._recent.append(time.monotonic())
+                BROADCAST_MESSAGES.labels(outcome="sent").inc()
+                return
+            except TelegramRetryAfter as e:
+                # flood control is per bot: hold back every sender, not just this one
+                self.flood_waits += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                BROADCAST_MESSAGES.labels(outcome="retry_after").inc()
+                if attempt < self.max_retries:
+                    await self._pace()
+            except TelegramForbiddenError:
+                # blocked the bot or deactivated account
+                row["blocked"] += 1
+                blocked.append(user_id)
+                BROADCAST_MESSAGES.labels(outcome="blocked").inc()
+                return
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    row["blocked"] += 1
+                    blocked.append(user_id)
+                    BROADCAST_MESSAGES.labels(outcome="blocked").inc()
+                    return
+                break
+            except Exception:
+                log.debug("broadcast %s: send to %s failed", row["id"], user_id, exc_info=True)
+                break
+        row["failed"] += 1
+        BROADCAST_MESSAGES.labels(outcome="failed").inc()
+
+    async def _send(self, row: Dict[str, Any], user_id: int):
+        if row["message_id"] is not None:
+            await self._bot.copy_message(user_id, from_chat_id=row["from_chat_id"], message_id=row["message_id"])
+        else:
+            await self._bot.send_message(user_id, row["text"])
+
+    # ---------- STATS ----------
+
+    def throughput(self) -> float:
+        """Messages/s over the last `window` seconds."""
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - self.window:
+            self._recent.popleft()
+        span = min(self.window, now - self._started)
+        return len(self._recent) / span if span > 0 else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        row = self.current or {}
+        done = row.get("sent", 0) + row.get("failed", 0) + row.get("blocked", 0)
+        rate = self.throughput() if self.running else 0.0
+        left = max(0, row.get("total", 0) - done)
+        return {
+            "id": row.get("id"),
+            "state": "running" if self.running else row.get("state", "—"),
+            "total": row.get("total", 0),
+            "sent": row.get("sent", 0),
+            "failed": row.get("failed", 0),
+            "blocked": row.get("blocked", 0),
+            "rate": rate,
+            "eta_s": left / rate if rate > 0 else None,
+            "flood_waits": self.flood_waits,
+            "paused_s": max(0.0, self._paused_until - time.monotonic()),
+        }
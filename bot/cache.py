@@ -0,0 +1,318 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+import aiofiles
+import aiofiles.os
+
+log = logging.getLogger(__name__)
+
+# result formats PhotoRoom is asked for (see bot.delivery.EXTENSIONS)
+EXTENSIONS = ("png", "jpg", "webp")
+
+
+@dataclass
+class CacheEntry:
+    size: int = 0  # bytes on disk, 0 if the file was evicted
+    file_id: Optional[str] = None  # Telegram file_id of a result we already sent
+    ext: str = "png"  # of the file on disk
+
+
+@dataclass
+class CachedResult:
+    key: str
+    file_id: Optional[str]
+    path: Optional[str]  # file on disk when there is no file_id to resend
+
+
+class CacheWriter:
+    """Streams a result to a temp file; commit(key, ext) publishes it into the cache."""
+
+    def __init__(self, cache: "ResultCache"):
+        self._cache = cache
+        self._tmp = os.path.join(cache.path, f"{uuid.uuid4().hex}.tmp")
+        self._f = None
+        self.size = 0
+
+    async def write(self, chunk: bytes):
+        if self._f is None:
+            self._f = await aiofiles.open(self._tmp, "wb")
+        await self._f.write(chunk)
+        self.size += len(chunk)
+
+    async def commit(self, key: str, ext: str = "png"):
+        if self._f is None:
+            return
+        await self._f.close()
+        self._f = None
+        await aiofiles.os.replace(self._tmp, self._cache._file(key, ext))
+        await self._cache._added(key, self.size, ext)
+
+    async def abort(self):
+        if self._f is not None:
+            await self._f.close()
+            self._f = None
+            try:
+                await aiofiles.os.remove(self._tmp)
+            except OSError:
+                pass
+
+
+class ResultCache:
+    """
+    Content-addressed cache of background-removal results.
+
+    Results are keyed by sha256 of the *input* image (hashed by the caller
+    as it downloads) and stored as <key>.<ext> under `path` (PNG, or the
+    JPEG/WebP of a preview), evicted LRU once
+    the directory exceeds `max_bytes`. Telegram `file_unique_id` is an alias
+    to the content key, so a resend of the same photo is found without
+    downloading it; the same bytes under a new file_unique_id are found by
+    the content key after the download. The `file_id` of a result
+    we already sent is kept even after the PNG is evicted: resending by
+    file_id costs no upload at all.
+
+    The file_id and alias maps live in memory and are written to
+    index.json every `save_interval` s when they changed, and on close(),
+    so a crash loses at most that much of them.
+    """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(
+        self,
+        path: str = "cache",
+        max_bytes: int = 512 * 1024 * 1024,
+        max_entries: int = 50_000,
+        save_interval: float = 60.0,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()  # LRU order, oldest first
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()  # file_unique_id -> key
+        self._bytes = 0
+        self._dirty = False  # index changed since the last save
+        self._task: Optional[asyncio.Task] = None
+
+        self.hits_unique_id = 0
+        self.hits_content = 0
+        self.hits_file_id = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- LIFECYCLE ----------
+
+    async def start(self):
+        await asyncio.to_thread(self._load)
+        if self._task is None and self.save_interval > 0:
+            self._task = asyncio.create_task(self._save_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._save_index()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            if not self._dirty:
+                continue
+            try:
+                await self._save_index()
+            except Exception:
+                log.exception("cache: saving the index failed")
+
+    async def _save_index(self):
+        # snapshot here, in the loop thread: the maps change while the file is written
+        self._dirty = False
+        index = {
+            "file_ids": {k: e.file_id for k, e in self._entries.items() if e.file_id},
+            "aliases": dict(self._aliases),
+        }
+        try:
+            await asyncio.to_thread(self._write_index, index)
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                # unfinished write from a previous run
+                os.remove(os.path.join(self.path, name))
+                continue
+            key, _, ext = name.rpartition(".")
+            if ext not in EXTENSIONS or not key:
+                continue
+            st = os.stat(os.path.join(self.path, name))
+            files.append((st.st_mtime, key, ext, st.st_size))
+        files.sort()
+
+        for _, key, ext, size in files:
+            self._entries[key] = CacheEntry(size=size, ext=ext)
+            self._bytes += size
+
+        try:
+            with open(os.path.join(self.path, self.INDEX_NAME), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        for key, file_id in (index.get("file_ids") or {}).items():
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = CacheEntry()
+                self._entries[key] = entry
+                self._entries.move_to_end(key, last=False)
+            entry.file_id = file_id
+        for uid, key in (index.get("aliases") or {}).items():
+            self._aliases[uid] = key
+
+    def _write_index(self, index: Dict[str, Any]):
+        tmp = os.path.join(self.path, self.INDEX_NAME + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.path, self.INDEX_NAME))
+
+    # ---------- LOOKUP ----------
+
+    async def lookup(self, file_unique_id: Optional[str]) -> Optional[CachedResult]:
+        """
+        The result for a Telegram file_unique_id alias, before anything is
+        downloaded. None is not a miss yet: lookup_content() comes next.
+        """
+        key = self._aliases.get(file_unique_id) if file_unique_id else None
+        if key is None:
+            return None
+        self._aliases.move_to_end(file_unique_id)
+        found = await self._get(key)
+        if found is not None:
+            self.hits_unique_id += 1
+        return found
+
+    async def lookup_content(self, key: str, file_unique_id: Optional[str] = None) -> Optional[CachedResult]:
+        """
+        The result for the content key of a downloaded input; on a hit the
+        new file_unique_id becomes an alias of it. Every None is a miss.
+        """
+        found = await self._get(key)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits_content += 1
+        self.alias(file_unique_id, key)
+        return found
+
+    def alias(self, file_unique_id: Optional[str], key: str):
+        if not file_unique_id:
+            return
+        self._aliases[file_unique_id] = key
+        self._aliases.move_to_end(file_unique_id)
+        self._dirty = True
+        while len(self._aliases) > self.max_entries:
+            self._aliases.popitem(last=False)
+
+    async def _get(self, key: str) -> Optional[CachedResult]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        path = None
+        if entry.file_id is None:
+            path = self._file(key, entry.ext)
+            if not await aiofiles.os.path.exists(path):
+                self._drop_file(key, entry)
+                return None
+        else:
+            self.hits_file_id += 1
+
+        self._entries.move_to_end(key)
+        return CachedResult(key=key, file_id=entry.file_id, path=path)
+
+    # ---------- STORE ----------
+
+    def writer(self) -> CacheWriter:
+        return CacheWriter(self)
+
+    async def _added(self, key: str, size: int, ext: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            self._entries[key] = entry
+        if entry.size and entry.ext != ext:
+            await self._remove_file(key, entry.ext)
+        self._bytes += size - entry.size
+        entry.size = size
+        entry.ext = ext
+        self._entries.move_to_end(key)
+
+        await self._evict()
+
+    def remember_file_id(self, key: str, file_id: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            self._entries[key] = entry
+        entry.file_id = file_id
+        self._dirty = True
+
+    async def _evict(self):
+        for key in list(self._entries.keys()):
+            if self._bytes <= self.max_bytes and len(self._entries) <= self.max_entries:
+                break
+            entry = self._entries[key]
+            if entry.size:
+                await self._remove_file(key, entry.ext)
+                self._bytes -= entry.size
+                entry.size = 0
+                self.evictions += 1
+            # keep the (tiny) file_id record unless we are over the entry limit
+            if entry.file_id is None or len(self._entries) > self.max_entries:
+                del self._entries[key]
+            self._dirty = True
+
+    def _drop_file(self, key: str, entry: CacheEntry):
+        self._bytes -= entry.size
+        entry.size = 0
+        if entry.file_id is None:
+            self._entries.pop(key, None)
+
+    async def _remove_file(self, key: str, ext: str):
+        try:
+            await aiofiles.os.remove(self._file(key, ext))
+        except OSError:
+            pass
+
+    def _file(self, key: str, ext: str) -> str:
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    # ---------- STATS ----------
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits_unique_id + self.hits_content,
+            "hits_unique_id": self.hits_unique_id,
+            "hits_content": self.hits_content,
+            "hits_file_id": self.hits_file_id,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -9,5 +9,118 @@ PHOTOROOM_API_KEY = os.getenv("PHOTOROOM_API_KEY", "")
 # Админ (только он видит /stats и /admin)
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0") or "0")
 
-# (опционально) лимит веса файла, если хочешь использовать позже
+# Лимит веса входного файла (проверяется до скачивания)
 MAX_MB = int(os.getenv("MAX_MB", "12") or "12")
+
+# PhotoRoom HTTP-клиент (пул соединений и таймауты)
+PHOTOROOM_API_URL = os.getenv("PHOTOROOM_API_URL", "https://image-api.photoroom.com/v2/edit")
+PHOTOROOM_POOL_LIMIT = int(os.getenv("PHOTOROOM_POOL_LIMIT", "16") or "16")
+PHOTOROOM_KEEPALIVE_S = float(os.getenv("PHOTOROOM_KEEPALIVE_S", "60") or "60")
+PHOTOROOM_DNS_TTL_S = int(os.getenv("PHOTOROOM_DNS_TTL_S", "600") or "600")
+PHOTOROOM_CONNECT_TIMEOUT_S = float(os.getenv("PHOTOROOM_CONNECT_TIMEOUT_S", "5") or "5")
+PHOTOROOM_READ_TIMEOUT_S = float(os.getenv("PHOTOROOM_READ_TIMEOUT_S", "60") or "60")
+PHOTOROOM_TOTAL_TIMEOUT_S = float(os.getenv("PHOTOROOM_TOTAL_TIMEOUT_S", "90") or "90")
+
+# Кэш результатов (файлы на диске, LRU по размеру; индекс file_id сохраняется раз в N секунд)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "512") or "512")
+RESULT_CACHE_INDEX_SAVE_S = float(os.getenv("RESULT_CACHE_INDEX_SAVE_S", "60") or "60")
+
+# Очередь обработки фото
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4") or "4")
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "200") or "200")
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "3") or "3")
+
+# База данных и буфер событий (аналитика пишется пачками)
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # OFF | NORMAL | FULL
+DB_READERS = int(os.getenv("DB_READERS", "2") or "2")  # read-only соединения для отчётов
+DB_BUSY_TIMEOUT_S = float(os.getenv("DB_BUSY_TIMEOUT_S", "5") or "5")  # ждать блокировку записи (несколько воркеров)
+EVENT_FLUSH_SIZE = int(os.getenv("EVENT_FLUSH_SIZE", "100") or "100")
+EVENT_FLUSH_INTERVAL_S = float(os.getenv("EVENT_FLUSH_INTERVAL_S", "2") or "2")
+EVENT_BUFFER_MAX = int(os.getenv("EVENT_BUFFER_MAX", "10000") or "10000")
+EVENT_OVERFLOW = os.getenv("EVENT_OVERFLOW", "drop")  # drop | block
+
+# Кэш проверки подписки на канал
+SUB_CACHE_POSITIVE_TTL_S = float(os.getenv("SUB_CACHE_POSITIVE_TTL_S", "600") or "600")
+SUB_CACHE_NEGATIVE_TTL_S = float(os.getenv("SUB_CACHE_NEGATIVE_TTL_S", "30") or "30")
+SUB_RETRY_DELAY_S = float(os.getenv("SUB_RETRY_DELAY_S", "0.5") or "0.5")
+
+# Предобработка больших файлов перед PhotoRoom (уменьшение и пережатие)
+PREPROCESS_MIN_KB = int(os.getenv("PREPROCESS_MIN_KB", "1024") or "1024")
+PREPROCESS_MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", "2048") or "2048")
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", "90") or "90")
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2") or "2")
+
+# Хранение событий: старше N дней уходят в архив (gzip NDJSON) и удаляются из БД
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "90") or "90")
+EVENTS_ARCHIVE_DIR = os.getenv("EVENTS_ARCHIVE_DIR", "archive")
+MAINTENANCE_INTERVAL_H = float(os.getenv("MAINTENANCE_INTERVAL_H", "6") or "6")
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "2000") or "2000")
+# 1 = разрешить однократный полный VACUUM (переход на incremental auto-vacuum); блокирует запись
+MAINTENANCE_FULL_VACUUM = int(os.getenv("MAINTENANCE_FULL_VACUUM", "0") or "0")
+
+# Получение апдейтов: polling (по умолчанию) или webhook
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # пусто -> выводится из BOT_TOKEN
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080") or "8080")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40") or "40")
+
+# PhotoRoom: повторы и предохранитель (circuit breaker)
+PHOTOROOM_MAX_ATTEMPTS = int(os.getenv("PHOTOROOM_MAX_ATTEMPTS", "4") or "4")
+PHOTOROOM_BACKOFF_CAP_S = float(os.getenv("PHOTOROOM_BACKOFF_CAP_S", "20") or "20")
+PHOTOROOM_BREAKER_THRESHOLD = int(os.getenv("PHOTOROOM_BREAKER_THRESHOLD", "5") or "5")
+PHOTOROOM_BREAKER_RESET_S = float(os.getenv("PHOTOROOM_BREAKER_RESET_S", "30") or "30")
+
+# Метрики Prometheus (/metrics только на локальном интерфейсе; порт 0 -> выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108") or "9108")
+
+# Альбомы: окно сбора сообщений одной media group и параллельность внутри альбома
+ALBUM_WINDOW_S = float(os.getenv("ALBUM_WINDOW_S", "0.8") or "0.8")
+ALBUM_CONCURRENCY = int(os.getenv("ALBUM_CONCURRENCY", "3") or "3")
+
+# Антифлуд: корзины токенов на пользователя и общая, сброс второстепенного трафика под нагрузкой
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "0.5") or "0.5")
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "12") or "12")
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "30") or "30")
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "100") or "100")
+THROTTLE_SHED_LOAD = float(os.getenv("THROTTLE_SHED_LOAD", "0.8") or "0.8")  # доля заполнения очереди
+
+# Надёжная очередь задач (таблица jobs): аренда, время на дообработку при остановке, число перезапусков задачи
+JOB_LEASE_S = float(os.getenv("JOB_LEASE_S", "60") or "60")
+JOB_DRAIN_TIMEOUT_S = float(os.getenv("JOB_DRAIN_TIMEOUT_S", "25") or "25")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3") or "3")
+
+# Свой Bot API сервер (telegram-bot-api --local): файлы читаются прямо с диска, лимиты больше
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # пусто -> api.telegram.org
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "0") == "1"
+TELEGRAM_SERVER_FILES_DIR = os.getenv("TELEGRAM_SERVER_FILES_DIR", "")  # каталог файлов глазами сервера
+TELEGRAM_LOCAL_FILES_DIR = os.getenv("TELEGRAM_LOCAL_FILES_DIR", "")  # тот же каталог глазами бота
+MAX_MB_LOCAL = int(os.getenv("MAX_MB_LOCAL", "50") or "50")
+
+# Ответ с результатом: auto (фото -> сжатое превью, файл -> PNG с прозрачностью), photo или document
+RESULT_DELIVERY = os.getenv("RESULT_DELIVERY", "auto")
+RESULT_PREVIEW_FORMAT = os.getenv("RESULT_PREVIEW_FORMAT", "jpeg")  # jpeg | webp | png
+RESULT_PREVIEW_BACKGROUND = os.getenv("RESULT_PREVIEW_BACKGROUND", "FFFFFF")  # пусто -> прозрачный
+RESULT_OUTPUT_SIZE = os.getenv("RESULT_OUTPUT_SIZE", "")  # пусто -> как у PhotoRoom; originalImage | croppedSubject | 1080x1080
+RESULT_PADDING = os.getenv("RESULT_PADDING", "")  # отступ вокруг объекта: 0.1, 10%, 30px
+
+# Рассылка: сообщений в секунду (у Telegram ~30/с на бота), параллельных запросов, пользователей на страницу
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25") or "25")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8") or "8")
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200") or "200")
+
+# Выгрузка таблиц админу (/export): строк за одно чтение, размер части (лимит Telegram 50 МБ), каталог временных файлов
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000") or "1000")
+EXPORT_PART_MB = int(os.getenv("EXPORT_PART_MB", "45") or "45")
+EXPORT_TMP_DIR = os.getenv("EXPORT_TMP_DIR", "")  # пусто -> системный temp
+
+# Несколько процессов: супервизор раздаёт апдейты воркерам по user_id; 1 -> один процесс, как раньше
+WORKERS = int(os.getenv("WORKERS", "1") or "1")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1") or "-1")  # выставляет супервизор, вручную не задавать
+WORKER_STOP_TIMEOUT_S = float(os.getenv("WORKER_STOP_TIMEOUT_S", "40") or "40")  # больше JOB_DRAIN_TIMEOUT_S
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "1000") or "1000")  # апдейтов в очереди одного воркера
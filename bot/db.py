@@ -1,6 +1,19 @@
+import asyncio
+import json
+import logging
+import os
+import time
 import aiosqlite
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any, List
+from typing import AsyncIterator, Optional, Dict, Any, List, Tuple
+from urllib.request import pathname2url
+
+from bot.metrics import DB_SECONDS, timed
+
+log = logging.getLogger(__name__)
 
 
 def _utc_now() -> datetime:
@@ -17,21 +30,244 @@ def _day_key(dt: Optional[datetime] = None) -> str:
     return dt.strftime("%Y-%m-%d")
 
 
+# Hot-path statements. sqlite3 keeps prepared statements per connection,
+# keyed by SQL text (see `cached_statements`), so these are compiled once.
+
+SQL_TOUCH_USER = """
+    INSERT INTO users (user_id, first_seen, last_seen)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen, blocked_at=NULL
+"""
+
+SQL_USAGE_ADD = """
+    INSERT INTO usage_monthly (user_id, month, used, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, month)
+    DO UPDATE SET used = used + ?, updated_at = excluded.updated_at
+"""
+
+SQL_USAGE_REFUND = """
+    UPDATE usage_monthly
+    SET used = MAX(used - ?, 0), updated_at = ?
+    WHERE user_id=? AND month=?
+"""
+
+SQL_LOAD_USED = "SELECT used FROM usage_monthly WHERE user_id=? AND month=?"
+
+SQL_INSERT_JOB = """
+    INSERT INTO jobs
+    (user_id, chat_id, kind, payload, month, charged, state, lease_owner, lease_until, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, 'leased', ?, ?, ?)
+"""
+
+SQL_DELETE_JOB = "DELETE FROM jobs WHERE id=?"
+
+SQL_INSERT_EVENT = "INSERT INTO events (ts, day, user_id, event, meta) VALUES (?, ?, ?, ?, ?)"
+
+SQL_EVENTS_DAILY_ADD = """
+    INSERT INTO events_daily (day, event, count) VALUES (?, ?, ?)
+    ON CONFLICT(day, event) DO UPDATE SET count = count + excluded.count
+"""
+
+# event -> user_funnel column: when the user first got to that step
+FUNNEL_STEPS = {
+    "start": "first_start",
+    "image_received": "first_image",
+    "photo_received": "first_image",  # older versions
+    "remove_bg_success": "first_success",
+    "sub_required": "hit_sub_wall",
+    "sub_ok": "sub_ok",
+    "paid_required": "hit_paywall",
+}
+FUNNEL_COLUMNS = ("first_start", "first_image", "first_success", "hit_sub_wall", "sub_ok", "hit_paywall")
+
+# keeps the earliest timestamp per step whatever order batches arrive in
+SQL_FUNNEL_UPSERT = f"""
+    INSERT INTO user_funnel (user_id, cohort_day, {", ".join(FUNNEL_COLUMNS)})
+    VALUES (?, ?, {", ".join("?" for _ in FUNNEL_COLUMNS)})
+    ON CONFLICT(user_id) DO UPDATE SET
+        cohort_day = MIN(cohort_day, excluded.cohort_day),
+        {", ".join(f"{c} = MIN(COALESCE({c}, excluded.{c}), COALESCE(excluded.{c}, {c}))" for c in FUNNEL_COLUMNS)}
+"""
+
+
+# table -> (query, (day_from, day_to) -> params), see DB.export_rows()
+EXPORT_QUERIES = {
+    "events": (
+        "SELECT id, ts, day, user_id, event, meta FROM events WHERE day >= ? AND day <= ? ORDER BY id",
+        lambda day_from, day_to: (day_from, day_to),
+    ),
+    "usage_monthly": (
+        "SELECT user_id, month, used, updated_at FROM usage_monthly"
+        " WHERE month >= ? AND month <= ? ORDER BY month, user_id",
+        lambda day_from, day_to: (day_from[:7], day_to[:7]),
+    ),
+    "users": (
+        # seen at some point of the range
+        "SELECT user_id, first_seen, last_seen, blocked_at FROM users"
+        " WHERE substr(first_seen, 1, 10) <= ? AND substr(last_seen, 1, 10) >= ? ORDER BY user_id",
+        lambda day_from, day_to: (day_to, day_from),
+    ),
+}
+
+
+def _funnel_rows(batch: List[Tuple]) -> List[Tuple]:
+    """SQL_FUNNEL_UPSERT parameters for the funnel events of an event batch."""
+    users: Dict[int, Dict[str, str]] = {}
+    for ts, day, user_id, event, _ in batch:
+        column = FUNNEL_STEPS.get(event)
+        if column is None or user_id is None:
+            continue
+        steps = users.setdefault(user_id, {"cohort_day": day})
+        steps["cohort_day"] = min(steps["cohort_day"], day)
+        if column not in steps or ts < steps[column]:
+            steps[column] = ts
+    return [
+        (user_id, steps["cohort_day"], *(steps.get(c) for c in FUNNEL_COLUMNS)) for user_id, steps in users.items()
+    ]
+
+
+@dataclass
+class Reservation:
+    user_id: int
+    month: str
+    used_before: int  # usage this month before the reservation
+    granted: int  # units charged (0 = limit reached)
+    job_id: Optional[int] = None  # jobs row written with the charge
+
+
+@dataclass
+class NewJob:
+    """A job to store together with the charge that pays for it (see reserve_usage)."""
+    chat_id: int
+    kind: str  # "image" | "album"
+    payload: Dict[str, Any]
+    owner: str  # lease holder: the process that will run it
+    lease: float  # seconds
+
+
+@dataclass
+class StoredJob:
+    id: int
+    user_id: int
+    chat_id: int
+    kind: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    month: str = ""
+    charged: int = 0
+    attempts: int = 0  # resumed runs the process died in (the first run is not counted)
+
+    @property
+    def reservation(self) -> Reservation:
+        return Reservation(
+            user_id=self.user_id, month=self.month, used_before=0, granted=self.charged, job_id=self.id
+        )
+
+
 class DB:
-    def __init__(self, path: str = "bot.db"):
+    def __init__(
+        self,
+        path: str = "bot.db",
+        event_flush_size: int = 100,
+        event_flush_interval: float = 2.0,
+        event_buffer_max: int = 10_000,
+        event_overflow: str = "drop",
+        synchronous: str = "NORMAL",
+        readers: int = 2,
+        cached_statements: int = 256,
+        busy_timeout: float = 5.0,
+    ):
         self.path = path
+        # how long a statement waits for another process's write lock
+        # (several workers on one file, see bot.supervisor)
+        self.busy_timeout = busy_timeout
+        # the writer: every INSERT/UPDATE/DELETE and schema change goes here
         self._conn: Optional[aiosqlite.Connection] = None
+        # read-only WAL connections for lookups and reporting; they never
+        # wait behind the writer's lock and see only committed data
+        self.readers = readers if path != ":memory:" else 0
+        self.cached_statements = cached_statements
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._reader_pool: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+
+        # Write-behind event buffer, see log_event()/flush_events()
+        self.event_flush_size = event_flush_size
+        self.event_flush_interval = event_flush_interval
+        self.event_buffer_max = event_buffer_max
+        self.event_overflow = event_overflow  # "drop" | "block"
+        self.synchronous = synchronous
+        self._events: List[Tuple] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_pending: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        # one writer transaction at a time on the shared connection
+        self._write_lock = asyncio.Lock()
+
+        # (user_id, month) -> used, current month only
+        self._usage: Dict[Tuple[int, str], int] = {}
+        self._usage_month: Optional[str] = None
+
+        self.events_flushed = 0
+        self.events_dropped = 0
+        self.event_flushes = 0
 
     async def connect(self):
-        self._conn = await aiosqlite.connect(self.path)
+        self._conn = await aiosqlite.connect(
+            self.path, timeout=self.busy_timeout, cached_statements=self.cached_statements
+        )
         self._conn.row_factory = aiosqlite.Row
+        # takes effect on a new file only: before WAL mode writes its header
+        await self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         await self._conn.execute("PRAGMA journal_mode=WAL;")
+        await self._conn.execute(f"PRAGMA synchronous={self.synchronous};")
         await self._conn.execute("PRAGMA foreign_keys=ON;")
         await self.init_schema()
         await self.ensure_default_plans()
+        await self._open_readers()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _connect_reader(self) -> aiosqlite.Connection:
+        # only after migrations: a read-only connection cannot create the schema
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        conn = await aiosqlite.connect(
+            uri, uri=True, timeout=self.busy_timeout, cached_statements=self.cached_statements
+        )
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    async def _open_readers(self):
+        for _ in range(self.readers):
+            conn = await self._connect_reader()
+            self._reader_conns.append(conn)
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """A reader from the pool for one query (the writer when there are no readers)."""
+        if not self._reader_conns:
+            yield self._conn
+            return
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
 
     async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns = []
+        self._reader_pool = asyncio.Queue()
         if self._conn:
+            await self.flush_events()
             await self._conn.close()
             self._conn = None
 
@@ -73,9 +309,131 @@ class DB:
                 is_active INTEGER,
                 created_at TEXT
             );
+
+            -- per-day event counters, maintained by flush_events()
+            CREATE TABLE IF NOT EXISTS events_daily (
+                day TEXT NOT NULL,
+                event TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, event)
+            ) WITHOUT ROWID;
+
+            -- accepted image jobs until they are finished (then deleted);
+            -- state: queued (nobody's) | leased (lease_owner runs it until lease_until)
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                month TEXT NOT NULL,
+                charged INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                lease_owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, lease_until);
+
+            -- one row per user: when they first reached each funnel step
+            -- (NULL = not yet); cohort_day is the day they first showed up
+            CREATE TABLE IF NOT EXISTS user_funnel (
+                user_id INTEGER PRIMARY KEY,
+                cohort_day TEXT NOT NULL,
+                first_start TEXT,
+                first_image TEXT,
+                first_success TEXT,
+                hit_sub_wall TEXT,
+                sub_ok TEXT,
+                hit_paywall TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_user_funnel_cohort ON user_funnel (cohort_day);
+
+            -- admin broadcasts; cursor = last user_id done (keyset over users)
+            -- state: running | done | cancelled | failed
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                created_by INTEGER NOT NULL,
+                text TEXT,
+                from_chat_id INTEGER,
+                message_id INTEGER,
+                state TEXT NOT NULL DEFAULT 'running',
+                cursor INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                finished_at TEXT
+            );
             """
         )
         await self._conn.commit()
+        await self.migrate()
+
+    async def migrate(self):
+        """One-time data migrations, tracked in PRAGMA user_version."""
+        assert self._conn is not None
+
+        cur = await self._conn.execute("PRAGMA user_version")
+        version = (await cur.fetchone())[0]
+
+        if version < 1:
+            # backfill events_daily from the raw events we already have
+            await self._conn.execute("DELETE FROM events_daily")
+            await self._conn.execute(
+                """
+                INSERT INTO events_daily (day, event, count)
+                SELECT day, event, COUNT(*) FROM events GROUP BY day, event
+                """
+            )
+            await self._conn.execute("PRAGMA user_version=1")
+            await self._conn.commit()
+
+        if version < 2:
+            # incremental auto-vacuum lets maintenance give pages back in small
+            # steps. New files get it in connect(); an existing one only
+            # switches with a full VACUUM, which would hold up the start, so
+            # Maintenance runs it if allowed (full_vacuum) or reports it pending
+            await self._conn.execute("PRAGMA user_version=2")
+            await self._conn.commit()
+
+        if version < 3:
+            # backfill user_funnel from the events still in the database;
+            # users whose early events were archived keep their first_seen day
+            firsts = ",\n".join(
+                f"MIN(CASE WHEN event IN ({', '.join(repr(e) for e, c in FUNNEL_STEPS.items() if c == col)}) "
+                f"THEN ts END)"
+                for col in FUNNEL_COLUMNS
+            )
+            await self._conn.execute("DELETE FROM user_funnel")
+            await self._conn.execute(
+                f"""
+                INSERT INTO user_funnel (user_id, cohort_day, {", ".join(FUNNEL_COLUMNS)})
+                SELECT user_id, MIN(day), {firsts}
+                FROM events
+                WHERE user_id IS NOT NULL AND event IN ({", ".join(repr(e) for e in FUNNEL_STEPS)})
+                GROUP BY user_id
+                """
+            )
+            await self._conn.execute(
+                """
+                INSERT INTO user_funnel (user_id, cohort_day)
+                SELECT user_id, substr(first_seen, 1, 10) FROM users WHERE true  -- WHERE: upsert-from-SELECT syntax
+                ON CONFLICT(user_id) DO UPDATE SET cohort_day = MIN(cohort_day, excluded.cohort_day)
+                """
+            )
+            await self._conn.execute("PRAGMA user_version=3")
+            await self._conn.commit()
+
+        if version < 4:
+            # users who blocked the bot: skipped by broadcasts until they write again
+            cur = await self._conn.execute("PRAGMA table_info(users)")
+            if "blocked_at" not in [r["name"] for r in await cur.fetchall()]:
+                await self._conn.execute("ALTER TABLE users ADD COLUMN blocked_at TEXT")
+            await self._conn.execute("PRAGMA user_version=4")
+            await self._conn.commit()
 
     async def ensure_default_plans(self):
         assert self._conn is not None
@@ -107,67 +465,553 @@ class DB:
 
     # ---------- USERS ----------
 
+    @timed(DB_SECONDS, op="touch_user")
     async def touch_user(self, user_id: int):
         assert self._conn is not None
         now = _utc_now().isoformat()
 
-        await self._conn.execute(
-            """
-            INSERT INTO users (user_id, first_seen, last_seen)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
-            """,
-            (user_id, now, now),
-        )
-        await self._conn.commit()
+        async with self._write_lock:
+            await self._conn.execute(SQL_TOUCH_USER, (user_id, now, now))
+            await self._conn.commit()
 
     # ---------- USAGE ----------
 
+    @timed(DB_SECONDS, op="get_used_this_month")
     async def get_used_this_month(self, user_id: int) -> int:
         assert self._conn is not None
-        mk = _month_key()
-
-        cur = await self._conn.execute(
-            "SELECT used FROM usage_monthly WHERE user_id=? AND month=?",
-            (user_id, mk),
-        )
-        row = await cur.fetchone()
-        return row["used"] if row else 0
-
-    async def inc_used_this_month(self, user_id: int):
+        return await self._load_used(user_id, _month_key())
+
+    @timed(DB_SECONDS, op="reserve_usage")
+    async def reserve_usage(
+        self, user_id: int, limit: int, count: int = 1, job: Optional[NewJob] = None
+    ) -> Reservation:
+        """
+        Admit-and-charge in one transaction: touches the user and charges up
+        to `count` units while this month's usage stays below `limit`.
+        With `job`, the jobs row is written in the same transaction when
+        anything was granted, so a charge never exists without its job.
+        The charge is provisional - give it back with finish_job() if the
+        work fails.
+        """
         assert self._conn is not None
-        mk = _month_key()
-        now = _utc_now().isoformat()
-
+        now = _utc_now()
+        mk = _month_key(now)
+        ts = now.isoformat()
+
+        async with self._write_lock:
+            used = await self._load_used(user_id, mk)
+            granted = max(0, min(count, limit - used))
+
+            job_id = None
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                await self._conn.execute(SQL_TOUCH_USER, (user_id, ts, ts))
+                if granted:
+                    await self._conn.execute(SQL_USAGE_ADD, (user_id, mk, granted, ts, granted))
+                if granted and job is not None:
+                    cur = await self._conn.execute(
+                        SQL_INSERT_JOB,
+                        (
+                            user_id,
+                            job.chat_id,
+                            job.kind,
+                            json.dumps(job.payload, ensure_ascii=False),
+                            mk,
+                            granted,
+                            job.owner,
+                            time.time() + job.lease,
+                            ts,
+                        ),
+                    )
+                    job_id = cur.lastrowid
+                await self._conn.commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+            self._usage[(user_id, mk)] = used + granted
+
+        return Reservation(user_id=user_id, month=mk, used_before=used, granted=granted, job_id=job_id)
+
+    async def _refund(self, res: Reservation, n: int):
+        # caller holds _write_lock and commits
         await self._conn.execute(
-            """
-            INSERT INTO usage_monthly (user_id, month, used, updated_at)
-            VALUES (?, ?, 1, ?)
-            ON CONFLICT(user_id, month)
-            DO UPDATE SET used = used + 1, updated_at = excluded.updated_at
-            """,
-            (user_id, mk, now),
+            SQL_USAGE_REFUND,
+            (n, _utc_now().isoformat(), res.user_id, res.month),
         )
-        await self._conn.commit()
+        key = (res.user_id, res.month)
+        if key in self._usage:
+            self._usage[key] = max(self._usage[key] - n, 0)
+
+    async def _load_used(self, user_id: int, mk: str) -> int:
+        # write-through cache of usage_monthly for the current month; with
+        # several workers it holds because a user only ever reaches one of them
+        if mk != self._usage_month:
+            self._usage.clear()
+            self._usage_month = mk
+        used = self._usage.get((user_id, mk))
+        if used is not None:
+            return used
+
+        # committed state from a reader; under _write_lock nothing is pending
+        async with self._read() as conn:
+            cur = await conn.execute(SQL_LOAD_USED, (user_id, mk))
+            row = await cur.fetchone()
+        # a writer may have cached a newer value while we were reading
+        return self._usage.setdefault((user_id, mk), row["used"] if row else 0)
 
     # ---------- EVENTS ----------
 
     async def log_event(self, event: str, user_id: int | None = None, meta: str | None = None):
+        """
+        Buffers the event in memory; it is written by flush_events() once
+        `event_flush_size` rows are queued or every `event_flush_interval` s.
+        """
         assert self._conn is not None
         now = _utc_now()
 
-        await self._conn.execute(
-            "INSERT INTO events (ts, day, user_id, event, meta) VALUES (?, ?, ?, ?, ?)",
-            (now.isoformat(), _day_key(now), user_id, event, meta),
-        )
-        await self._conn.commit()
+        if len(self._events) >= self.event_buffer_max:
+            if self.event_overflow == "drop":
+                self.events_dropped += 1
+                return
+            await self.flush_events()
+
+        self._events.append((now.isoformat(), _day_key(now), user_id, event, meta))
+        if len(self._events) >= self.event_flush_size and (
+            self._flush_pending is None or self._flush_pending.done()
+        ):
+            self._flush_pending = asyncio.create_task(self.flush_events())
+
+    @timed(DB_SECONDS, op="flush_events")
+    async def flush_events(self):
+        assert self._conn is not None
+
+        async with self._flush_lock:
+            if not self._events:
+                return
+            batch, self._events = self._events, []
+
+            async with self._write_lock:
+                try:
+                    await self._conn.executemany(SQL_INSERT_EVENT, batch)
+                    daily = Counter((day, event) for _, day, _, event, _ in batch)
+                    await self._conn.executemany(
+                        SQL_EVENTS_DAILY_ADD,
+                        [(day, event, n) for (day, event), n in daily.items()],
+                    )
+                    await self._conn.executemany(SQL_FUNNEL_UPSERT, _funnel_rows(batch))
+                    await self._conn.commit()
+                except Exception:
+                    await self._conn.rollback()
+                    # put the batch back (oldest first), keeping the buffer bounded
+                    self._events = (batch + self._events)[-self.event_buffer_max:]
+                    raise
+
+            self.events_flushed += len(batch)
+            self.event_flushes += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.event_flush_interval)
+            try:
+                await self.flush_events()
+            except Exception:
+                log.exception("event flush failed")
+
+    def event_stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._events),
+            "flushed": self.events_flushed,
+            "flushes": self.event_flushes,
+            "dropped": self.events_dropped,
+        }
+
+    # ---------- JOBS ----------
+
+    @timed(DB_SECONDS, op="finish_job")
+    async def finish_job(self, res: Reservation, refund: int = 0):
+        """Drops the job row and gives back `refund` units, atomically."""
+        assert self._conn is not None
+        n = min(res.granted, refund)
+        if res.job_id is None and n <= 0:
+            return
+
+        async with self._write_lock:
+            try:
+                if n > 0:
+                    await self._refund(res, n)
+                if res.job_id is not None:
+                    await self._conn.execute(SQL_DELETE_JOB, (res.job_id,))
+                await self._conn.commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+        res.granted -= n
+        res.job_id = None
+
+    @timed(DB_SECONDS, op="claim_jobs")
+    async def claim_jobs(
+        self, owner: str, lease: float, limit: int, shard: Optional[Tuple[int, int]] = None
+    ) -> List[StoredJob]:
+        """
+        Leases up to `limit` jobs that are queued or whose lease ran out
+        (their process died), oldest first, in one statement. With
+        shard=(index, count) only jobs of users that bot.supervisor.shard_of()
+        sends to worker `index`, so usage and jobs of a user stay in one process.
+        Claiming costs no attempt: see count_attempt().
+        """
+        assert self._conn is not None
+        now = time.time()
+        where, params = "", (owner, now + lease, now)
+        if shard is not None:
+            where = " AND abs(user_id) % ? = ?"
+            params += (shard[1], shard[0])
+
+        async with self._write_lock:
+            cur = await self._conn.execute(
+                f"""
+                UPDATE jobs
+                SET state='leased', lease_owner=?, lease_until=?
+                WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE (state='queued' OR (state='leased' AND lease_until < ?)){where}
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, user_id, chat_id, kind, payload, month, charged, attempts
+                """,
+                params + (limit,),
+            )
+            rows = await cur.fetchall()
+            await self._conn.commit()
+
+        jobs = [
+            StoredJob(
+                id=r["id"],
+                user_id=r["user_id"],
+                chat_id=r["chat_id"],
+                kind=r["kind"],
+                payload=json.loads(r["payload"]),
+                month=r["month"],
+                charged=r["charged"],
+                attempts=r["attempts"],
+            )
+            for r in rows
+        ]
+        jobs.sort(key=lambda j: j.id)
+        return jobs
+
+    @timed(DB_SECONDS, op="count_attempt")
+    async def count_attempt(self, job_id: int, n: int = 1):
+        """
+        A resumed job is starting (n=1), or a run was cut short by a graceful
+        stop (n=-1). What stays counted are runs the process died in; a job
+        handed back unstarted (drain on a deploy, QueueFull) costs nothing.
+        """
+        assert self._conn is not None
+        async with self._write_lock:
+            await self._conn.execute("UPDATE jobs SET attempts=max(attempts + ?, 0) WHERE id=?", (n, job_id))
+            await self._conn.commit()
+
+    @timed(DB_SECONDS, op="renew_leases")
+    async def renew_leases(self, owner: str, lease: float) -> int:
+        assert self._conn is not None
+        async with self._write_lock:
+            cur = await self._conn.execute(
+                "UPDATE jobs SET lease_until=? WHERE state='leased' AND lease_owner=?",
+                (time.time() + lease, owner),
+            )
+            await self._conn.commit()
+            return cur.rowcount
+
+    async def release_jobs(self, owner: str, ids: Optional[List[int]] = None) -> int:
+        """Hands leased jobs back to the queue (all of `owner`'s, or just `ids`)."""
+        assert self._conn is not None
+        sql = "UPDATE jobs SET state='queued', lease_owner=NULL, lease_until=NULL WHERE state='leased' AND lease_owner=?"
+        params: List[Any] = [owner]
+        if ids is not None:
+            if not ids:
+                return 0
+            sql += f" AND id IN ({','.join('?' for _ in ids)})"
+            params.extend(ids)
+        async with self._write_lock:
+            cur = await self._conn.execute(sql, params)
+            await self._conn.commit()
+            return cur.rowcount
+
+    async def job_counts(self) -> Dict[str, int]:
+        assert self._conn is not None
+        async with self._read() as conn:
+            cur = await conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+            rows = await cur.fetchall()
+        counts = {"queued": 0, "leased": 0}
+        for state, n in rows:
+            counts[state] = n
+        return counts
+
+    # ---------- BROADCASTS ----------
+
+    async def create_broadcast(
+        self,
+        created_by: int,
+        text: Optional[str] = None,
+        from_chat_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+    ) -> int:
+        """A running broadcast of `text`, or of a copy of message_id in from_chat_id."""
+        assert self._conn is not None
+        async with self._write_lock:
+            cur = await self._conn.execute(
+                """
+                INSERT INTO broadcasts (created_at, created_by, text, from_chat_id, message_id, total)
+                VALUES (?, ?, ?, ?, ?, (SELECT COUNT(*) FROM users WHERE blocked_at IS NULL))
+                """,
+                (_utc_now().isoformat(), created_by, text, from_chat_id, message_id),
+            )
+            await self._conn.commit()
+            return cur.lastrowid
+
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """By id, or the latest one."""
+        assert self._conn is not None
+        async with self._read() as conn:
+            if broadcast_id is None:
+                cur = await conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+            else:
+                cur = await conn.execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,))
+            row = await cur.fetchone()
+        return dict(row) if row else None
+
+    async def running_broadcast(self) -> Optional[Dict[str, Any]]:
+        assert self._conn is not None
+        async with self._read() as conn:
+            cur = await conn.execute("SELECT * FROM broadcasts WHERE state='running' ORDER BY id LIMIT 1")
+            row = await cur.fetchone()
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS, op="broadcast_recipients")
+    async def broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """Next page of reachable users in user_id order (keyset: no OFFSET, no full list)."""
+        assert self._conn is not None
+        async with self._read() as conn:
+            cur = await conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+                (after_user_id, limit),
+            )
+            return [r[0] for r in await cur.fetchall()]
+
+    async def save_broadcast(
+        self,
+        broadcast_id: int,
+        cursor: int,
+        sent: int,
+        failed: int,
+        blocked: int,
+        state: str = "running",
+    ):
+        assert self._conn is not None
+        async with self._write_lock:
+            await self._conn.execute(
+                """
+                UPDATE broadcasts
+                SET cursor=?, sent=?, failed=?, blocked=?, state=?,
+                    finished_at=CASE WHEN ? = 'running' THEN NULL ELSE ? END
+                WHERE id=?
+                """,
+                (cursor, sent, failed, blocked, state, state, _utc_now().isoformat(), broadcast_id),
+            )
+            await self._conn.commit()
+
+    async def mark_blocked(self, user_ids: List[int]):
+        assert self._conn is not None
+        if not user_ids:
+            return
+        now = _utc_now().isoformat()
+        async with self._write_lock:
+            await self._conn.executemany(
+                "UPDATE users SET blocked_at=? WHERE user_id=?", [(now, uid) for uid in user_ids]
+            )
+            await self._conn.commit()
+
+    # ---------- EXPORT ----------
+
+    async def export_rows(
+        self, table: str, day_from: str, day_to: str, chunk_size: int = 1000
+    ) -> AsyncIterator[Tuple[List[str], List[Tuple]]]:
+        """
+        Streams (columns, rows) chunks of `table` for [day_from, day_to]:
+        events by day, usage_monthly by month, users active in the range.
+        An empty range gives one chunk with no rows.
+        One SELECT read with fetchmany() on a read-only connection of its
+        own, so a long export holds neither the writer nor a pooled reader
+        and memory stays at one chunk.
+        """
+        assert self._conn is not None
+        if table not in EXPORT_QUERIES:
+            raise ValueError(f"unknown export table {table!r}")
+        sql, bounds = EXPORT_QUERIES[table]
+
+        if self.readers:
+            conn = await self._connect_reader()
+        else:
+            conn = self._conn  # :memory: has nothing to share with a second connection
+        try:
+            cur = await conn.execute(sql, bounds(day_from, day_to))
+            columns = [d[0] for d in cur.description]
+            first = True
+            while True:
+                rows = await cur.fetchmany(chunk_size)
+                if not rows and not first:
+                    break
+                first = False
+                # an empty range still yields its columns once
+                yield columns, [tuple(r) for r in rows]
+                if not rows:
+                    break
+            await cur.close()
+        finally:
+            if conn is not self._conn:
+                await conn.close()
+
+    # ---------- MAINTENANCE ----------
+
+    async def fetch_old_events(self, day_before: str, after_id: int, limit: int) -> List[Dict[str, Any]]:
+        assert self._conn is not None
+        async with self._read() as conn:
+            cur = await conn.execute(
+                """
+                SELECT id, ts, day, user_id, event, meta
+                FROM events
+                WHERE id > ? AND day < ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (after_id, day_before, limit),
+            )
+            return [dict(r) for r in await cur.fetchall()]
+
+    @timed(DB_SECONDS, op="delete_events")
+    async def delete_events(self, first_id: int, last_id: int, day_before: str) -> int:
+        """Deletes one batch in its own short transaction."""
+        assert self._conn is not None
+        async with self._write_lock:
+            cur = await self._conn.execute(
+                "DELETE FROM events WHERE id >= ? AND id <= ? AND day < ?",
+                (first_id, last_id, day_before),
+            )
+            await self._conn.commit()
+            return cur.rowcount
+
+    async def storage_info(self) -> Dict[str, int]:
+        assert self._conn is not None
+        info = {}
+        async with self._read() as conn:
+            for pragma in ("page_size", "page_count", "freelist_count"):
+                cur = await conn.execute(f"PRAGMA {pragma}")
+                info[pragma] = (await cur.fetchone())[0]
+        info["db_bytes"] = info["page_size"] * info["page_count"]
+        try:
+            info["wal_bytes"] = os.path.getsize(self.path + "-wal")
+        except OSError:
+            info["wal_bytes"] = 0
+        return info
+
+    async def auto_vacuum_mode(self) -> int:
+        """0 none, 1 full, 2 incremental."""
+        assert self._conn is not None
+        async with self._read() as conn:
+            cur = await conn.execute("PRAGMA auto_vacuum")
+            return (await cur.fetchone())[0]
+
+    async def vacuum(self):
+        """
+        Full VACUUM that also switches the file to incremental auto-vacuum.
+        Rewrites the whole database (about its size again in free disk) and
+        holds the writer meanwhile.
+        """
+        assert self._conn is not None
+        async with self._write_lock:
+            await self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await self._conn.execute("VACUUM")
+
+    async def incremental_vacuum(self, pages: int):
+        assert self._conn is not None
+        async with self._write_lock:
+            # frees one page per step: fetch all rows to run it to the end
+            cur = await self._conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            await cur.fetchall()
+            await self._conn.commit()
+
+    async def wal_checkpoint(self) -> Tuple[int, int, int]:
+        assert self._conn is not None
+        async with self._write_lock:
+            cur = await self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy, log_frames, checkpointed = await cur.fetchone()
+        return busy, log_frames, checkpointed
 
     # ---------- STATS ----------
 
+    @timed(DB_SECONDS, op="funnel_cohorts")
+    async def funnel_cohorts(self, day_from: str, day_to: str) -> List[Dict[str, Any]]:
+        """
+        Unique users per cohort day in [day_from, day_to] and how many of them
+        reached each funnel step (ever, not just that day). Reads only the
+        cohort's rows of user_funnel.
+        """
+        assert self._conn is not None
+        await self.flush_events()
+
+        reached = ", ".join(f"COUNT({c}) AS {c}" for c in FUNNEL_COLUMNS)
+        async with self._read() as conn:
+            cur = await conn.execute(
+                f"""
+                SELECT cohort_day, COUNT(*) AS users, {reached}
+                FROM user_funnel
+                WHERE cohort_day >= ? AND cohort_day <= ?
+                GROUP BY cohort_day
+                ORDER BY cohort_day
+                """,
+                (day_from, day_to),
+            )
+            return [dict(r) for r in await cur.fetchall()]
+
+    async def funnel_totals(self, day_from: str, day_to: str) -> Dict[str, int]:
+        """funnel_cohorts() summed over the whole range."""
+        totals = {"users": 0, **{c: 0 for c in FUNNEL_COLUMNS}}
+        for row in await self.funnel_cohorts(day_from, day_to):
+            for k in totals:
+                totals[k] += row[k]
+        return totals
+
+    @timed(DB_SECONDS, op="count_events")
+    async def count_events(self, day_from: str, day_to: str, events: List[str]) -> Dict[str, int]:
+        """Event counts for [day_from, day_to] from the events_daily rollup."""
+        assert self._conn is not None
+        await self.flush_events()
+
+        counts = {e: 0 for e in events}
+        placeholders = ",".join("?" for _ in events)
+        async with self._read() as conn:
+            cur = await conn.execute(
+                f"""
+                SELECT event, SUM(count) AS c
+                FROM events_daily
+                WHERE day >= ? AND day <= ?
+                  AND event IN ({placeholders})
+                GROUP BY event
+                """,
+                [day_from, day_to, *events],
+            )
+            rows = await cur.fetchall()
+        for event, c in rows:
+            counts[event] = c
+        return counts
+
+    @timed(DB_SECONDS, op="list_plans")
     async def list_plans(self) -> List[Dict[str, Any]]:
         assert self._conn is not None
-        cur = await self._conn.execute(
-            "SELECT code, title, price_uah, credits, is_subscription FROM plans WHERE is_active=1"
-        )
-        rows = await cur.fetchall()
+        async with self._read() as conn:
+            cur = await conn.execute(
+                "SELECT code, title, price_uah, credits, is_subscription FROM plans WHERE is_active=1"
+            )
+            rows = await cur.fetchall()
         return [dict(r) for r in rows]
@@ -0,0 +1,98 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Optional
+
+from bot.photoroom import OutputOptions
+
+MODES = ("auto", "photo", "document")
+
+EXTENSIONS = {"jpeg": "jpg", "jpg": "jpg", "webp": "webp", "png": "png"}
+
+
+@dataclass(frozen=True)
+class Delivery:
+    """How a result goes back to the user, and what PhotoRoom is asked for to match."""
+    name: str  # "photo" | "document"
+    output: OutputOptions
+    as_document: bool
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.output.format or "png", "png")
+
+    @property
+    def filename(self) -> str:
+        return f"result.{self.extension}"
+
+    @property
+    def variant(self) -> str:
+        # part of the cache key: a result made with other options is another file
+        digest = hashlib.sha1(repr(self.output).encode()).hexdigest()[:8]
+        return f"{self.name}-{digest}"
+
+    @property
+    def max_input_edge(self) -> Optional[int]:
+        """
+        Largest input edge worth uploading: None for the preprocessor's
+        default, 0 to keep the resolution (a full-size document reply), or
+        the longer side of an explicit WIDTHxHEIGHT output size.
+        """
+        if not self.as_document:
+            return None
+        width, _, height = (self.output.size or "").partition("x")
+        if width.isdigit() and height.isdigit():
+            return max(int(width), int(height))
+        return 0
+
+
+class DeliveryPolicy:
+    """
+    Picks the reply type per request. Telegram recompresses photos to JPEG
+    and drops transparency, so a photo reply asks PhotoRoom for a small
+    opaque preview (`preview_format` on `preview_background`); a document
+    reply gets the full-resolution transparent PNG, untouched.
+
+    mode "auto" answers in kind: a photo with a photo, an image sent as a
+    file with a file. Albums always come back as a photo media group.
+    """
+
+    def __init__(
+        self,
+        mode: str = "auto",
+        preview_format: str = "jpeg",
+        preview_background: str = "FFFFFF",
+        output_size: Optional[str] = None,
+        padding: Optional[str] = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"unknown delivery mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+        self.preview = Delivery(
+            name="photo",
+            output=OutputOptions(
+                format=preview_format,
+                size=output_size,
+                padding=padding,
+                background=preview_background or None,
+            ),
+            as_document=False,
+        )
+        self.full = Delivery(
+            name="document",
+            output=OutputOptions(format="png", size=output_size, padding=padding),
+            as_document=True,
+        )
+
+    def for_reply(self, sent_as_document: bool) -> Delivery:
+        if self.mode == "photo":
+            return self.preview
+        if self.mode == "document":
+            return self.full
+        return self.full if sent_as_document else self.preview
+
+    def for_album(self) -> Delivery:
+        return self.preview
+
+    def get(self, name: str) -> Delivery:
+        """By Delivery.name, for jobs restored from the database."""
+        return self.full if name == self.full.name else self.preview
@@ -0,0 +1,160 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional, Tuple
+
+from bot.db import DB, EXPORT_QUERIES
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("csv", "ndjson")
+TABLES = tuple(EXPORT_QUERIES)
+
+
+class ExportBusy(Exception):
+    pass
+
+
+@dataclass
+class ExportPart:
+    path: str
+    filename: str
+    rows: int
+    size: int
+
+
+class _PartWriter:
+    """One gzip file being written; everything here runs in a worker thread."""
+
+    def __init__(self, path: str, fmt: str, columns: List[str]):
+        self.path = path
+        self.fmt = fmt
+        self.columns = columns
+        self.rows = 0
+        self._raw = open(path, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        if fmt == "csv":
+            self._write_csv([columns])
+
+    def _write_csv(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(rows)
+        self._gz.write(buf.getvalue().encode("utf-8"))
+
+    def write(self, rows: List[Tuple]):
+        if not rows:
+            return
+        if self.fmt == "csv":
+            self._write_csv(rows)
+        else:
+            lines = [json.dumps(dict(zip(self.columns, r)), ensure_ascii=False) for r in rows]
+            self._gz.write(("\n".join(lines) + "\n").encode("utf-8"))
+        self.rows += len(rows)
+
+    @property
+    def size(self) -> int:
+        # compressed bytes on disk so far (the compressor holds back a little)
+        return self._raw.tell()
+
+    def close(self) -> int:
+        self._gz.close()
+        self._raw.close()
+        return os.path.getsize(self.path)
+
+
+class Exporter:
+    """
+    Dumps a table for a date range into gzip CSV or NDJSON files for the
+    admin. Rows come from DB.export_rows() one chunk at a time and are
+    encoded and compressed in a worker thread as they arrive, so memory
+    stays at one chunk whatever the table size and the event loop keeps
+    serving users. A file that reaches `part_bytes` is closed and handed
+    out right away (Telegram caps uploads at 50 MB), the next rows go to a
+    new part with its own header.
+
+    One export at a time: they are rare and each holds a read transaction.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        chunk_rows: int = 1000,
+        part_bytes: int = 45 * 1024 * 1024,
+        tmp_dir: Optional[str] = None,
+    ):
+        self.db = db
+        self.chunk_rows = chunk_rows
+        self.part_bytes = part_bytes
+        self.tmp_dir = tmp_dir or None
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def export(self, table: str, day_from: str, day_to: str, fmt: str = "csv") -> AsyncIterator[ExportPart]:
+        """
+        Yields finished parts; the caller sends and then deletes each file.
+        A part the caller never received is deleted here.
+        """
+        if table not in TABLES:
+            raise ValueError(f"unknown table {table!r}, expected one of {TABLES}")
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown format {fmt!r}, expected one of {FORMATS}")
+        if self._lock.locked():
+            raise ExportBusy()
+
+        async with self._lock:
+            if self.tmp_dir:
+                os.makedirs(self.tmp_dir, exist_ok=True)
+            base = f"{table}_{day_from}_{day_to}"
+            writer: Optional[_PartWriter] = None
+            number = 0
+            total = 0
+            try:
+                async for columns, rows in self.db.export_rows(table, day_from, day_to, self.chunk_rows):
+                    if writer is not None and writer.size >= self.part_bytes:
+                        yield await self._finish(writer, base, number)
+                        writer = None
+                    if writer is None:
+                        number += 1
+                        writer = await asyncio.to_thread(_PartWriter, self._tmp_path(), fmt, columns)
+                    await asyncio.to_thread(writer.write, rows)
+                    total += len(rows)
+
+                part = await self._finish(writer, base, number if number > 1 else 0)
+                writer = None
+                log.info("export %s %s..%s: %d rows, %s", table, day_from, day_to, total, fmt)
+                yield part
+            finally:
+                if writer is not None:
+                    await asyncio.to_thread(writer.close)
+                    _unlink(writer.path)
+
+    async def _finish(self, writer: _PartWriter, base: str, number: int) -> ExportPart:
+        size = await asyncio.to_thread(writer.close)
+        suffix = f".part{number}" if number else ""
+        return ExportPart(
+            path=writer.path,
+            filename=f"{base}{suffix}.{writer.fmt}.gz",
+            rows=writer.rows,
+            size=size,
+        )
+
+    def _tmp_path(self) -> str:
+        fd, path = tempfile.mkstemp(prefix="export-", suffix=".gz", dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
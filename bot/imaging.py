@@ -0,0 +1,144 @@
+import asyncio
+import io
+import logging
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Tuple
+
+from PIL import Image, ImageOps, ExifTags
+
+from bot.metrics import PREPROCESS_SECONDS
+
+log = logging.getLogger(__name__)
+
+# sent as they are when nothing needs changing
+UPLOAD_FORMATS = ("JPEG", "PNG", "WEBP")
+# a JPEG that must be re-encoded at full resolution (rotated) keeps this much
+FULL_RES_JPEG_QUALITY = 95
+
+
+@dataclass
+class Prepared:
+    data: bytes
+    content_type: str
+    filename: str
+    in_bytes: int
+    out_bytes: int
+
+
+def _prepare(data: bytes, max_edge: int, jpeg_quality: int) -> Optional[Tuple[bytes, str]]:
+    """
+    Runs in a worker process: decode, apply EXIF orientation, downscale to
+    `max_edge` and re-encode (JPEG, or PNG when there is transparency).
+    Returns None when the original is already as good as it gets.
+
+    max_edge=0 is a full-resolution reply: the original is kept unless its
+    EXIF orientation forces a re-encode, and that one is lossless (PNG) for
+    anything but a JPEG source.
+    """
+    with Image.open(io.BytesIO(data)) as src:
+        fmt = src.format
+        rotated = src.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        if not max_edge and not rotated and fmt in UPLOAD_FORMATS:
+            return None
+        if fmt == "JPEG" and max_edge:
+            # let libjpeg decode at reduced scale (still >= max_edge)
+            src.draft("RGB", (max_edge, max_edge))
+        im = ImageOps.exif_transpose(src) if rotated else src
+        resized = bool(max_edge) and max(im.size) > max_edge
+        if resized:
+            im.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+        out = io.BytesIO()
+        if has_alpha or (not max_edge and fmt != "JPEG"):
+            im.save(out, "PNG", compress_level=3)
+            content_type = "image/png"
+        else:
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            quality = jpeg_quality if max_edge else max(jpeg_quality, FULL_RES_JPEG_QUALITY)
+            im.save(out, "JPEG", quality=quality, optimize=True)
+            content_type = "image/jpeg"
+
+    result = out.getvalue()
+    if not rotated and not resized and fmt in ("JPEG", "PNG") and len(result) >= len(data):
+        return None
+    return result, content_type
+
+
+class ImagePreprocessor:
+    """
+    Shrinks oversized uploads (phone photos sent as documents) before they go
+    to PhotoRoom. The CPU work runs in a process pool, off the event loop.
+    """
+
+    def __init__(self, max_edge: int = 2048, jpeg_quality: int = 90, workers: int = 2):
+        self.max_edge = max_edge
+        self.jpeg_quality = jpeg_quality
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+        self.images = 0
+        self.reencoded = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def start(self):
+        if self._pool is None:
+            # spawn: forking a process that already runs threads (aiosqlite) is unsafe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context("spawn"))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def prepare(
+        self, data: bytes, content_type: str, filename: str = "image", max_edge: Optional[int] = None
+    ) -> Prepared:
+        """`max_edge` overrides the configured one for this image; 0 keeps the resolution (see _prepare)."""
+        if self._pool is None:
+            self.start()
+
+        loop = asyncio.get_running_loop()
+        self.images += 1
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(
+                self._pool, _prepare, data, self.max_edge if max_edge is None else max_edge, self.jpeg_quality
+            )
+            outcome = "kept" if result is None else "reencoded"
+        except Exception:
+            # undecodable for Pillow (HEIC, broken file...): let PhotoRoom decide
+            self.failed += 1
+            log.debug("preprocess failed", exc_info=True)
+            result = None
+            outcome = "failed"
+        PREPROCESS_SECONDS.labels(result=outcome).observe(time.perf_counter() - started)
+
+        if result is None:
+            out, out_type = data, content_type
+        else:
+            self.reencoded += 1
+            out, out_type = result
+            filename = filename.rsplit(".", 1)[0] + (".png" if out_type == "image/png" else ".jpg")
+
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return Prepared(data=out, content_type=out_type, filename=filename, in_bytes=len(data), out_bytes=len(out))
+
+    def stats(self) -> Dict[str, Any]:
+        saved = self.bytes_in - self.bytes_out
+        return {
+            "images": self.images,
+            "reencoded": self.reencoded,
+            "failed": self.failed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "saved": saved,
+            "saved_avg": saved / self.images if self.images else 0,
+        }
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, Any, Optional, Tuple
+
+from bot.db import DB, StoredJob
+from bot.scheduler import JobScheduler, QueueFull
+
+log = logging.getLogger(__name__)
+
+
+def default_owner() -> str:
+    # unique per process start: a restarted bot must not think it still holds old leases
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class DurableJobs:
+    """
+    Keeps the `jobs` table and the in-memory scheduler in step.
+
+    New jobs are written already leased to this process (reserve_usage(job=...))
+    and go straight to the scheduler. In the background, leases of the jobs
+    we hold are renewed in one statement, and jobs nobody holds - handed back
+    on a graceful stop, or left behind by a crashed process - are claimed in
+    batches as long as the scheduler has room. `resume(job)` (given to start())
+    turns a claimed row back into a scheduler Job, or gives up on it.
+
+    Charges are made once, at admission; a resumed job runs on the original
+    reservation and is finished (row deleted, failures refunded) exactly once
+    via DB.finish_job().
+
+    With `shard` (index, count), in supervisor mode, only jobs of this
+    worker's users are claimed; a dead worker's jobs wait for its restart.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        scheduler: JobScheduler,
+        owner: Optional[str] = None,
+        lease: float = 60.0,
+        claim_batch: int = 20,
+        drain_timeout: float = 25.0,
+        shard: Optional[Tuple[int, int]] = None,
+    ):
+        self.db = db
+        self.scheduler = scheduler
+        self.resume: Optional[Callable[[StoredJob], Awaitable[None]]] = None
+        self.owner = owner or default_owner()
+        self.lease = lease
+        self.claim_batch = claim_batch
+        self.drain_timeout = drain_timeout
+        self.shard = shard
+
+        self._task: Optional[asyncio.Task] = None
+        self.claimed = 0
+        self.resumed = 0
+        self.released = 0
+
+    def start(self, resume: Callable[[StoredJob], Awaitable[None]]):
+        self.resume = resume
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Drains the scheduler, then hands every job we still hold back to the queue."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        left = await self.scheduler.drain(self.drain_timeout)
+        self.released = await self.db.release_jobs(self.owner)
+        if left or self.released:
+            log.info("jobs: %d not started, %d handed back to the queue", len(left), self.released)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.db.renew_leases(self.owner, self.lease)
+                await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("jobs: lease/claim round failed")
+            await asyncio.sleep(self.lease / 3)
+
+    async def _claim(self):
+        while True:
+            room = self.scheduler.max_pending - self.scheduler.stats()["pending"]
+            if room <= 0:
+                return
+            jobs = await self.db.claim_jobs(self.owner, self.lease, min(room, self.claim_batch), self.shard)
+            if not jobs:
+                return
+            self.claimed += len(jobs)
+
+            refused = []
+            for job in jobs:
+                try:
+                    await self.resume(job)
+                    self.resumed += 1
+                except QueueFull:
+                    refused.append(job.id)
+                except Exception:
+                    log.exception("jobs: could not resume job %s", job.id)
+                    refused.append(job.id)
+            if refused:
+                # someone else (or a later round) can take them
+                await self.db.release_jobs(self.owner, refused)
+                return
+            if len(jobs) < self.claim_batch:
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "claimed": self.claimed,
+            "resumed": self.resumed,
+            "released": self.released,
+        }
@@ -1,19 +1,139 @@
 import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
 from datetime import datetime, timezone, timedelta
+from pathlib import Path
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, SimpleFilesPathWrapper, TelegramAPIServer
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
     Message,
+    ChatMemberUpdated,
+    InputFile,
+    BufferedInputFile,
+    InputMediaPhoto,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
 )
 from aiogram.enums import ContentType
 
-from bot.config import BOT_TOKEN, PHOTOROOM_API_KEY, ADMIN_ID
-from bot.photoroom import remove_bg
-from bot.db import DB
+from bot.config import (
+    BOT_TOKEN,
+    PHOTOROOM_API_KEY,
+    ADMIN_ID,
+    MAX_MB,
+    PHOTOROOM_API_URL,
+    PHOTOROOM_POOL_LIMIT,
+    PHOTOROOM_KEEPALIVE_S,
+    PHOTOROOM_DNS_TTL_S,
+    PHOTOROOM_CONNECT_TIMEOUT_S,
+    PHOTOROOM_READ_TIMEOUT_S,
+    PHOTOROOM_TOTAL_TIMEOUT_S,
+    PHOTOROOM_MAX_ATTEMPTS,
+    PHOTOROOM_BACKOFF_CAP_S,
+    PHOTOROOM_BREAKER_THRESHOLD,
+    PHOTOROOM_BREAKER_RESET_S,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_MAX_MB,
+    RESULT_CACHE_INDEX_SAVE_S,
+    JOB_CONCURRENCY,
+    JOB_MAX_PENDING,
+    JOB_MAX_PER_USER,
+    DB_PATH,
+    DB_SYNCHRONOUS,
+    DB_READERS,
+    DB_BUSY_TIMEOUT_S,
+    EVENT_FLUSH_SIZE,
+    EVENT_FLUSH_INTERVAL_S,
+    EVENT_BUFFER_MAX,
+    EVENT_OVERFLOW,
+    SUB_CACHE_POSITIVE_TTL_S,
+    SUB_CACHE_NEGATIVE_TTL_S,
+    SUB_RETRY_DELAY_S,
+    PREPROCESS_MIN_KB,
+    PREPROCESS_MAX_EDGE,
+    PREPROCESS_JPEG_QUALITY,
+    PREPROCESS_WORKERS,
+    EVENTS_RETENTION_DAYS,
+    EVENTS_ARCHIVE_DIR,
+    MAINTENANCE_INTERVAL_H,
+    MAINTENANCE_BATCH_SIZE,
+    MAINTENANCE_FULL_VACUUM,
+    DELIVERY_MODE,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_MAX_CONNECTIONS,
+    METRICS_HOST,
+    METRICS_PORT,
+    ALBUM_WINDOW_S,
+    ALBUM_CONCURRENCY,
+    THROTTLE_USER_RATE,
+    THROTTLE_USER_BURST,
+    THROTTLE_GLOBAL_RATE,
+    THROTTLE_GLOBAL_BURST,
+    THROTTLE_SHED_LOAD,
+    JOB_LEASE_S,
+    JOB_DRAIN_TIMEOUT_S,
+    JOB_MAX_ATTEMPTS,
+    TELEGRAM_API_URL,
+    TELEGRAM_API_LOCAL,
+    TELEGRAM_SERVER_FILES_DIR,
+    TELEGRAM_LOCAL_FILES_DIR,
+    MAX_MB_LOCAL,
+    RESULT_DELIVERY,
+    RESULT_PREVIEW_FORMAT,
+    RESULT_PREVIEW_BACKGROUND,
+    RESULT_OUTPUT_SIZE,
+    RESULT_PADDING,
+    BROADCAST_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_PAGE_SIZE,
+    EXPORT_CHUNK_ROWS,
+    EXPORT_PART_MB,
+    EXPORT_TMP_DIR,
+    WORKERS,
+    WORKER_INDEX,
+    WORKER_STOP_TIMEOUT_S,
+    WORKER_QUEUE_MAX,
+)
+from bot.photoroom import PhotoRoomClient, PhotoRoomError
+from bot.delivery import Delivery, DeliveryPolicy
+from bot.cache import ResultCache
+from bot.scheduler import JobScheduler, Job, QueueFull
+from bot.albums import AlbumCollector
+from bot.throttling import ThrottlingMiddleware, HIGH, NORMAL, LOW
+from bot.subscriptions import SubscriptionCache, SUBSCRIBED_STATUSES
+from bot.imaging import ImagePreprocessor
+from bot.maintenance import Maintenance, MaintenanceReport
+from bot.webhook import check_base_url, run_webhook, default_secret
+from bot.streams import StreamInputFile, FileTooLarge, disk_file, telegram_file_chunks, tee
+from bot.db import DB, Reservation, NewJob, StoredJob
+from bot.jobs import DurableJobs
+from bot.broadcast import Broadcaster, BroadcastBusy
+from bot.supervisor import READY, Supervisor, build_router_app, poll_updates, shard_of
+from bot.export import Exporter, ExportBusy, FORMATS as EXPORT_FORMATS, TABLES as EXPORT_TABLES
+from bot.metrics import (
+    BotApiTimer,
+    HandlerTimer,
+    LoopLagMonitor,
+    PHOTOROOM_BREAKER,
+    PHOTOROOM_TRANSFER_BYTES,
+    MetricsServer,
+)
+
+log = logging.getLogger(__name__)
 
 # =======================
 # CONFIG
@@ -25,9 +145,96 @@ CHANNEL_URL = "https://t.me/resident_room"
 # 0 used -> free
 # 1 used -> requires subscription
 # 2+ used -> show tariffs
-
-db = DB()
+FREE_LIMIT = 2
+
+# a local Bot API server has no 20 MB getFile limit
+INPUT_MAX_MB = MAX_MB_LOCAL if TELEGRAM_API_LOCAL else MAX_MB
+MAX_BYTES = INPUT_MAX_MB * 1024 * 1024
+PREPROCESS_MIN_BYTES = PREPROCESS_MIN_KB * 1024
+
+# supervisor mode: this process is worker WORKER_INDEX of WORKERS (see bot.supervisor)
+IS_WORKER = WORKER_INDEX >= 0
+SHARDS = WORKERS if IS_WORKER else 1
+# the worker that gets the admin's updates also runs maintenance and broadcasts
+IS_LEAD = not IS_WORKER or WORKER_INDEX == shard_of(ADMIN_ID, WORKERS)
+
+db = DB(
+    path=DB_PATH,
+    event_flush_size=EVENT_FLUSH_SIZE,
+    event_flush_interval=EVENT_FLUSH_INTERVAL_S,
+    event_buffer_max=EVENT_BUFFER_MAX,
+    event_overflow=EVENT_OVERFLOW,
+    synchronous=DB_SYNCHRONOUS,
+    readers=DB_READERS,
+    busy_timeout=DB_BUSY_TIMEOUT_S,
+)
 dp = Dispatcher()
+photoroom = PhotoRoomClient(
+    api_key=PHOTOROOM_API_KEY,
+    api_url=PHOTOROOM_API_URL,
+    pool_limit=PHOTOROOM_POOL_LIMIT,
+    keepalive_timeout=PHOTOROOM_KEEPALIVE_S,
+    dns_ttl=PHOTOROOM_DNS_TTL_S,
+    connect_timeout=PHOTOROOM_CONNECT_TIMEOUT_S,
+    read_timeout=PHOTOROOM_READ_TIMEOUT_S,
+    total_timeout=PHOTOROOM_TOTAL_TIMEOUT_S,
+    max_attempts=PHOTOROOM_MAX_ATTEMPTS,
+    backoff_cap=PHOTOROOM_BACKOFF_CAP_S,
+    breaker_threshold=PHOTOROOM_BREAKER_THRESHOLD,
+    breaker_reset=PHOTOROOM_BREAKER_RESET_S,
+)
+# the cache index lives in memory: one directory per worker
+cache = ResultCache(
+    path=os.path.join(RESULT_CACHE_DIR, f"w{WORKER_INDEX}") if IS_WORKER else RESULT_CACHE_DIR,
+    max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024 // SHARDS,
+    save_interval=RESULT_CACHE_INDEX_SAVE_S,
+)
+preprocessor = ImagePreprocessor(
+    max_edge=PREPROCESS_MAX_EDGE,
+    jpeg_quality=PREPROCESS_JPEG_QUALITY,
+    workers=PREPROCESS_WORKERS,
+)
+maintenance = Maintenance(
+    db,
+    archive_dir=EVENTS_ARCHIVE_DIR,
+    retention_days=EVENTS_RETENTION_DAYS,
+    batch_size=MAINTENANCE_BATCH_SIZE,
+    interval=MAINTENANCE_INTERVAL_H * 3600,
+    full_vacuum=bool(MAINTENANCE_FULL_VACUUM),
+)
+subs = SubscriptionCache(positive_ttl=SUB_CACHE_POSITIVE_TTL_S, negative_ttl=SUB_CACHE_NEGATIVE_TTL_S)
+# while PhotoRoom's circuit is open, jobs stay queued instead of failing
+scheduler = JobScheduler(
+    concurrency=JOB_CONCURRENCY,
+    max_pending=JOB_MAX_PENDING,
+    max_per_user=JOB_MAX_PER_USER,
+    gate=photoroom.breaker.admit_job,
+)
+albums = AlbumCollector(window=ALBUM_WINDOW_S)
+delivery_policy = DeliveryPolicy(
+    mode=RESULT_DELIVERY,
+    preview_format=RESULT_PREVIEW_FORMAT,
+    preview_background=RESULT_PREVIEW_BACKGROUND,
+    output_size=RESULT_OUTPUT_SIZE or None,
+    padding=RESULT_PADDING or None,
+)
+jobs = DurableJobs(
+    db,
+    scheduler,
+    lease=JOB_LEASE_S,
+    drain_timeout=JOB_DRAIN_TIMEOUT_S,
+    shard=(WORKER_INDEX, WORKERS) if IS_WORKER else None,
+)
+broadcaster = Broadcaster(db, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, page_size=BROADCAST_PAGE_SIZE)
+exporter = Exporter(
+    db, chunk_rows=EXPORT_CHUNK_ROWS, part_bytes=EXPORT_PART_MB * 1024 * 1024, tmp_dir=EXPORT_TMP_DIR or None
+)
+loop_lag = LoopLagMonitor()
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT + WORKER_INDEX if IS_WORKER else METRICS_PORT)
+
+dp.message.middleware(HandlerTimer())
+dp.chat_member.middleware(HandlerTimer())
+PHOTOROOM_BREAKER.set_function(lambda: {"closed": 0, "half_open": 1, "open": 2}[photoroom.breaker.state])
 
 
 # =======================
@@ -62,7 +269,8 @@ def rk_admin() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="📊 Сегодня"), KeyboardButton(text="📈 7 дней")],
-            [KeyboardButton(text="🎯 Конверсия"), KeyboardButton(text="💳 Тарифы (таблица)")],
+            [KeyboardButton(text="🎯 Конверсия"), KeyboardButton(text="👥 Когорты")],
+            [KeyboardButton(text="💳 Тарифы (таблица)"), KeyboardButton(text="⚙️ Система")],
             [KeyboardButton(text="⬅️ Назад")],
         ],
         resize_keyboard=True,
@@ -76,17 +284,75 @@ def is_admin(user_id: int) -> bool:
     return int(user_id) == int(ADMIN_ID)
 
 
-async def is_subscribed(bot: Bot, user_id: int) -> bool:
-    try:
-        member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ("member", "administrator", "creator", "restricted")
-    except Exception as e:
-        # Distinguish "not subscribed" from errors
+# dropped first when the queue fills up: nothing here starts image work
+LOW_PRIORITY_TEXTS = {
+    "💳 Тарифы",
+    "⬅️ Назад",
+    "/admin",
+    "/stats",
+    "📊 Статистика",
+    "📊 Сегодня",
+    "📈 7 дней",
+    "🎯 Конверсия",
+    "👥 Когорты",
+    "💳 Тарифы (таблица)",
+    "⚙️ Система",
+}
+
+
+def classify_update(message: Message) -> tuple[str, int, float]:
+    """(kind, priority, cost in per-user tokens) for flood control."""
+    if message.photo or message.document:
+        return "image", HIGH, 1.0
+    if message.text == "✅ Я подписался":
+        # every press is a get_chat_member call
+        return "sub_check", NORMAL, 3.0
+    if message.text in LOW_PRIORITY_TEXTS:
+        return "low", LOW, 1.0
+    return "other", NORMAL, 1.0
+
+
+throttling = ThrottlingMiddleware(
+    classify=classify_update,
+    log_event=db.log_event,
+    load=scheduler.load,
+    exempt=is_admin,
+    user_rate=THROTTLE_USER_RATE,
+    user_burst=THROTTLE_USER_BURST,
+    # Telegram's limit is per bot, each worker gets its share
+    global_rate=THROTTLE_GLOBAL_RATE / SHARDS,
+    global_burst=THROTTLE_GLOBAL_BURST / SHARDS,
+    shed_load=THROTTLE_SHED_LOAD,
+)
+dp.message.outer_middleware(throttling)
+
+
+async def is_subscribed(bot: Bot, user_id: int, trust_negative: bool = True) -> bool | None:
+    """
+    True/False from the subscription cache or get_chat_member.
+    None means Telegram could not answer (after one short retry) - not cached.
+    """
+    cached = subs.get(user_id, trust_negative=trust_negative)
+    if cached is not None:
+        return cached
+
+    for attempt in range(2):
         try:
-            await db.log_event(user_id=user_id, event="check_sub_error", meta=str(e)[:300])
-        except Exception:
-            pass
-        return False
+            member = await bot.get_chat_member(CHANNEL_ID, user_id)
+        except Exception as e:
+            # Distinguish "not subscribed" from errors
+            subs.errors += 1
+            try:
+                await db.log_event(user_id=user_id, event="check_sub_error", meta=str(e)[:300])
+            except Exception:
+                pass
+            if attempt == 0:
+                await asyncio.sleep(SUB_RETRY_DELAY_S)
+            continue
+        ok = member.status in SUBSCRIBED_STATUSES
+        subs.set(user_id, ok)
+        return ok
+    return None
 
 
 async def send_tariffs(message: Message):
@@ -120,67 +386,522 @@ async def ask_for_photo(message: Message):
     )
 
 
-async def process_image(message: Message, bot: Bot, file_id: str, mime_type: str | None = None):
+async def _reject(message: Message, used: int, subscribed: bool | None):
+    """Tells the user why (part of) their upload was not admitted."""
     user_id = message.from_user.id
     a = is_admin(user_id)
 
-    await db.touch_user(user_id)
-    await db.log_event(user_id=user_id, event="image_received", meta=mime_type or "")
-
-    used = await db.get_used_this_month(user_id)
-
     # 0 -> free
-    if used == 0:
-        pass
     # 1 -> requires subscription
-    elif used == 1:
-        if not await is_subscribed(bot, user_id):
-            await db.log_event(user_id=user_id, event="sub_required", meta=f"used={used}")
-            await message.answer(
-                "🔒 Второе фото доступно после подписки на канал.\n\n"
-                f"📢 Подпишись: {CHANNEL_URL}\n"
-                "После подписки нажми «✅ Я подписался».",
-                reply_markup=rk_subscribe(a),
-            )
-            return
-    # 2+ -> tariffs
-    else:
-        await db.log_event(user_id=user_id, event="paid_required", meta=f"used={used}")
+    if used < FREE_LIMIT and subscribed is None:
         await message.answer(
-            "🚫 Бесплатный лимит исчерпан.\n\n💳 Ознакомься с тарифами.",
+            "⚠️ Не получилось проверить подписку. Попробуй ещё раз через минуту.",
             reply_markup=rk_main(a),
         )
         return
+    if used < FREE_LIMIT:
+        await db.log_event(user_id=user_id, event="sub_required", meta=f"used={used}")
+        await message.answer(
+            "🔒 Второе фото доступно после подписки на канал.\n\n"
+            f"📢 Подпишись: {CHANNEL_URL}\n"
+            "После подписки нажми «✅ Я подписался».",
+            reply_markup=rk_subscribe(a),
+        )
+        return
 
-    await message.answer("⏳ Обрабатываю…", reply_markup=ReplyKeyboardRemove())
-    await db.log_event(user_id=user_id, event="remove_bg_start")
+    # 2+ -> tariffs
+    await db.log_event(user_id=user_id, event="paid_required", meta=f"used={used}")
+    await message.answer(
+        "🚫 Бесплатный лимит исчерпан.\n\n💳 Ознакомься с тарифами.",
+        reply_markup=rk_main(a),
+    )
 
-    try:
-        tg_file = await bot.get_file(file_id)
-        stream = await bot.download_file(tg_file.file_path)
-        image_bytes = stream.read()
 
-        # PhotoRoom
-        result_bytes = await remove_bg(image_bytes=image_bytes, api_key=PHOTOROOM_API_KEY)
+async def admit(message: Message, bot: Bot, count: int = 1, job: NewJob | None = None) -> Reservation | None:
+    """
+    Quota check and charge for `count` images sent together, in one
+    reservation (stored together with `job`). Whatever does not fit is
+    answered with the sub wall / tariffs; returns None when nothing was granted.
+    """
+    user_id = message.from_user.id
+
+    # The subscription check is only needed past the 1st photo of the month
+    used = await db.get_used_this_month(user_id)
+    subscribed, sub_checked = False, False
+    if used < FREE_LIMIT and used + count > 1:
+        subscribed, sub_checked = await is_subscribed(bot, user_id), True
+
+    # Atomically charge: two photos sent together can no longer both see
+    # used == 0. Without a confirmed subscription only the free one.
+    res = await db.reserve_usage(user_id, limit=FREE_LIMIT if subscribed else 1, count=count, job=job)
+    if res.granted < count and res.used_before + res.granted < FREE_LIMIT and not sub_checked:
+        # usage moved between the peek and the reservation
+        subscribed, sub_checked = await is_subscribed(bot, user_id), True
+        if subscribed:
+            # only reachable with count == 1, i.e. nothing (and no job) granted yet
+            res = await db.reserve_usage(user_id, limit=FREE_LIMIT, count=count, job=job)
+
+    if res.granted < count:
+        await _reject(message, res.used_before + res.granted, subscribed)
+    return res if res.granted else None
+
+
+async def process_image(
+    message: Message,
+    bot: Bot,
+    file_id: str,
+    file_unique_id: str | None = None,
+    mime_type: str | None = None,
+    file_size: int | None = None,
+):
+    user_id = message.from_user.id
+    a = is_admin(user_id)
 
-        await db.inc_used_this_month(user_id)
-        await db.log_event(user_id=user_id, event="remove_bg_success")
+    await db.log_event(user_id=user_id, event="image_received", meta=mime_type or "")
 
-        await message.answer_photo(
-            photo=result_bytes,
-            caption="✅ Готово! Фон убран.\n\nЧтобы обработать ещё — отправь следующее фото.",
+    # Reject before downloading anything or charging quota
+    if (file_size or 0) > MAX_BYTES:
+        await db.log_event(user_id=user_id, event="file_too_large", meta=str(file_size))
+        await message.answer(
+            f"⚠️ Файл слишком большой. Максимум — {INPUT_MAX_MB} МБ.",
             reply_markup=rk_main(a),
         )
-    except Exception as e:
-        await db.log_event(user_id=user_id, event="remove_bg_error", meta=str(e)[:300])
+        return
+
+    job = ImageJob(
+        user_id=user_id,
+        chat_id=message.chat.id,
+        file_id=file_id,
+        file_unique_id=file_unique_id,
+        mime_type=_image_type(mime_type),
+        delivery=delivery_policy.for_reply(sent_as_document=mime_type != "photo"),
+    )
+    payload = {
+        "file_id": file_id,
+        "file_unique_id": file_unique_id,
+        "mime_type": job.mime_type,
+        "delivery": job.delivery.name,
+    }
+    job.reservation = await admit(message, bot, job=_new_job(job.chat_id, "image", payload))
+    if job.reservation is None:
+        return
+
+    await _submit(message, bot, job, key=(user_id, file_unique_id or file_id), run=lambda: run_job(bot, job))
+
+
+async def process_album(bot: Bot, batch: list[tuple[Message, "AlbumItem"]]):
+    """One album (collected by AlbumCollector): one quota check, one job."""
+    message = batch[0][0]
+    user_id = message.from_user.id
+    a = is_admin(user_id)
+
+    items = []
+    for _, item in batch:
+        await db.log_event(user_id=user_id, event="image_received", meta=item.mime_type)
+        if (item.file_size or 0) > MAX_BYTES:
+            await db.log_event(user_id=user_id, event="file_too_large", meta=str(item.file_size))
+        else:
+            items.append(item)
+
+    if len(items) < len(batch):
         await message.answer(
-            "⚠️ Не получилось обработать фото. Попробуй другое изображение.",
+            f"⚠️ {len(batch) - len(items)} из {len(batch)} файлов больше {INPUT_MAX_MB} МБ — их пропускаю.",
             reply_markup=rk_main(a),
         )
+    if not items:
+        return
+
+    payload = {"media_group_id": message.media_group_id, "items": [asdict(item) for item in items]}
+    res = await admit(message, bot, count=len(items), job=_new_job(message.chat.id, "album", payload))
+    if res is None:
+        return
+
+    # the stored payload keeps all items, `charged` says how many were paid for
+    job = AlbumJob(
+        user_id=user_id,
+        chat_id=message.chat.id,
+        items=items[: res.granted],
+        reservation=res,
+    )
+    await _submit(
+        message, bot, job, key=_album_key(user_id, message.media_group_id, items), run=lambda: run_job(bot, job)
+    )
+
+
+def _album_key(user_id: int, media_group_id: str, items: list["AlbumItem"]) -> tuple:
+    # items arriving after the collector window form a second batch of the
+    # same album: the first item tells the batches apart, so it is not
+    # taken for a duplicate of the first one
+    first = items[0]
+    return (user_id, "album", media_group_id, first.file_unique_id or first.file_id)
+
+
+def _new_job(chat_id: int, kind: str, payload: dict) -> NewJob:
+    return NewJob(chat_id=chat_id, kind=kind, payload=payload, owner=jobs.owner, lease=JOB_LEASE_S)
+
+
+async def _submit(message: Message, bot: Bot, job: "ImageJob | AlbumJob", key, run):
+    """Queues an admitted job and shows its status message; refunds when it can't be queued."""
+    user_id = job.user_id
+    try:
+        pos = scheduler.submit(
+            Job(
+                key=key,
+                user_id=user_id,
+                run=run,
+                on_position=lambda p: update_queue_status(bot, job, p),
+            )
+        )
+    except QueueFull as e:
+        await db.finish_job(job.reservation, refund=job.reservation.granted)
+        await db.log_event(user_id=user_id, event="queue_full", meta=str(e))
+        await message.answer(
+            "🚦 Сейчас много желающих. Попробуй отправить фото через минуту.",
+            reply_markup=rk_main(is_admin(user_id)),
+        )
+        return
+
+    if pos is None:
+        # same photo from the same user is already queued / in progress
+        await db.finish_job(job.reservation, refund=job.reservation.granted)
+        return
+
+    try:
+        status = await message.answer(_queue_text(pos, job), reply_markup=ReplyKeyboardRemove())
+        job.status_message_id = status.message_id
+    finally:
+        job.ready.set()
+
+
+def _image_type(mime_type: str | None) -> str:
+    return mime_type if (mime_type or "").startswith("image/") else "image/jpeg"
+
+
+@dataclass
+class ImageJob:
+    user_id: int
+    chat_id: int
+    file_id: str
+    file_unique_id: str | None = None
+    mime_type: str = "image/jpeg"
+    delivery: Delivery = delivery_policy.preview
+    reservation: Reservation | None = None
+    status_message_id: int | None = None
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+@dataclass
+class AlbumItem:
+    file_id: str
+    file_unique_id: str | None = None
+    mime_type: str = "image/jpeg"
+    file_size: int | None = None
+
+
+@dataclass
+class AlbumJob:
+    user_id: int
+    chat_id: int
+    items: list[AlbumItem]
+    reservation: Reservation | None = None
+    status_message_id: int | None = None
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def _queue_text(pos: int, job: "ImageJob | AlbumJob | None" = None) -> str:
+    n = len(job.items) if isinstance(job, AlbumJob) else 1
+    if pos <= 0:
+        return "⏳ Обрабатываю…" if n == 1 else f"⏳ Обрабатываю {n} фото…"
+    if n == 1:
+        return f"🕒 Ты #{pos} в очереди. Фото обработается автоматически."
+    return f"🕒 Ты #{pos} в очереди. {n} фото обработаются автоматически."
+
+
+async def update_queue_status(bot: Bot, job: "ImageJob | AlbumJob", pos: int):
+    await job.ready.wait()
+    if job.status_message_id is None:
+        return
+    await bot.edit_message_text(_queue_text(pos, job), chat_id=job.chat_id, message_id=job.status_message_id)
+
+
+@dataclass
+class ResultSource:
+    media: InputFile | str
+    key: str | None = None
+    cached: bool = False
+    upload_bytes: int = 0  # sent to PhotoRoom (last attempt)
+    result_bytes: int = 0  # received from PhotoRoom
+
+
+@asynccontextmanager
+async def open_result(bot: Bot, file_id: str, file_unique_id: str | None, mime_type: str, delivery: Delivery):
+    """
+    Yields the background-removed image for a Telegram file, in the output
+    `delivery` asks for: a cached file_id / file, or a StreamInputFile of the
+    PhotoRoom response. Must be consumed (sent) inside the block; on a clean
+    exit the streamed result is committed to the cache and `key` is set.
+    """
+    # Cache: same Telegram file -> same key without downloading it again;
+    # every delivery variant is a separate result
+    alias = f"{file_unique_id}-{delivery.variant}" if file_unique_id else None
+    cached = await cache.lookup(alias)
+    if cached is not None:
+        yield ResultSource(
+            media=cached.file_id or disk_file(bot, cached.path, delivery.filename), key=cached.key, cached=True
+        )
+        return
+
+    tg_file = await bot.get_file(file_id)
+    if (tg_file.file_size or 0) > MAX_BYTES:
+        raise FileTooLarge(f"file_size={tg_file.file_size}")
+
+    # The input is read whole before anything goes to PhotoRoom: its sha256
+    # is the content key, so the same bytes under another file_unique_id (a
+    # saved photo sent again, a re-upload) are found here. PhotoRoom retries
+    # then reuse the buffer instead of downloading again.
+    filename = os.path.basename(tg_file.file_path)
+    content_type = mime_type
+    hasher = hashlib.sha256()
+    chunks = tee(telegram_file_chunks(bot, tg_file.file_path), hasher.update, limit=MAX_BYTES)
+    data = b"".join([chunk async for chunk in chunks])
+    key = f"{hasher.hexdigest()}-{delivery.variant}"
+    cached = await cache.lookup_content(key, alias)
+    if cached is not None:
+        yield ResultSource(
+            media=cached.file_id or disk_file(bot, cached.path, delivery.filename), key=cached.key, cached=True
+        )
+        return
+
+    source = data
+    if len(data) >= PREPROCESS_MIN_BYTES:
+        # Big upload (usually a phone photo sent as a document): downscaled
+        # and re-encoded in the process pool, unless the reply is a
+        # full-resolution document - that one is only oriented if needed.
+        prepared = await preprocessor.prepare(data, content_type, filename, max_edge=delivery.max_input_edge)
+        source, filename, content_type = prepared.data, prepared.filename, prepared.content_type
+    uploaded = len(source)
+    del data
+
+    writer = cache.writer()
+    try:
+        async with photoroom.remove_bg_stream(
+            source, filename=filename, content_type=content_type, output=delivery.output
+        ) as body:
+            result = ResultSource(media=StreamInputFile(tee(body, writer.write), filename=delivery.filename))
+            yield result
+        result.key = key
+        result.upload_bytes, result.result_bytes = uploaded, writer.size
+        await writer.commit(result.key, delivery.extension)
+    except BaseException:
+        await writer.abort()
+        raise
+    PHOTOROOM_TRANSFER_BYTES.labels(direction="upload", delivery=delivery.name).observe(result.upload_bytes)
+    PHOTOROOM_TRANSFER_BYTES.labels(direction="result", delivery=delivery.name).observe(result.result_bytes)
+    cache.alias(alias, result.key)
+
+
+async def send_result(bot: Bot, job: ImageJob, media: InputFile | str) -> Message:
+    caption = "✅ Готово! Фон убран.\n\nЧтобы обработать ещё — отправь следующее фото."
+    markup = rk_main(is_admin(job.user_id))
+    if job.delivery.as_document:
+        return await bot.send_document(job.chat_id, document=media, caption=caption, reply_markup=markup)
+    return await bot.send_photo(job.chat_id, photo=media, caption=caption, reply_markup=markup)
+
+
+def _success_meta(result: ResultSource, delivery: Delivery) -> str:
+    if result.cached:
+        return "cache"
+    return f"{delivery.name} up={result.upload_bytes} result={result.result_bytes}"
+
+
+def _error_text(e: Exception) -> str:
+    if isinstance(e, PhotoRoomError) and e.retryable:
+        return "⚠️ Сервис обработки сейчас перегружен. Попробуй отправить фото через пару минут."
+    return "⚠️ Не получилось обработать фото. Попробуй другое изображение."
+
+
+async def run_job(bot: Bot, job: "ImageJob | AlbumJob"):
+    """
+    Runs an admitted job and closes its jobs row, refunding what was not
+    delivered. Cancellation (drain deadline) leaves the row for a resume.
+    """
+    res = job.reservation
+    try:
+        if isinstance(job, AlbumJob):
+            failed = await run_album_job(bot, job)
+        else:
+            failed = await run_image_job(bot, job)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        if res is not None:
+            await db.finish_job(res, refund=res.granted)
+        raise
+    if res is not None:
+        # quota is only kept for delivered results
+        await db.finish_job(res, refund=failed)
+
+
+async def resume_job(bot: Bot, stored: StoredJob):
+    """A job left over by a restart (or a crashed worker): queue it again on its original charge."""
+    res = stored.reservation
+    if stored.attempts >= JOB_MAX_ATTEMPTS:
+        # it went down with the process every time it ran: give up
+        await db.finish_job(res, refund=res.granted)
+        await db.log_event(
+            user_id=stored.user_id, event="remove_bg_error", meta=f"job {stored.id}: {stored.attempts} attempts"
+        )
+        await bot.send_message(
+            stored.chat_id,
+            "⚠️ Не получилось обработать фото. Попробуй отправить его ещё раз.",
+            reply_markup=rk_main(is_admin(stored.user_id)),
+        )
+        return
+
+    p = stored.payload
+    job: ImageJob | AlbumJob
+    if stored.kind == "album":
+        job = AlbumJob(
+            user_id=stored.user_id,
+            chat_id=stored.chat_id,
+            items=[AlbumItem(**item) for item in p["items"][: res.granted]],
+            reservation=res,
+        )
+        key = _album_key(stored.user_id, p["media_group_id"], job.items)
+    else:
+        job = ImageJob(
+            user_id=stored.user_id,
+            chat_id=stored.chat_id,
+            file_id=p["file_id"],
+            file_unique_id=p.get("file_unique_id"),
+            mime_type=p.get("mime_type") or "image/jpeg",
+            delivery=delivery_policy.get(p.get("delivery") or "photo"),
+            reservation=res,
+        )
+        key = (stored.user_id, job.file_unique_id or job.file_id)
+
+    async def run():
+        # counted when it starts, not when it is claimed, and given back when
+        # a graceful stop cuts it short: only a crash mid-run makes the job
+        # a suspect, waiting in the queue through a deploy does not
+        try:
+            await db.count_attempt(stored.id)
+        except Exception:
+            log.warning("job %s: could not count the attempt", stored.id, exc_info=True)
+        try:
+            await run_job(bot, job)
+        except asyncio.CancelledError:
+            await db.count_attempt(stored.id, -1)
+            raise
+
+    # QueueFull propagates: DurableJobs hands the row back for later
+    pos = scheduler.submit(
+        Job(
+            key=key,
+            user_id=stored.user_id,
+            run=run,
+            on_position=lambda p: update_queue_status(bot, job, p),
+        )
+    )
+    if pos is None:
+        # the same photo has been sent again meanwhile and is already queued
+        await db.finish_job(res, refund=res.granted)
+        return
+
+    try:
+        status = await bot.send_message(stored.chat_id, "♻️ Бот перезапускался — продолжаю.\n\n" + _queue_text(pos, job))
+        job.status_message_id = status.message_id
+    except Exception:
+        log.debug("resume notice failed", exc_info=True)
+    finally:
+        job.ready.set()
+
+
+async def run_image_job(bot: Bot, job: ImageJob) -> int:
+    """Returns the number of undelivered images (0 or 1)."""
+    user_id = job.user_id
+    a = is_admin(user_id)
+
+    await job.ready.wait()
+    await db.log_event(user_id=user_id, event="remove_bg_start")
+
+    try:
+        async with open_result(bot, job.file_id, job.file_unique_id, job.mime_type, job.delivery) as result:
+            sent = await send_result(bot, job, result.media)
+
+        await db.log_event(user_id=user_id, event="remove_bg_success", meta=_success_meta(result, job.delivery))
+        if sent.photo:
+            cache.remember_file_id(result.key, sent.photo[-1].file_id)
+        elif sent.document:
+            cache.remember_file_id(result.key, sent.document.file_id)
+        return 0
+    except Exception as e:
+        await db.log_event(user_id=user_id, event="remove_bg_error", meta=str(e)[:300])
+        await bot.send_message(job.chat_id, _error_text(e), reply_markup=rk_main(a))
+        return 1
+
+
+async def run_album_job(bot: Bot, job: AlbumJob) -> int:
+    """
+    Up to ALBUM_CONCURRENCY photos of the album go through PhotoRoom at
+    once; results are buffered (an album is at most 10 images) and sent
+    back as one media group. Returns the number of undelivered photos.
+    """
+    user_id = job.user_id
+    a = is_admin(user_id)
+    await job.ready.wait()
+
+    limit = asyncio.Semaphore(ALBUM_CONCURRENCY)
+    preview = delivery_policy.for_album()
+
+    async def one(item: AlbumItem) -> tuple[ResultSource, InputFile | str]:
+        async with limit:
+            await db.log_event(user_id=user_id, event="remove_bg_start")
+            mime_type = _image_type(item.mime_type)
+            async with open_result(bot, item.file_id, item.file_unique_id, mime_type, preview) as result:
+                media = result.media
+                if isinstance(media, StreamInputFile):
+                    data = b"".join([chunk async for chunk in media.read(bot)])
+                    media = BufferedInputFile(data, filename=preview.filename)
+            return result, media
+
+    outcomes = await asyncio.gather(*(one(item) for item in job.items), return_exceptions=True)
+    done = [o for o in outcomes if not isinstance(o, BaseException)]
+    errors = [o for o in outcomes if isinstance(o, BaseException)]
+
+    if done:
+        try:
+            if len(done) == 1:
+                sent = [await bot.send_photo(job.chat_id, photo=done[0][1])]
+            else:
+                sent = await bot.send_media_group(job.chat_id, media=[InputMediaPhoto(media=m) for _, m in done])
+        except Exception as e:
+            # nothing was delivered
+            errors.extend([e] * len(done))
+            done, sent = [], []
+        for (result, _), msg in zip(done, sent):
+            await db.log_event(user_id=user_id, event="remove_bg_success", meta=_success_meta(result, preview))
+            if msg.photo:
+                cache.remember_file_id(result.key, msg.photo[-1].file_id)
+
+    for e in errors:
+        await db.log_event(user_id=user_id, event="remove_bg_error", meta=str(e)[:300])
+
+    if not errors:
+        text = f"✅ Готово! Фон убран на {len(done)} фото.\n\nЧтобы обработать ещё — отправь следующее фото."
+    elif done:
+        text = f"✅ Готово: {len(done)} из {len(job.items)} фото.\n" + _error_text(errors[0])
+    else:
+        text = _error_text(errors[0])
+    try:
+        await bot.send_message(job.chat_id, text, reply_markup=rk_main(a))
+    except Exception:
+        log.warning("album summary not delivered to %s", job.chat_id, exc_info=True)
+    return len(errors)
 
 
 # =======================
-# Admin stats (queries over events table)
+# Admin stats (queries over the events_daily rollup and user_funnel)
 # =======================
 async def _count_events(day_from: str, day_to: str | None = None) -> dict:
     """
@@ -202,29 +923,10 @@ async def _count_events(day_from: str, day_to: str | None = None) -> dict:
         "check_sub_error",
     ]
 
-    # Use db._conn directly (aiosqlite connection created in db.connect()).
-    conn = getattr(db, "_conn", None)
-    if conn is None:
-        return {k: 0 for k in keys}
-
     if day_to is None:
         day_to = day_from
 
-    counts = {k: 0 for k in keys}
-    placeholders = ",".join("?" for _ in keys)
-    sql = f"""
-        SELECT event, COUNT(*) as c
-        FROM events
-        WHERE day >= ? AND day <= ?
-          AND event IN ({placeholders})
-        GROUP BY event
-    """
-    params = [day_from, day_to, *keys]
-    cur = await conn.execute(sql, params)
-    rows = await cur.fetchall()
-    for event, c in rows:
-        counts[event] = c
-    return counts
+    return await db.count_events(day_from, day_to, keys)
 
 
 async def admin_show_today(message: Message):
@@ -275,31 +977,143 @@ async def admin_show_7d(message: Message):
     await message.answer(text, reply_markup=rk_admin())
 
 
+def _pct(a: int, b: int) -> str:
+    if b <= 0:
+        return "—"
+    return f"{(a / b) * 100:.1f}%"
+
+
 async def admin_show_conversion(message: Message):
+    # unique users who first showed up in the last 7 days (user_funnel)
     today = datetime.now(timezone.utc).date()
     day_to = today.isoformat()
     day_from = (today - timedelta(days=6)).isoformat()
-    s = await _count_events(day_from, day_to)
+    f = await db.funnel_totals(day_from, day_to)
 
-    starts = s.get("start", 0)
-    received = s.get("image_received", 0) + s.get("photo_received", 0)
-    ok = s.get("remove_bg_success", 0)
-    subreq = s.get("sub_required", 0)
-    paid = s.get("paid_required", 0)
+    text = (
+        f"🎯 Конверсия — уникальные пользователи\n"
+        f"Новые за UTC {day_from} … {day_to}: {f['users']}\n\n"
+        f"/start: {f['first_start']}\n"
+        f"Прислали фото: {f['first_image']} (от /start: {_pct(f['first_image'], f['first_start'])})\n"
+        f"Получили результат: {f['first_success']} (от фото: {_pct(f['first_success'], f['first_image'])})\n"
+        f"Запрос подписки: {f['hit_sub_wall']} (от результата: {_pct(f['hit_sub_wall'], f['first_success'])})\n"
+        f"Подписались: {f['sub_ok']} (от запроса: {_pct(f['sub_ok'], f['hit_sub_wall'])})\n"
+        f"Уперлись в тарифы: {f['hit_paywall']} (от результата: {_pct(f['hit_paywall'], f['first_success'])})\n"
+    )
+    await message.answer(text, reply_markup=rk_admin())
+
+
+async def admin_show_cohorts(message: Message):
+    # daily cohorts of the last 14 days: how far each one got so far
+    today = datetime.now(timezone.utc).date()
+    day_from = (today - timedelta(days=13)).isoformat()
+    rows = await db.funnel_cohorts(day_from, today.isoformat())
+
+    lines = ["👥 Когорты по дню прихода (UTC)", "новые → фото → результат → подписка → тарифы", ""]
+    for r in rows:
+        n = r["users"]
+        lines.append(
+            f"{r['cohort_day'][5:]}: {n} → {_pct(r['first_image'], n)} → {_pct(r['first_success'], n)}"
+            f" → {_pct(r['sub_ok'], n)} → {_pct(r['hit_paywall'], n)}"
+        )
+    if not rows:
+        lines.append("Пока нет данных.")
+    await message.answer("\n".join(lines), reply_markup=rk_admin())
+
+
+def _broadcast_text(b: dict) -> str:
+    states = {"running": "идёт", "done": "завершена", "cancelled": "отменена", "failed": "остановлена из-за ошибки"}
+    done = b["sent"] + b["failed"] + b["blocked"]
+    text = (
+        f"📣 Рассылка #{b['id']}: {states.get(b['state'], b['state'])}\n"
+        f"• отправлено: {b['sent']}, ошибок: {b['failed']}, заблокировали бота: {b['blocked']}\n"
+        f"• пройдено: {done} из {b['total']} ({_pct(done, b['total'])})\n"
+    )
+    if b["state"] == "running":
+        eta = f", осталось ~{b['eta_s'] / 60:.0f} мин" if b["eta_s"] is not None else ""
+        text += f"• скорость: {b['rate']:.1f} сообщ./с{eta}\n"
+        if b["paused_s"] > 0:
+            text += f"• пауза по FloodWait: ещё {b['paused_s']:.0f} с\n"
+    return text
+
+
+def _maintenance_text(r: MaintenanceReport) -> str:
+    return (
+        f"🧹 Обслуживание БД ({r.finished_at})\n\n"
+        f"• событий старше {r.cutoff_day} в архиве: {r.archived}, удалено: {r.deleted}\n"
+        f"• размер: {r.bytes_before / 1024 / 1024:.1f} → {r.bytes_after / 1024 / 1024:.1f} МБ "
+        f"(освобождено {r.reclaimed / 1024 / 1024:.1f} МБ)\n"
+        f"• заняло: {r.seconds:.1f} с\n"
+        + ("• выполнен полный VACUUM: база перешла на incremental auto-vacuum\n" if r.vacuumed else "")
+        + (
+            "• нужен однократный полный VACUUM (блокирует запись на время перезаписи файла): "
+            "MAINTENANCE_FULL_VACUUM=1\n"
+            if r.vacuum_pending
+            else ""
+        )
+    )
+
+
+async def notify_admin_maintenance(bot: Bot, r: MaintenanceReport):
+    if ADMIN_ID:
+        await bot.send_message(ADMIN_ID, _maintenance_text(r))
 
-    def pct(a: int, b: int) -> str:
-        if b <= 0:
-            return "—"
-        return f"{(a / b) * 100:.1f}%"
 
+async def admin_show_system(message: Message):
+    p = photoroom.stats()
+    c = cache.stats()
+    q = scheduler.stats()
+    ev = db.event_stats()
+    sb = subs.stats()
+    pp = preprocessor.stats()
+    al = albums.stats()
+    th = throttling.stats()
+    jb = jobs.stats()
+    jc = await db.job_counts()
     text = (
-        f"🎯 Конверсия (UTC {day_from} … {day_to})\n\n"
-        f"/start: {starts}\n"
-        f"Фото получено: {received} (от /start: {pct(received, starts)})\n"
-        f"Успешно убрали фон: {ok} (от фото: {pct(ok, received)})\n"
-        f"Запрос подписки (2-я попытка): {subreq}\n"
-        f"Уперлись в тарифы (3+): {paid}\n"
+        "⚙️ Система\n\n"
+        "Очередь:\n"
+        f"• в очереди: {q['pending']} / {q['max_pending']}\n"
+        f"• в работе: {q['running']} / {q['concurrency']}\n"
+        f"• ожидание: ср. {q['wait_avg']:.1f} с, p95 {q['wait_p95']:.1f} с, старейшее {q['wait_oldest']:.1f} с\n"
+        f"• готово: {q['completed']}, сбоев: {q['failed']}, отказов: {q['rejected']}, дублей: {q['deduped']}\n"
+        f"• альбомов: {al['albums']} ({al['items']} фото), собирается: {al['open']}\n"
+        f"• в таблице jobs: в работе {jc['leased']}, ждут {jc['queued']}; "
+        f"подхвачено после перезапуска: {jb['resumed']}\n"
+        "\nАнтифлуд:\n"
+        f"• отброшено: по пользователю {th['dropped_user']}, общий лимит {th['dropped_global']}, "
+        f"под нагрузкой {th['dropped_shed']}\n"
+        f"• загрузка очереди: {th['load']:.0%}, пользователей в учёте: {th['users_tracked']}\n"
+        "\nPhotoRoom:\n"
+        f"• состояние: {p['breaker_state']}"
+        + (f" (повтор через {p['breaker_retry_in']:.0f} с)" if p["breaker_state"] == "open" else "")
+        + f", размыканий: {p['breaker_opened']}\n"
+        f"• повторов: {p['retries']}, временных ошибок: {p['errors_retryable']}, "
+        f"постоянных: {p['errors_permanent']}\n"
+        f"• запросов: {p['requests']}\n"
+        f"• соединений открыто: {p['conn_opened']}\n"
+        f"• соединений переиспользовано: {p['conn_reused']}\n"
+        f"• лимит пула: {p['pool_limit']}\n"
+        "\nКэш результатов:\n"
+        f"• попаданий: {c['hits']} (file_unique_id: {c['hits_unique_id']}, хэш: {c['hits_content']})\n"
+        f"• без загрузки (file_id): {c['hits_file_id']}\n"
+        f"• промахов: {c['misses']}\n"
+        f"• вытеснено: {c['evictions']}\n"
+        f"• записей: {c['entries']}, на диске: {c['bytes'] / 1024 / 1024:.1f} / {c['max_bytes'] / 1024 / 1024:.0f} МБ\n"
+        "\nСобытия:\n"
+        f"• в буфере: {ev['buffered']}, записано: {ev['flushed']} за {ev['flushes']} транзакций\n"
+        f"• потеряно при переполнении: {ev['dropped']}\n"
+        "\nПроверка подписки:\n"
+        f"• из кэша: {sb['hits']}, запросов к Telegram: {sb['misses']}\n"
+        f"• обновлений chat_member: {sb['updates']}, ошибок: {sb['errors']}, в кэше: {sb['entries']}\n"
+        "\nПредобработка:\n"
+        f"• файлов: {pp['images']}, пережато: {pp['reencoded']}, не распознано: {pp['failed']}\n"
+        f"• сэкономлено: {pp['saved'] / 1024 / 1024:.1f} МБ (в среднем {pp['saved_avg'] / 1024:.0f} КБ на фото)\n"
     )
+    if broadcaster.current is not None:
+        text += "\n" + _broadcast_text(broadcaster.stats())
+    if maintenance.last_report is not None:
+        text += "\n" + _maintenance_text(maintenance.last_report)
     await message.answer(text, reply_markup=rk_admin())
 
 
@@ -356,6 +1170,145 @@ async def btn_admin_conv(message: Message):
     await admin_show_conversion(message)
 
 
+@dp.message(F.text == "👥 Когорты")
+async def btn_admin_cohorts(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    await admin_show_cohorts(message)
+
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    """
+    /broadcast <text> - send text to every user; /broadcast as a reply -
+    send a copy of that message; /broadcast alone - progress.
+    """
+    if not is_admin(message.from_user.id):
+        return
+    source = message.reply_to_message
+    if not command.args and source is None:
+        if broadcaster.current is None:
+            await message.answer(
+                "📣 Рассылок ещё не было.\n\n"
+                "/broadcast текст — отправить текст всем\n"
+                "/broadcast ответом на сообщение — разослать его копию\n"
+                "/broadcast_cancel — остановить",
+                reply_markup=rk_admin(),
+            )
+        else:
+            await message.answer(_broadcast_text(broadcaster.stats()), reply_markup=rk_admin())
+        return
+
+    try:
+        if source is not None:
+            broadcast_id = await broadcaster.launch(
+                message.from_user.id, from_chat_id=source.chat.id, message_id=source.message_id
+            )
+        else:
+            broadcast_id = await broadcaster.launch(message.from_user.id, text=command.args)
+    except BroadcastBusy as e:
+        await message.answer(f"⚠️ Уже идёт рассылка #{e.args[0]}. /broadcast_cancel — остановить.")
+        return
+    await db.log_event(user_id=message.from_user.id, event="broadcast_start", meta=str(broadcast_id))
+    b = broadcaster.stats()
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id} запущена: {b['total']} получателей, "
+        f"до {BROADCAST_RATE:g} сообщ./с.\nПрогресс — /broadcast",
+        reply_markup=rk_admin(),
+    )
+
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    broadcast_id = await broadcaster.cancel()
+    if broadcast_id is None:
+        await message.answer("Сейчас рассылки нет.", reply_markup=rk_admin())
+        return
+    await db.log_event(user_id=message.from_user.id, event="broadcast_cancel", meta=str(broadcast_id))
+    await message.answer(_broadcast_text(broadcaster.stats()), reply_markup=rk_admin())
+
+
+EXPORT_ALIASES = {"usage": "usage_monthly", "all": None}
+
+
+def _parse_export_args(args: str):
+    """[table|all] [from] [to] [csv|ndjson] in any order; None on a bad argument."""
+    tables = list(EXPORT_TABLES)
+    days = []
+    fmt = "csv"
+    for arg in (args or "").split():
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg in EXPORT_TABLES or arg in EXPORT_ALIASES:
+            table = EXPORT_ALIASES.get(arg, arg)
+            tables = [table] if table else list(EXPORT_TABLES)
+        else:
+            try:
+                days.append(datetime.strptime(arg, "%Y-%m-%d").date())
+            except ValueError:
+                return None
+    if len(days) > 2:
+        return None
+    today = datetime.now(timezone.utc).date()
+    day_from = days[0] if days else today - timedelta(days=29)
+    day_to = days[1] if len(days) > 1 else today
+    if day_from > day_to:
+        day_from, day_to = day_to, day_from
+    return tables, day_from.isoformat(), day_to.isoformat(), fmt
+
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject, bot: Bot):
+    """
+    /export [events|usage|users|all] [YYYY-MM-DD [YYYY-MM-DD]] [csv|ndjson] -
+    gzip files with the rows for the range; by default all tables, csv,
+    the last 30 days.
+    """
+    if not is_admin(message.from_user.id):
+        return
+    parsed = _parse_export_args(command.args)
+    if parsed is None:
+        await message.answer(
+            "Формат: /export [events|usage|users|all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [csv|ndjson]\n"
+            "Без аргументов — все таблицы за 30 дней в CSV.",
+            reply_markup=rk_admin(),
+        )
+        return
+    tables, day_from, day_to, fmt = parsed
+    if exporter.running:
+        await message.answer("⏳ Выгрузка уже идёт, дождись файлов.", reply_markup=rk_admin())
+        return
+
+    await message.answer(f"📦 Выгружаю {', '.join(tables)} за {day_from} — {day_to} ({fmt}.gz)…")
+    rows = 0
+    try:
+        for table in tables:
+            async for part in exporter.export(table, day_from, day_to, fmt):
+                try:
+                    await bot.send_document(
+                        message.chat.id,
+                        document=disk_file(bot, part.path, part.filename),
+                        caption=f"{part.filename}: {part.rows} строк, {part.size / 1024 / 1024:.1f} МБ",
+                    )
+                finally:
+                    os.remove(part.path)
+                rows += part.rows
+    except ExportBusy:
+        await message.answer("⏳ Выгрузка уже идёт, дождись файлов.", reply_markup=rk_admin())
+        return
+    except Exception:
+        log.exception("export %s %s..%s failed", tables, day_from, day_to)
+        await message.answer("⚠️ Выгрузка прервалась, подробности в логе.", reply_markup=rk_admin())
+        return
+    await db.log_event(
+        user_id=message.from_user.id, event="export", meta=f"{','.join(tables)} {day_from}..{day_to} {fmt} rows={rows}"
+    )
+    await message.answer("✅ Выгрузка готова.", reply_markup=rk_admin())
+
+
 @dp.message(F.text == "💳 Тарифы (таблица)")
 async def btn_admin_plans(message: Message):
     if not is_admin(message.from_user.id):
@@ -363,13 +1316,35 @@ async def btn_admin_plans(message: Message):
     await send_tariffs(message)
 
 
+@dp.message(F.text == "⚙️ Система")
+async def btn_admin_system(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    await admin_show_system(message)
+
+
+@dp.message(F.text == "/maintenance")
+async def cmd_admin_maintenance(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    await message.answer("🧹 Запускаю обслуживание БД…")
+    report = await maintenance.run_once()
+    await message.answer(_maintenance_text(report), reply_markup=rk_admin())
+
+
 @dp.message(F.text == "✅ Я подписался")
 async def btn_check_sub(message: Message, bot: Bot):
     user_id = message.from_user.id
     a = is_admin(user_id)
 
-    ok = await is_subscribed(bot, user_id)
-    if ok:
+    # the user says they just subscribed: don't trust a cached "no"
+    ok = await is_subscribed(bot, user_id, trust_negative=False)
+    if ok is None:
+        await message.answer(
+            "⚠️ Не получилось проверить подписку. Попробуй ещё раз через минуту.",
+            reply_markup=rk_subscribe(a),
+        )
+    elif ok:
         await db.log_event(user_id=user_id, event="sub_ok")
         await message.answer("✅ Подписка подтверждена! Теперь пришли фото.", reply_markup=rk_main(a))
     else:
@@ -380,11 +1355,27 @@ async def btn_check_sub(message: Message, bot: Bot):
         )
 
 
+# Channel membership changes keep the subscription cache fresh
+# (the bot must be a channel admin to receive them)
+@dp.chat_member(F.chat.id == CHANNEL_ID)
+async def on_channel_member(event: ChatMemberUpdated):
+    subs.on_member_update(event.new_chat_member.user.id, event.new_chat_member.status)
+
+
 # PHOTO
+def collect_album(message: Message, bot: Bot, item: AlbumItem):
+    albums.add((message.chat.id, message.media_group_id), (message, item), lambda batch: process_album(bot, batch))
+
+
 @dp.message(F.photo)
 async def on_photo(message: Message, bot: Bot):
-    file_id = message.photo[-1].file_id
-    await process_image(message, bot, file_id, mime_type="photo")
+    photo = message.photo[-1]
+    if message.media_group_id:
+        collect_album(message, bot, AlbumItem(photo.file_id, photo.file_unique_id, "photo", photo.file_size))
+        return
+    await process_image(
+        message, bot, photo.file_id, photo.file_unique_id, mime_type="photo", file_size=photo.file_size
+    )
 
 
 # DOCUMENT image/*
@@ -395,16 +1386,163 @@ async def on_document(message: Message, bot: Bot):
         return
     if not (doc.mime_type or "").startswith("image/"):
         return
-    await process_image(message, bot, doc.file_id, mime_type=doc.mime_type)
+    if message.media_group_id:
+        collect_album(message, bot, AlbumItem(doc.file_id, doc.file_unique_id, doc.mime_type, doc.file_size))
+        return
+    await process_image(
+        message, bot, doc.file_id, doc.file_unique_id, mime_type=doc.mime_type, file_size=doc.file_size
+    )
 
 
-async def main():
+async def startup(bot: Bot):
+    # shared by polling and webhook mode
+    bot.session.middleware(BotApiTimer())
+    loop_lag.start()
+    if METRICS_PORT:
+        await metrics_server.start()
     await db.connect()
-    bot = Bot(token=BOT_TOKEN)
+    await photoroom.start()
+    await cache.start()
+    preprocessor.start()
+    scheduler.start()
+    jobs.start(resume=lambda stored: resume_job(bot, stored))
+    throttling.start()
+    if IS_LEAD:
+        maintenance.start(notify=lambda r: notify_admin_maintenance(bot, r))
+        await broadcaster.start(bot)
+
+
+async def shutdown(bot: Bot):
+    await broadcaster.stop()
+    await maintenance.stop()
+    await throttling.stop()
+    await albums.close()
+    # finish what is running, hand the rest back to the jobs table
+    await jobs.stop()
+    await scheduler.stop()
+    preprocessor.close()
+    await cache.close()
+    await photoroom.close()
+    await db.flush_events()
+    await db.close()
+    await loop_lag.stop()
+    await metrics_server.stop()
+    await bot.session.close()
+
+
+def api_server(base_url: str = TELEGRAM_API_URL) -> TelegramAPIServer:
+    """api.telegram.org, or a self-hosted Bot API server (optionally in local mode)."""
+    if not base_url:
+        return PRODUCTION
+    kwargs = {}
+    if TELEGRAM_SERVER_FILES_DIR and TELEGRAM_LOCAL_FILES_DIR:
+        kwargs["wrap_local_file"] = SimpleFilesPathWrapper(
+            Path(TELEGRAM_SERVER_FILES_DIR), Path(TELEGRAM_LOCAL_FILES_DIR)
+        )
+    return TelegramAPIServer.from_base(base_url, is_local=TELEGRAM_API_LOCAL, **kwargs)
+
+
+async def _feed(bot: Bot, raw: dict):
     try:
-        await dp.start_polling(bot)
+        await dp.feed_raw_update(bot, raw)
+    except Exception:
+        log.exception("update %s failed", raw.get("update_id"))
+
+
+async def run_worker(bot: Bot):
+    """Handles the updates the supervisor routes here (JSON lines on stdin) until EOF."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    sys.stdout.buffer.write(READY)
+    sys.stdout.flush()
+
+    handling = set()
+    while line := await reader.readline():
+        task = asyncio.create_task(_feed(bot, json.loads(line)))
+        handling.add(task)
+        task.add_done_callback(handling.discard)
+    if handling:
+        await asyncio.gather(*handling)
+
+
+async def run_supervisor():
+    # schema and migrations once, before any worker opens the file
+    await db.connect()
+    await db.close()
+
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=api_server()))
+    supervisor = Supervisor(
+        WORKERS,
+        command=[sys.executable, "-m", "bot.main"],
+        stop_timeout=WORKER_STOP_TIMEOUT_S,
+        max_queue=WORKER_QUEUE_MAX,
+    )
+    await supervisor.start()
+    try:
+        if DELIVERY_MODE == "webhook":
+            secret = WEBHOOK_SECRET or default_secret(BOT_TOKEN)
+            await run_webhook(
+                dp,
+                bot,
+                base_url=WEBHOOK_BASE_URL,
+                path=WEBHOOK_PATH,
+                secret=secret,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                app=build_router_app(supervisor.route, WEBHOOK_PATH, secret),
+            )
+        else:
+            await bot.delete_webhook()
+            await poll_updates(bot, supervisor.route, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await supervisor.stop()
+        log.info("supervisor: %s", supervisor.stats())
+        await bot.session.close()
+
+
+async def main():
+    if DELIVERY_MODE == "webhook" and not IS_WORKER:
+        # before the DB, workers or the port are touched: set_webhook would only fail later
+        try:
+            check_base_url(WEBHOOK_BASE_URL)
+        except ValueError as e:
+            raise SystemExit(f"webhook mode: {e}")
+
+    if WORKERS > 1 and not IS_WORKER:
+        await run_supervisor()
+        return
+
+    if IS_WORKER:
+        # Ctrl+C and systemd signal the whole group; the supervisor closes stdin when it is time
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: None)
+
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=api_server()))
+    await startup(bot)
+    try:
+        if IS_WORKER:
+            await run_worker(bot)
+        elif DELIVERY_MODE == "webhook":
+            await run_webhook(
+                dp,
+                bot,
+                base_url=WEBHOOK_BASE_URL,
+                path=WEBHOOK_PATH,
+                secret=WEBHOOK_SECRET or default_secret(BOT_TOKEN),
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
-        await db.close()
+        await shutdown(bot)
 
 
 if __name__ == "__main__":
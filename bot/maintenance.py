@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Any
+
+from bot.db import DB, _utc_now, _day_key
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class MaintenanceReport:
+    finished_at: str
+    cutoff_day: str
+    archived: int
+    deleted: int
+    files: List[str]
+    bytes_before: int
+    bytes_after: int
+    seconds: float
+    vacuumed: bool = False  # the one-time full VACUUM ran in this round
+    vacuum_pending: bool = False  # the file still needs it (full_vacuum is off)
+
+    @property
+    def reclaimed(self) -> int:
+        return max(0, self.bytes_before - self.bytes_after)
+
+
+class Maintenance:
+    """
+    Periodic housekeeping for bot.db: events older than `retention_days` are
+    appended to gzip NDJSON archives (one file per month, one gzip member per
+    batch), then deleted in small batches with a pause in between so the
+    writer connection stays available for users. Afterwards free pages are
+    given back with incremental_vacuum and the WAL is truncated.
+
+    A file created before incremental auto-vacuum needs one full VACUUM to
+    switch, which blocks writes while the file is rewritten. It runs here
+    only with `full_vacuum`; otherwise the report says it is pending.
+
+    Archiving happens before deleting, so a crash in between can only
+    duplicate a batch in the archive, never lose it.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        archive_dir: str = "archive",
+        retention_days: int = 90,
+        batch_size: int = 2000,
+        batch_pause: float = 0.05,
+        interval: float = 6 * 3600,
+        first_delay: float = 120,
+        vacuum_pages: int = 2000,
+        full_vacuum: bool = False,
+    ):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self.first_delay = first_delay
+        self.vacuum_pages = vacuum_pages
+        self.full_vacuum = full_vacuum
+
+        self.last_report: Optional[MaintenanceReport] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._notify: Optional[Callable[[MaintenanceReport], Awaitable[None]]] = None
+        self._pending_notified = False
+
+    def start(self, notify: Optional[Callable[[MaintenanceReport], Awaitable[None]]] = None):
+        self._notify = notify
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(self.first_delay)
+        while True:
+            try:
+                report = await self.run_once()
+                # a pending VACUUM is worth one message, not one every round
+                pending = report.vacuum_pending and not self._pending_notified
+                if self._notify is not None and (report.deleted or report.reclaimed or report.vacuumed or pending):
+                    await self._notify(report)
+                    self._pending_notified = self._pending_notified or pending
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("maintenance failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> MaintenanceReport:
+        async with self._lock:
+            started = time.monotonic()
+            cutoff = _day_key(_utc_now() - timedelta(days=self.retention_days))
+            before = await self.db.storage_info()
+
+            archived = deleted = 0
+            files = set()
+            last_id = 0
+            while True:
+                rows = await self.db.fetch_old_events(cutoff, last_id, self.batch_size)
+                if not rows:
+                    break
+
+                files.update(await asyncio.to_thread(self._archive, rows))
+                archived += len(rows)
+
+                deleted += await self.db.delete_events(rows[0]["id"], rows[-1]["id"], cutoff)
+                last_id = rows[-1]["id"]
+                await asyncio.sleep(self.batch_pause)
+
+            vacuumed = pending = False
+            if await self.db.auto_vacuum_mode() != 2:
+                if self.full_vacuum:
+                    log.info("maintenance: full VACUUM to switch to incremental auto-vacuum")
+                    await self.db.vacuum()
+                    vacuumed = True
+                else:
+                    pending = True
+
+            # give pages back in steps of `vacuum_pages`, yielding in between
+            free = (await self.db.storage_info())["freelist_count"]
+            while free:
+                await self.db.incremental_vacuum(self.vacuum_pages)
+                await asyncio.sleep(self.batch_pause)
+                left = (await self.db.storage_info())["freelist_count"]
+                if left >= free:
+                    break
+                free = left
+            await self.db.wal_checkpoint()
+
+            after = await self.db.storage_info()
+            self.last_report = MaintenanceReport(
+                finished_at=_utc_now().isoformat(timespec="seconds"),
+                cutoff_day=cutoff,
+                archived=archived,
+                deleted=deleted,
+                files=sorted(files),
+                bytes_before=before["db_bytes"] + before["wal_bytes"],
+                bytes_after=after["db_bytes"] + after["wal_bytes"],
+                seconds=time.monotonic() - started,
+                vacuumed=vacuumed,
+                vacuum_pending=pending,
+            )
+            return self.last_report
+
+    def _archive(self, rows: List[Dict[str, Any]]) -> List[str]:
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        by_month: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for r in rows:
+            by_month[r["day"][:7]].append(r)
+
+        files = []
+        for month, items in by_month.items():
+            path = os.path.join(self.archive_dir, f"events-{month}.ndjson.gz")
+            data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in items).encode("utf-8")
+            with open(path, "ab") as f:
+                f.write(gzip.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+            files.append(path)
+        return files
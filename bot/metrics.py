@@ -0,0 +1,371 @@
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# seconds; wide enough for both a SQLite write and a slow PhotoRoom call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ---------- METRIC TYPES ----------
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels: Any):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _only(self):
+        return self._children[()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+    def _render_child(self, key: Tuple[str, ...], child) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_num(child.get())}"]
+
+
+class _Value:
+    __slots__ = ("value", "fn")
+
+    def __init__(self):
+        self.value = 0.0
+        self.fn: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, fn: Callable[[], float]):
+        """Value computed at scrape time (queue length, cache size...)."""
+        self.fn = fn
+
+    def get(self) -> float:
+        if self.fn is not None:
+            try:
+                return float(self.fn())
+            except Exception:
+                log.debug("metric callback failed", exc_info=True)
+                return math.nan
+        return self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._only().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._only().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._only().dec(amount)
+
+    def set(self, value: float):
+        self._only().set(value)
+
+    def set_function(self, fn: Callable[[], float]):
+        self._only().set_function(fn)
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """inc() for the duration of the block: in-flight work."""
+        child = self._only()
+        child.inc()
+        try:
+            yield
+        finally:
+            child.dec()
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self._only().observe(value)
+
+    def time(self):
+        return self._only().time()
+
+    def _render_child(self, key: Tuple[str, ...], child: _Buckets) -> List[str]:
+        lines = []
+        total = 0
+        for bound, n in zip(self.buckets + (math.inf,), child.counts):
+            total += n
+            le = _labels(self.labelnames, key, f'le="{_num(bound)}"')
+            lines.append(f"{self.name}_bucket{le} {total}")
+        labels = _labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_num(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------- HOT PATH ----------
+
+TELEGRAM_API_SECONDS = REGISTRY.histogram(
+    "bot_telegram_api_seconds", "Bot API call duration (uploads included)", ["method", "outcome"]
+)
+DOWNLOAD_SECONDS = REGISTRY.histogram("bot_telegram_download_seconds", "Telegram file download duration")
+DOWNLOAD_BYTES = REGISTRY.counter("bot_telegram_download_bytes_total", "Bytes downloaded from Telegram")
+PREPROCESS_SECONDS = REGISTRY.histogram("bot_preprocess_seconds", "Downscale/re-encode duration", ["result"])
+PHOTOROOM_SECONDS = REGISTRY.histogram(
+    "bot_photoroom_request_seconds", "PhotoRoom request duration until response headers", ["status"]
+)
+PHOTOROOM_REQUESTS = REGISTRY.counter("bot_photoroom_requests_total", "PhotoRoom requests by status", ["status"])
+PHOTOROOM_TRANSFER_BYTES = REGISTRY.histogram(
+    "bot_photoroom_transfer_bytes",
+    "Bytes per image sent to (upload) and received from (result) PhotoRoom, by reply type",
+    ["direction", "delivery"],
+    BYTES_BUCKETS,
+)
+PHOTOROOM_BREAKER = REGISTRY.gauge("bot_photoroom_breaker_state", "Circuit breaker: 0 closed, 1 half-open, 2 open")
+DB_SECONDS = REGISTRY.histogram("bot_db_seconds", "DB operation duration, lock wait included", ["op"], FAST_BUCKETS)
+JOB_SECONDS = REGISTRY.histogram("bot_job_seconds", "Image job duration", ["outcome"])
+JOB_WAIT_SECONDS = REGISTRY.histogram("bot_job_queue_wait_seconds", "Time a job spent queued")
+JOBS_IN_FLIGHT = REGISTRY.gauge("bot_jobs_in_flight", "Image jobs being processed")
+JOBS_PENDING = REGISTRY.gauge("bot_jobs_pending", "Image jobs waiting in the queue")
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "aiogram handler duration", ["handler", "outcome"])
+LOOP_LAG_SECONDS = REGISTRY.histogram("bot_event_loop_lag_seconds", "Event loop scheduling delay", buckets=FAST_BUCKETS)
+THROTTLED = REGISTRY.counter("bot_throttled_total", "Updates dropped by flood control", ["reason", "kind"])
+BROADCAST_MESSAGES = REGISTRY.counter(
+    "bot_broadcast_messages_total", "Broadcast sends by outcome (sent, failed, blocked, retry_after)", ["outcome"]
+)
+
+
+def timed(histogram: Histogram, **labels: Any):
+    """Decorator for coroutine functions: observes their duration in `histogram`."""
+    child = histogram.labels(**labels) if labels else histogram._only()
+
+    def deco(fn: Callable[..., Awaitable[Any]]):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return deco
+
+
+# ---------- AIOGRAM ----------
+
+class HandlerTimer(BaseMiddleware):
+    """Inner middleware: times the matched handler, labeled by its function name."""
+
+    async def __call__(self, handler, event, data):
+        obj = data.get("handler")
+        name = getattr(getattr(obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(event, data)
+            outcome = "ok"
+            return result
+        finally:
+            HANDLER_SECONDS.labels(handler=name, outcome=outcome).observe(time.perf_counter() - started)
+
+
+class BotApiTimer(BaseRequestMiddleware):
+    """Session middleware: times every Bot API request by method."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await make_request(bot, method)
+            outcome = "ok"
+            return result
+        finally:
+            TELEGRAM_API_SECONDS.labels(method=method.__api_method__, outcome=outcome).observe(
+                time.perf_counter() - started
+            )
+
+
+# ---------- EVENT LOOP ----------
+
+class LoopLagMonitor:
+    """Sleeps `interval` in a loop and records how late it wakes up."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - self.interval))
+
+
+# ---------- HTTP ----------
+
+class MetricsServer:
+    """GET /metrics in the Prometheus text format, on its own (local) port."""
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -1,24 +1,395 @@
+import asyncio
+import random
+import time
 import aiohttp
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, AsyncIterable, AsyncIterator, Callable, Union
+
+from bot.metrics import PHOTOROOM_SECONDS, PHOTOROOM_REQUESTS
 
 API_URL = "https://image-api.photoroom.com/v2/edit"
 
+# 408/429 and gateway errors are worth another try; other 4xx are about the request itself
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# bytes, or a factory that opens a fresh chunk stream for every attempt
+ImageSource = Union[bytes, memoryview, Callable[[], AsyncIterable[bytes]]]
+
+
+@dataclass(frozen=True)
+class OutputOptions:
+    """/v2/edit output parameters; None keeps PhotoRoom's default."""
+    format: Optional[str] = None  # export.format: "png" | "jpeg" | "webp"
+    size: Optional[str] = None  # outputSize: "originalImage" | "croppedSubject" | "WIDTHxHEIGHT"
+    padding: Optional[str] = None  # around the subject: "0.1", "10%", "30px"
+    background: Optional[str] = None  # background.color, hex ("FFFFFF"); transparent when unset
+
+    def fields(self) -> Dict[str, str]:
+        fields = {}
+        if self.format:
+            fields["export.format"] = self.format
+        if self.size:
+            fields["outputSize"] = self.size
+        if self.padding:
+            fields["padding"] = self.padding
+        if self.background:
+            fields["background.color"] = self.background
+        return fields
+
+
+class PhotoRoomError(RuntimeError):
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpen(PhotoRoomError):
+    def __init__(self, retry_in: float):
+        super().__init__(f"PhotoRoom circuit open, retry in {retry_in:.0f}s", retryable=True, retry_after=retry_in)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    closed -> (failure_threshold consecutive failures) -> open
+    open -> (reset_timeout) -> half_open: one probe request goes through
+    half_open -> probe ok -> closed, probe failed -> open again
+
+    A probe nobody settles within `probe_timeout` counts as failed, so a
+    lost probe can't keep the breaker half-open for good.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, probe_timeout: float = 120.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe = False
+        self._probe_since = 0.0
+        self._admitted = False  # admit_job(): the one job let through while half-open
+        self._changed = asyncio.Event()
+
+    def _tick(self):
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probe = False
+        elif self.state == "half_open" and self._probe and now - self._probe_since >= self.probe_timeout:
+            self.record_failure()
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        self._tick()
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._probe:
+            self._probe = True
+            self._probe_since = time.monotonic()
+            return True
+        return False
+
+    def release_probe(self):
+        """The probe was given up (cancelled) without an answer: let another request probe."""
+        if self._probe:
+            self._probe = False
+            self._notify()
+
+    def record_success(self):
+        self.failures = 0
+        self._probe = False
+        if self.state != "closed":
+            self.state = "closed"
+            self._notify()
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Waits until a request would be let through (closed, or a free probe slot)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._tick()
+            if self.state == "closed" or (self.state == "half_open" and not self._probe):
+                return True
+            wait = self.retry_in() or 1.0
+            if self.state == "half_open":
+                # wake up when the probe's deadline passes, even if nobody settles it
+                wait = min(wait, max(0.0, self._probe_since + self.probe_timeout - time.monotonic()) or 0.01)
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def admit_job(self) -> Optional[Callable[[], None]]:
+        """
+        Scheduler gate. wait_ready() alone lets every idle worker through
+        while half-open, and all but the probe would then run into
+        CircuitOpen; here one job at a time goes through until the probe
+        settles the state. That job's release is returned, to be called
+        when it is done (it may not even reach PhotoRoom, e.g. a cache hit).
+        """
+        while True:
+            await self.wait_ready()
+            if self.state != "half_open":
+                return None
+            if not self._admitted:
+                self._admitted = True
+                return self._release_admitted
+            # the admitted job ends, or the probe opens/closes the circuit
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def _release_admitted(self):
+        self._admitted = False
+        self._notify()
+
+
+class PhotoRoomClient:
+    """
+    Long-lived PhotoRoom client: one ClientSession with a pooled keep-alive
+    connector for the whole lifetime of the bot (start() / close() from main()).
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str = API_URL,
+        pool_limit: int = 16,
+        keepalive_timeout: float = 60.0,
+        dns_ttl: int = 600,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        total_timeout: float = 90.0,
+        max_attempts: int = 4,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 20.0,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+        breaker_wait: float = 60.0,
+    ):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.pool_limit = pool_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker_wait = breaker_wait
+        # a probe can't take longer than its own request
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_threshold, reset_timeout=breaker_reset, probe_timeout=total_timeout
+        )
+        self.retries = 0
+        self.errors_retryable = 0
+        self.errors_permanent = 0
+
+        # connection pool counters (filled by trace hooks)
+        self.requests = 0
+        self.conn_opened = 0
+        self.conn_reused = 0
+
+    async def start(self):
+        if self._session is not None:
+            return
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_conn_create)
+        trace.on_connection_reuseconn.append(self._on_conn_reuse)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_ttl,
+            use_dns_cache=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers={"x-api-key": self.api_key},
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _on_conn_create(self, session, ctx, params):
+        self.conn_opened += 1
+
+    async def _on_conn_reuse(self, session, ctx, params):
+        self.conn_reused += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "conn_opened": self.conn_opened,
+            "conn_reused": self.conn_reused,
+            "pool_limit": self.pool_limit,
+            "retries": self.retries,
+            "errors_retryable": self.errors_retryable,
+            "errors_permanent": self.errors_permanent,
+            "breaker_state": self.breaker.state,
+            "breaker_retry_in": self.breaker.retry_in(),
+            "breaker_opened": self.breaker.times_opened,
+        }
+
+    @asynccontextmanager
+    async def remove_bg_stream(
+        self,
+        image: ImageSource,
+        filename: str = "image.jpg",
+        content_type: str = "image/jpeg",
+        chunk_size: int = 64 * 1024,
+        output: Optional[OutputOptions] = None,
+    ) -> AsyncIterator[AsyncIterator[bytes]]:
+        """
+        Sends `image` (bytes, or a factory of chunk streams uploaded with
+        chunked encoding) and yields the result body as a chunk iterator,
+        valid until the context exits. `output` picks the result format/size.
+
+        Retryable failures (network, timeouts, 408/429/5xx) are retried with
+        full-jitter exponential backoff, honoring Retry-After. While the
+        circuit breaker is open we wait up to `breaker_wait` for it, then
+        fail fast with CircuitOpen without touching the network.
+        """
+        if self._session is None:
+            await self.start()
+        assert self._session is not None
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.breaker.allow():
+                await self.breaker.wait_ready(timeout=self.breaker_wait)
+                if not self.breaker.allow():
+                    raise CircuitOpen(self.breaker.retry_in())
+            # this request is the half-open probe: it must settle it on every path
+            probing = self.breaker.state == "half_open"
+
+            err = None
+            try:
+                form = aiohttp.FormData()
+                for name, value in (output.fields() if output else {}).items():
+                    form.add_field(name, value)
+                form.add_field(
+                    name="imageFile",
+                    value=image() if callable(image) else image,
+                    filename=filename,
+                    content_type=content_type,
+                )
 
-async def remove_bg(image_bytes: bytes, api_key: str) -> bytes:
-    headers = {"x-api-key": api_key}
+                self.requests += 1
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    resp = await self._session.post(self.api_url, data=form)
+                    status = str(resp.status)
+                    if resp.status != 200:
+                        try:
+                            text = await resp.text()
+                        finally:
+                            resp.release()
+                        err = PhotoRoomError(
+                            f"PhotoRoom API error {resp.status}: {text[:300]}",
+                            status=resp.status,
+                            retryable=resp.status in RETRYABLE_STATUSES,
+                            retry_after=_parse_retry_after(resp.headers.get("Retry-After")),
+                        )
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                    status = "timeout" if isinstance(e, asyncio.TimeoutError) else "network"
+                    err = PhotoRoomError(f"PhotoRoom network error: {e!r}", retryable=True)
+                finally:
+                    PHOTOROOM_SECONDS.labels(status=status).observe(time.perf_counter() - started)
+                    PHOTOROOM_REQUESTS.labels(status=status).inc()
+            except asyncio.CancelledError:
+                if probing:
+                    self.breaker.release_probe()
+                raise
+            except Exception:
+                if probing:
+                    self.breaker.record_failure()
+                raise
 
-    form = aiohttp.FormData()
-    form.add_field(
-        name="imageFile",
-        value=image_bytes,
-        filename="image.png",
-        content_type="image/png",
-    )
+            if err is None:
+                self.breaker.record_success()
+                # past this point the body is being consumed: no retries
+                try:
+                    yield resp.content.iter_chunked(chunk_size)
+                finally:
+                    resp.release()
+                return
 
-    timeout = aiohttp.ClientTimeout(total=60)
+            if not err.retryable:
+                # PhotoRoom answered, it just didn't like this request
+                self.breaker.record_success()
+                self.errors_permanent += 1
+                raise err
+            self.errors_retryable += 1
+            if err.status != 429 or probing:
+                # rate limiting says nothing about PhotoRoom being down, but a
+                # probe that got no answer can't close the breaker either
+                self.breaker.record_failure()
+            if attempt >= self.max_attempts:
+                raise err
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(API_URL, headers=headers, data=form) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise RuntimeError(f"PhotoRoom API error {resp.status}: {text}")
-            return await resp.read()
+            delay = err.retry_after
+            if delay is None:
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+            elif delay > self.backoff_cap:
+                # asked to come back later than we are willing to hold the job
+                raise err
+            self.retries += 1
+            await asyncio.sleep(delay)
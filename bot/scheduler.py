@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Any
+
+from bot.metrics import JOB_SECONDS, JOB_WAIT_SECONDS, JOBS_IN_FLIGHT, JOBS_PENDING
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    key: Hashable  # dedupe key, e.g. (user_id, file_unique_id)
+    user_id: int
+    run: Callable[[], Awaitable[None]]
+    # called with the new queue position (0 = about to start) when it changes
+    on_position: Optional[Callable[[int], Awaitable[None]]] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    position: int = -1
+    notified_at: float = 0.0
+
+
+class JobScheduler:
+    """
+    In-process image job queue: `concurrency` workers, a bounded FIFO and a
+    per-user pending limit (submit() raises QueueFull instead of growing).
+    A job whose key is already pending/running is collapsed into the existing one.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        max_pending: int = 200,
+        max_per_user: int = 3,
+        position_update_interval: float = 3.0,
+        gate: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.position_update_interval = position_update_interval
+        # awaited before taking the next job (e.g. "PhotoRoom is reachable");
+        # a callable it returns is called once that job is done
+        self.gate = gate
+
+        self._pending: Deque[Job] = deque()
+        self._keys: Dict[Hashable, Job] = {}
+        self._per_user: Dict[int, int] = {}
+        self._running = 0
+        self._draining = False
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deduped = 0
+        self._waits: Deque[float] = deque(maxlen=200)
+
+    # ---------- LIFECYCLE ----------
+
+    def start(self):
+        if self._workers:
+            return
+        self._draining = False
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def drain(self, timeout: float) -> List[Job]:
+        """
+        Graceful stop: no new job is started, running ones get up to
+        `timeout` seconds to finish, then they are cancelled. Returns the
+        jobs that never started.
+        """
+        self._draining = True
+        self._wakeup.set()
+        if self._workers:
+            _, late = await asyncio.wait(self._workers, timeout=timeout)
+            if late:
+                log.warning("drain: cancelling %d running jobs after %.1fs", len(late), timeout)
+            for t in late:
+                t.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = []
+
+        left = list(self._pending)
+        self._pending.clear()
+        for job in left:
+            self._keys.pop(job.key, None)
+        self._per_user.clear()
+        JOBS_PENDING.set(0)
+        return left
+
+    # ---------- SUBMIT ----------
+
+    def submit(self, job: Job) -> Optional[int]:
+        """
+        Returns the queue position (0 = a worker will pick it right away),
+        or None when an identical job is already pending/running.
+        """
+        if job.key in self._keys:
+            self.deduped += 1
+            return None
+        if len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            raise QueueFull("queue is full")
+        if self._per_user.get(job.user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise QueueFull("too many jobs for this user")
+
+        self._pending.append(job)
+        JOBS_PENDING.set(len(self._pending))
+        self._keys[job.key] = job
+        self._per_user[job.user_id] = self._per_user.get(job.user_id, 0) + 1
+        self.submitted += 1
+
+        job.position = self._position(len(self._pending) - 1)
+        job.notified_at = time.monotonic()
+        self._wakeup.set()
+        return job.position
+
+    def _position(self, index: int) -> int:
+        free = max(0, self.concurrency - self._running)
+        return max(0, index + 1 - free)
+
+    # ---------- WORKERS ----------
+
+    async def _worker(self):
+        while not self._draining:
+            while not self._pending and not self._draining:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            release = None
+            if self.gate is not None and not self._draining:
+                release = await self.gate()
+            if self._draining or not self._pending:
+                if release is not None:
+                    release()
+                continue
+
+            job = self._pending.popleft()
+            JOBS_PENDING.set(len(self._pending))
+            job.started_at = time.monotonic()
+            self._waits.append(job.started_at - job.enqueued_at)
+            JOB_WAIT_SECONDS.observe(job.started_at - job.enqueued_at)
+            self._running += 1
+            JOBS_IN_FLIGHT.inc()
+            self._notify_positions()
+
+            outcome = "cancelled"
+            try:
+                await job.run()
+                self.completed += 1
+                outcome = "ok"
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                outcome = "error"
+                log.exception("job %r failed", job.key)
+            finally:
+                JOB_SECONDS.labels(outcome=outcome).observe(time.monotonic() - job.started_at)
+                JOBS_IN_FLIGHT.dec()
+                self._running -= 1
+                if release is not None:
+                    release()
+                self._keys.pop(job.key, None)
+                left = self._per_user.get(job.user_id, 1) - 1
+                if left > 0:
+                    self._per_user[job.user_id] = left
+                else:
+                    self._per_user.pop(job.user_id, None)
+
+    def _notify_positions(self):
+        now = time.monotonic()
+        for index, job in enumerate(self._pending):
+            pos = self._position(index)
+            if pos == job.position or job.on_position is None:
+                continue
+            # front of the queue gets every update, the tail is throttled
+            if pos > 3 and now - job.notified_at < self.position_update_interval:
+                continue
+            job.position = pos
+            job.notified_at = now
+            asyncio.create_task(self._safe_notify(job, pos))
+
+    @staticmethod
+    async def _safe_notify(job: Job, pos: int):
+        try:
+            await job.on_position(pos)
+        except Exception:
+            log.debug("position update failed for %r", job.key, exc_info=True)
+
+    # ---------- STATS ----------
+
+    def load(self) -> float:
+        """Queue fill level, 0..1 (cheap enough to call per update)."""
+        return len(self._pending) / self.max_pending if self.max_pending else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        oldest = time.monotonic() - self._pending[0].enqueued_at if self._pending else 0.0
+        return {
+            "pending": len(self._pending),
+            "running": self._running,
+            "concurrency": self.concurrency,
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "deduped": self.deduped,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "wait_oldest": oldest,
+        }
@@ -0,0 +1,103 @@
+import mmap
+import os
+import time
+from typing import AsyncGenerator, AsyncIterable, Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.types import FSInputFile, InputFile
+
+from bot.metrics import DOWNLOAD_SECONDS, DOWNLOAD_BYTES
+
+CHUNK_SIZE = 64 * 1024
+# slices of a mapped file: no socket in between, so fewer, bigger chunks
+LOCAL_CHUNK_SIZE = 1024 * 1024
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class StreamInputFile(InputFile):
+    """
+    Upload an async stream of chunks (e.g. a PhotoRoom response body)
+    without collecting it into one bytes object first. Can be read once.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes], filename: str = "result.png"):
+        super().__init__(filename=filename)
+        self._chunks = chunks
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async for chunk in self._chunks:
+            yield chunk
+
+
+async def telegram_file_chunks(bot: Bot, file_path: str, chunk_size: int = CHUNK_SIZE) -> AsyncGenerator[bytes, None]:
+    """
+    Chunks of a Telegram file. A local Bot API server (--local) answers
+    getFile with a path on its disk: that file is read in place instead of
+    being downloaded again over HTTP.
+    """
+    api = bot.session.api
+    if api.is_local and os.path.isabs(file_path):
+        async for chunk in local_file_chunks(str(api.wrap_local_file.to_local(file_path))):
+            yield chunk
+        return
+
+    url = api.file_url(bot.token, file_path)
+    started = time.perf_counter()
+    async for chunk in bot.session.stream_content(url, timeout=60, chunk_size=chunk_size):
+        DOWNLOAD_BYTES.inc(len(chunk))
+        yield chunk
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+
+
+async def local_file_chunks(path: str, chunk_size: int = LOCAL_CHUNK_SIZE) -> AsyncGenerator[bytes, None]:
+    """Reads a file through mmap: each chunk is one copy out of the page cache."""
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, size, chunk_size):
+                    chunk = mm[offset:offset + chunk_size]
+                    DOWNLOAD_BYTES.inc(len(chunk))
+                    yield chunk
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+
+
+def disk_file(bot: Bot, path: str, filename: str) -> InputFile | str:
+    """
+    A file on our disk to send. A local Bot API server reads it itself from a
+    file:// URI (no multipart upload, local upload limits); otherwise, or
+    when the server cannot see the path, it is uploaded as usual.
+    """
+    api = bot.session.api
+    if api.is_local:
+        try:
+            return "file://" + str(api.wrap_local_file.to_server(os.path.abspath(path)))
+        except ValueError:
+            pass  # outside the directory shared with the server
+    return FSInputFile(path, filename=filename)
+
+
+async def tee(
+    chunks: AsyncIterable[bytes],
+    sink: Callable[[bytes], Optional[Awaitable[None]]],
+    limit: Optional[int] = None,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Pass chunks through, feeding each one to `sink` (hasher.update, a cache
+    writer, a byte counter...). Raises FileTooLarge past `limit` bytes.
+    """
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if limit is not None and total > limit:
+            raise FileTooLarge(f"stream exceeds {limit} bytes")
+        r = sink(chunk)
+        if r is not None:
+            await r
+        yield chunk
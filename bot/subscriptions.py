@@ -0,0 +1,64 @@
+import time
+from typing import Dict, Optional, Tuple, Any
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator", "restricted")
+
+
+class SubscriptionCache:
+    """
+    user_id -> subscribed, with separate TTLs for positive and negative answers.
+    Entries are overwritten right away by chat_member updates for the channel,
+    so the TTLs only bound how stale we can be if an update is missed.
+    Errors are never cached.
+    """
+
+    def __init__(self, positive_ttl: float = 600.0, negative_ttl: float = 30.0, max_entries: int = 100_000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: Dict[int, Tuple[bool, float]] = {}  # user_id -> (subscribed, expires_at)
+
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.errors = 0
+
+    def get(self, user_id: int, trust_negative: bool = True) -> Optional[bool]:
+        item = self._entries.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        subscribed, expires_at = item
+        if expires_at < time.monotonic() or (not subscribed and not trust_negative):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return subscribed
+
+    def set(self, user_id: int, subscribed: bool):
+        if len(self._entries) >= self.max_entries:
+            self._prune()
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+
+    def on_member_update(self, user_id: int, status: str):
+        self.updates += 1
+        self.set(user_id, status in SUBSCRIBED_STATUSES)
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id in [u for u, (_, exp) in self._entries.items() if exp < now]:
+            del self._entries[user_id]
+        # still full: drop the oldest half (dicts keep insertion order)
+        if len(self._entries) >= self.max_entries:
+            for user_id in list(self._entries)[: self.max_entries // 2]:
+                del self._entries[user_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "errors": self.errors,
+        }
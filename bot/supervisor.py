@@ -0,0 +1,338 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# update types that carry the user in "from"; the rest fall back to "chat"
+USER_UPDATE_TYPES = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "chat_member",
+    "my_chat_member",
+    "chat_join_request",
+    "message_reaction",
+    "business_message",
+)
+
+
+# routed by new_chat_member.user: the member, not whoever changed it
+MEMBER_UPDATE_TYPES = ("chat_member", "my_chat_member")
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    """Worker for a user. Must agree with the `abs(user_id) % count` in DB.claim_jobs()."""
+    return abs(int(user_id)) % shards
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    for kind in USER_UPDATE_TYPES:
+        body = update.get(kind)
+        if body is None:
+            continue
+        user = None
+        if kind in MEMBER_UPDATE_TYPES:
+            # "from" is whoever changed the membership (a channel admin for a
+            # kick); the subscription cache to update is the member's. In
+            # my_chat_member the member is this bot: that goes by "from"
+            member = (body.get("new_chat_member") or {}).get("user") or {}
+            if not member.get("is_bot"):
+                user = member
+        user = user or body.get("from") or body.get("user") or body.get("chat")
+        if user and "id" in user:
+            return user["id"]
+    return None
+
+
+READY = b"ready\n"
+
+
+class WorkerProcess:
+    """
+    One `python -m bot.main` child reading raw updates, one JSON per line,
+    from stdin. It prints READY on stdout once startup() is done.
+
+    Updates wait in the worker's own queue (at most `max_queue`) and a
+    sender task writes them to the pipe, so a worker that is slow or being
+    restarted holds up only its own users. Past `max_queue` new updates for
+    it are dropped and counted.
+    """
+
+    def __init__(self, index: int, count: int, command: List[str], env: Dict[str, str], max_queue: int = 1000):
+        self.index = index
+        self.count = count
+        self.command = command
+        self.env = env
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.alive = asyncio.Event()
+        self.started_at = 0.0
+        self.restarts = 0
+        self.sent = 0
+        self.dropped = 0
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._stdout: Optional[asyncio.Task] = None
+        self._sender: Optional[asyncio.Task] = None
+
+    async def spawn(self, ready_timeout: float = 60.0):
+        env = {**os.environ, **self.env, "WORKERS": str(self.count), "WORKER_INDEX": str(self.index)}
+        self.proc = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env
+        )
+        self.started_at = time.monotonic()
+        try:
+            line = await asyncio.wait_for(self.proc.stdout.readline(), timeout=ready_timeout)
+        except asyncio.TimeoutError:
+            line = b""
+        if line != READY:
+            log.error("worker %d: not ready after %.0fs", self.index, time.monotonic() - self.started_at)
+        self._stdout = asyncio.create_task(self._forward_stdout(self.proc.stdout))
+        if self._sender is None:
+            self._sender = asyncio.create_task(self._send_loop())
+        # updates wait in the queue meanwhile, or for the restart if it died
+        self.alive.set()
+        log.info("worker %d: pid %d", self.index, self.proc.pid)
+
+    async def _forward_stdout(self, stdout: asyncio.StreamReader):
+        # a stray print() must not fill the pipe and stall the worker
+        while line := await stdout.readline():
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+
+    def send(self, line: bytes) -> bool:
+        """Queues an update for this worker; False when its queue is full and the update is dropped."""
+        try:
+            self.queue.put_nowait(line)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                log.warning(
+                    "worker %d: queue full (%d), %d updates dropped", self.index, self.queue.qsize(), self.dropped
+                )
+            return False
+
+    async def _send_loop(self):
+        while True:
+            line = await self.queue.get()
+            try:
+                await self._write(line)
+            finally:
+                self.queue.task_done()
+
+    async def _write(self, line: bytes):
+        # a worker that died takes what was still in its pipe; the next
+        # update waits for the restarted one instead of being lost too
+        while True:
+            await self.alive.wait()
+            try:
+                self.proc.stdin.write(line)
+                await self.proc.stdin.drain()
+                self.sent += 1
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                self.alive.clear()
+
+    async def close(self, timeout: float):
+        """
+        Hands over what is still queued, then EOF on stdin: the worker
+        finishes its updates, drains its jobs and exits.
+        """
+        if self._sender is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=timeout if self.alive.is_set() else 0)
+            except asyncio.TimeoutError:
+                log.warning("worker %d: %d queued updates not delivered", self.index, self.queue.qsize())
+            self._sender.cancel()
+            await asyncio.gather(self._sender, return_exceptions=True)
+            self._sender = None
+        if self.proc is None or self.proc.returncode is not None:
+            return
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning("worker %d: no exit after %.0fs, killing", self.index, timeout)
+            self.proc.kill()
+            await self.proc.wait()
+
+
+class Supervisor:
+    """
+    Runs `workers` bot processes and routes every update to one of them by
+    user id (shard_of), so all updates of a user - and with them the quota
+    checks in DB.reserve_usage() - stay in one process, in arrival order.
+    Only the raw JSON is looked at here; parsing, handlers, image work and
+    SQLite access happen in the workers.
+
+    Workers share bot.db through WAL with a busy timeout; writes that must
+    not interleave run in BEGIN IMMEDIATE, and each worker claims only the
+    durable jobs of its own shard. A worker that exits is restarted after
+    `restart_backoff` s (doubling while it keeps dying young).
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        command: List[str],
+        env: Optional[Dict[str, str]] = None,
+        restart_backoff: float = 1.0,
+        stop_timeout: float = 40.0,
+        max_queue: int = 1000,
+    ):
+        self.workers = [WorkerProcess(i, workers, command, env or {}, max_queue) for i in range(workers)]
+        self.restart_backoff = restart_backoff
+        self.stop_timeout = stop_timeout
+        self._watchers: List[asyncio.Task] = []
+        self._stopping = False
+        self.routed = 0
+        self.unrouted = 0
+
+    async def start(self):
+        """Returns once every worker is ready, so no update waits on a cold start."""
+        await asyncio.gather(*(w.spawn() for w in self.workers))
+        for w in self.workers:
+            self._watchers.append(asyncio.create_task(self._watch(w)))
+
+    async def stop(self):
+        self._stopping = True
+        await asyncio.gather(*(w.close(self.stop_timeout) for w in self.workers))
+        for task in self._watchers:
+            task.cancel()
+        await asyncio.gather(*self._watchers, return_exceptions=True)
+        self._watchers = []
+
+    async def _watch(self, w: WorkerProcess):
+        backoff = self.restart_backoff
+        while True:
+            code = await w.proc.wait()
+            w.alive.clear()
+            if self._stopping:
+                return
+            uptime = time.monotonic() - w.started_at
+            backoff = self.restart_backoff if uptime > 60 else min(backoff * 2, 60.0)
+            log.error("worker %d exited with %s after %.0fs, restarting in %.0fs", w.index, code, uptime, backoff)
+            await asyncio.sleep(backoff)
+            w.restarts += 1
+            await w.spawn()
+
+    async def route(self, update: Dict[str, Any]):
+        user_id = update_user_id(update)
+        if user_id is None:
+            self.unrouted += 1
+            user_id = 0
+        line = json.dumps(update, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+        # only queues it: a stuck worker must not hold up the others
+        if self.workers[shard_of(user_id, len(self.workers))].send(line):
+            self.routed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self.workers),
+            "routed": self.routed,
+            "unrouted": self.unrouted,
+            "sent": [w.sent for w in self.workers],
+            "queued": [w.queue.qsize() for w in self.workers],
+            "dropped": [w.dropped for w in self.workers],
+            "restarts": [w.restarts for w in self.workers],
+        }
+
+
+def build_router_app(route: Callable[[Dict[str, Any]], Awaitable[None]], path: str, secret: str) -> web.Application:
+    """Webhook endpoint of the supervisor: checks the secret and routes the raw update."""
+    app = web.Application()
+
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        await route(await request.json())
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app.router.add_post(path, handle)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def poll_updates(
+    bot: Bot,
+    route: Callable[[Dict[str, Any]], Awaitable[None]],
+    allowed_updates: Optional[List[str]] = None,
+    timeout: int = 30,
+    limit: int = 100,
+):
+    """
+    Long polling without parsing: getUpdates answers are handed to `route`
+    as plain dicts. Runs until SIGTERM/SIGINT (or cancellation).
+    """
+    session = await bot.session.create_session()
+    url = bot.session.api.api_url(bot.token, "getUpdates")
+    offset = 0
+    failures = 0
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async def get_updates() -> List[Dict[str, Any]]:
+        params = {"offset": offset, "timeout": timeout, "limit": limit}
+        if allowed_updates is not None:
+            params["allowed_updates"] = allowed_updates
+        async with session.post(url, json=params, timeout=timeout + 10) as resp:
+            body = await resp.json(content_type=None)
+        if not body.get("ok"):
+            raise RuntimeError(f"getUpdates: {body.get('error_code')} {body.get('description')}")
+        return body["result"]
+
+    try:
+        while not stop.is_set():
+            request = asyncio.ensure_future(get_updates())
+            stopped = asyncio.ensure_future(stop.wait())
+            await asyncio.wait({request, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                request.cancel()
+                break
+            stopped.cancel()
+            try:
+                updates = request.result()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                log.warning("getUpdates failed (%s), retry %d", e, failures)
+                await asyncio.sleep(min(failures, 10))
+                continue
+            for update in updates:
+                await route(update)
+                offset = update["update_id"] + 1
+        if offset:
+            # confirm what was routed, or Telegram sends it again after a restart
+            params = {"offset": offset, "timeout": 0, "limit": 1}
+            async with session.post(url, json=params, timeout=10) as resp:
+                await resp.read()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+from bot.metrics import THROTTLED
+
+log = logging.getLogger(__name__)
+
+# what an update is worth keeping under pressure
+HIGH, NORMAL, LOW = 0, 1, 2
+# share of the global bucket a priority may not dig into: low-priority
+# traffic runs dry first and leaves the rest for image jobs
+GLOBAL_FLOOR = {HIGH: 0.0, NORMAL: 0.2, LOW: 0.5}
+
+
+class _Bucket:
+    __slots__ = ("tokens", "ts", "noticed")
+
+    def __init__(self, tokens: float, ts: float):
+        self.tokens = tokens
+        self.ts = ts
+        self.noticed = 0.0
+
+
+class TokenBuckets:
+    """
+    Token buckets keyed by user: `rate` tokens/s up to `burst`. A bucket that
+    has refilled completely is the same as no bucket, so those are dropped
+    lazily (at most once per `sweep_interval`) and memory follows the
+    number of recently active users only.
+    """
+
+    def __init__(self, rate: float, burst: float, sweep_interval: float = 60.0):
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self._buckets: Dict[Any, _Bucket] = {}
+        self._swept = time.monotonic()
+
+    def _get(self, key: Any, now: float) -> _Bucket:
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = _Bucket(self.burst, now)
+        else:
+            b.tokens = min(self.burst, b.tokens + (now - b.ts) * self.rate)
+            b.ts = now
+        return b
+
+    def take(self, key: Any, cost: float = 1.0, floor: float = 0.0, now: Optional[float] = None) -> bool:
+        """Takes `cost` tokens unless that would leave fewer than `floor`."""
+        now = time.monotonic() if now is None else now
+        if now - self._swept >= self.sweep_interval:
+            self._sweep(now)
+        b = self._get(key, now)
+        if b.tokens - cost < floor:
+            return False
+        b.tokens -= cost
+        return True
+
+    def should_notice(self, key: Any, interval: float, now: Optional[float] = None) -> bool:
+        """True at most once per `interval` per key (for "slow down" replies)."""
+        now = time.monotonic() if now is None else now
+        b = self._get(key, now)
+        if now - b.noticed < interval:
+            return False
+        b.noticed = now
+        return True
+
+    def _sweep(self, now: float):
+        self._swept = now
+        full = (self.burst / self.rate) if self.rate > 0 else float("inf")
+        stale = [k for k, b in self._buckets.items() if now - b.ts >= full and now - b.noticed >= full]
+        for k in stale:
+            del self._buckets[k]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer message middleware: per-user flood control plus a global budget
+    with load shedding. `classify(message)` returns (kind, priority, cost).
+    Above `shed_load` (0..1, from `load()`) LOW updates are dropped outright;
+    the global bucket keeps a reserve per priority (GLOBAL_FLOOR).
+    Drops are counted and written to the events table every `log_interval`
+    as one "throttled" row per reason/kind.
+    """
+
+    def __init__(
+        self,
+        classify: Callable[[Message], Tuple[str, int, float]],
+        log_event: Callable[..., Awaitable[None]],
+        load: Callable[[], float] = lambda: 0.0,
+        exempt: Callable[[int], bool] = lambda user_id: False,
+        user_rate: float = 0.5,
+        user_burst: float = 12,
+        global_rate: float = 30,
+        global_burst: float = 100,
+        shed_load: float = 0.8,
+        notice_interval: float = 30.0,
+        log_interval: float = 60.0,
+    ):
+        self.classify = classify
+        self.log_event = log_event
+        self.load = load
+        self.exempt = exempt
+        self.shed_load = shed_load
+        self.notice_interval = notice_interval
+        self.log_interval = log_interval
+
+        self.users = TokenBuckets(user_rate, user_burst)
+        self.total = TokenBuckets(global_rate, global_burst)
+        self.dropped: Counter = Counter()
+        self._unlogged: Counter = Counter()
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- LIFECYCLE ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._log_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._log_drops()
+
+    async def _log_loop(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            try:
+                await self._log_drops()
+            except Exception:
+                log.exception("throttling: logging drops failed")
+
+    async def _log_drops(self):
+        batch, self._unlogged = self._unlogged, Counter()
+        for (reason, kind), n in batch.items():
+            await self.log_event(event="throttled", meta=f"reason={reason} kind={kind} n={n}")
+
+    # ---------- MIDDLEWARE ----------
+
+    def check(self, user_id: int, kind: str, priority: int, cost: float) -> Optional[str]:
+        """None when the update may pass, else the drop reason."""
+        if priority >= LOW and self.load() >= self.shed_load:
+            return "shed"
+        if not self.exempt(user_id) and not self.users.take(user_id, cost):
+            return "user"
+        if not self.total.take(None, 1.0, floor=GLOBAL_FLOOR.get(priority, 0.0) * self.total.burst):
+            return "global"
+        return None
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is None or not isinstance(event, Message):
+            return await handler(event, data)
+
+        kind, priority, cost = self.classify(event)
+        reason = self.check(user.id, kind, priority, cost)
+        if reason is None:
+            return await handler(event, data)
+
+        self.dropped[(reason, kind)] += 1
+        self._unlogged[(reason, kind)] += 1
+        THROTTLED.labels(reason=reason, kind=kind).inc()
+        if reason == "user" and self.users.should_notice(user.id, self.notice_interval):
+            try:
+                await event.answer("⏳ Слишком много сообщений подряд. Подожди немного и попробуй снова.")
+            except Exception:
+                log.debug("throttling notice failed", exc_info=True)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        by_reason: Counter = Counter()
+        for (reason, _), n in self.dropped.items():
+            by_reason[reason] += n
+        return {
+            "users_tracked": len(self.users),
+            "dropped_user": by_reason["user"],
+            "dropped_global": by_reason["global"],
+            "dropped_shed": by_reason["shed"],
+            "load": self.load(),
+        }
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import logging
+import signal
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+
+def default_secret(token: str) -> str:
+    # stable across restarts and across processes behind one load balancer
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+def check_base_url(base_url: str):
+    """Telegram delivers webhooks only to a public https URL."""
+    if not base_url:
+        raise ValueError("WEBHOOK_BASE_URL is empty; set it to the public https address of the bot")
+    parsed = urlsplit(base_url)
+    if parsed.scheme != "https" or not parsed.netloc:
+        raise ValueError(f"WEBHOOK_BASE_URL must be an https:// URL, got {base_url!r}")
+
+
+def build_app(dp: Dispatcher, bot: Bot, path: str, secret: str) -> web.Application:
+    """
+    aiohttp app serving Telegram updates on `path`. Requests without the
+    right X-Telegram-Bot-Api-Secret-Token get 401; valid ones are acked
+    right away and handled in a background task.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        handle_in_background=True,
+    ).register(app, path=path)
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    base_url: str,
+    path: str,
+    secret: str,
+    host: str,
+    port: int,
+    allowed_updates: Optional[List[str]] = None,
+    max_connections: int = 40,
+    app: Optional[web.Application] = None,
+):
+    """
+    Serves the webhook until SIGTERM/SIGINT (or cancellation). `app`
+    replaces the Dispatcher one, e.g. the supervisor's router.
+    """
+    if app is None:
+        app = build_app(dp, bot, path, secret)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    await bot.set_webhook(
+        base_url.rstrip("/") + path,
+        secret_token=secret,
+        allowed_updates=allowed_updates,
+        max_connections=max_connections,
+    )
+    log.info("webhook listening on %s:%s%s", host, port, path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+        # the webhook stays registered: Telegram keeps updates until we are back
+        await runner.cleanup()